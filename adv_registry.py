@@ -0,0 +1,142 @@
+#!/usr/bin/python2
+
+"""Setup a metaclass that registers decoders for data carried in
+advertisements, keyed by the company id of manufacturer specific data
+or the uuid of service data, the way uuid_registry does for services
+and characteristics.
+
+A decoder is a subclass of AdvDecoder with company_id or service_uuid
+set and a value property that interprets self.raw (the payload after
+the company id or uuid), e.g. profiles/ibeacon.py. Several decoders
+may share a key; accepts() picks the ones that understand a payload.
+
+decode() runs the decoders over advdata.decode() output. Results are
+cached per (address, payload), so a beacon repeating the same
+advertisement is decoded once.
+"""
+
+import struct
+import collections
+
+company_registry = {} # company id -> [decoder classes]
+service_data_registry = {} # service data uuid -> [decoder classes]
+
+class AdvMeta(type):
+    def __new__(cls, name, parents, dct):
+        c = super(AdvMeta, cls).__new__(cls, name, parents, dct)
+        if c.company_id is not None:
+            company_registry.setdefault(c.company_id, []).append(c)
+        if c.service_uuid is not None:
+            service_data_registry.setdefault(c.service_uuid, []).append(c)
+        return c
+
+from six import add_metaclass
+@add_metaclass(AdvMeta)
+class AdvDecoder(object):
+    company_id = None
+    service_uuid = None
+    name = None # key of the value in decode() results; class name if None
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    @classmethod
+    def accepts(cls, raw):
+        "Whether this decoder understands the payload raw."
+        return True
+
+    @property
+    def value(self):
+        return self.raw
+
+def lookup_company(company_id):
+    """Returns the decoders registered for company_id, raises KeyError
+    if there are none"""
+    return company_registry[company_id]
+
+def lookup_service_data(uuid):
+    """Returns the decoders registered for service data uuid, raises
+    KeyError if there are none"""
+    return service_data_registry[uuid]
+
+def decode_payload(decoders, raw):
+    """Returns {name: value} from each of decoders that accepts raw.
+    A decoder that fails on a malformed payload is left out."""
+    ret = {}
+    for cls in decoders:
+        try:
+            if cls.accepts(raw):
+                ret[cls.name or cls.__name__] = cls(raw).value
+        except (ValueError, IndexError, struct.error):
+            pass
+    return ret
+
+class DecodeCache(object):
+    """Decoded payloads by (address, registry key, payload), least
+    recently used dropped past capacity."""
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, address, key, decoders, raw):
+        cache_key = (address, key, raw)
+        entries = self.entries
+        ret = entries.pop(cache_key, None)
+        if ret is None:
+            self.misses += 1
+            ret = decode_payload(decoders, raw)
+            if len(entries) >= self.capacity:
+                entries.popitem(last=False)
+        else:
+            self.hits += 1
+        entries[cache_key] = ret
+        return ret
+
+    def clear(self):
+        self.entries.clear()
+
+cache = DecodeCache()
+
+def decode(data, address=None, cache=cache):
+    """Runs the registered decoders on the manufacturer and service data
+    of data, a dict from advdata.decode(). Returns {name: value}; empty
+    if nothing is registered for it.
+
+    With cache (the module's by default; None for no caching) values
+    are reused for the same address and payload, so treat them as
+    read-only.
+    """
+    ret = {}
+    items = []
+    for company,raw in data.get('manufacturer_data', {}).iteritems():
+        decoders = company_registry.get(company)
+        if decoders:
+            items.append((company, decoders, raw))
+    for uuid,raw in data.get('service_data', {}).iteritems():
+        decoders = service_data_registry.get(uuid)
+        if decoders:
+            items.append((uuid, decoders, raw))
+
+    for key,decoders,raw in items:
+        if cache is None:
+            ret.update(decode_payload(decoders, raw))
+        else:
+            ret.update(cache.get(address, key, decoders, raw))
+    return ret
+
+def decode_props(props, address=None, cache=cache):
+    """Same as decode(), but takes BlueZ Device1 properties, with their
+    ManufacturerData and ServiceData dicts."""
+    data = {}
+    manufacturer = props.get('ManufacturerData')
+    if manufacturer:
+        data['manufacturer_data'] = dict((int(k), str(bytearray(v)))
+                                         for k,v in manufacturer.items())
+    service = props.get('ServiceData')
+    if service:
+        data['service_data'] = dict((str(k).lower(), str(bytearray(v)))
+                                    for k,v in service.items())
+    return decode(data, address, cache)
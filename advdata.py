@@ -0,0 +1,257 @@
+#!/usr/bin/python2
+
+"""Parser for advertising data (AD) and EIR structures.
+
+Advertising data is a sequence of [length, type, value...]
+structures. ad_fields() walks them by offset without slicing the
+buffer, and decode()/decode_fields() interpret the common types. The
+same code serves the raw HCI scanner in scan.py and the bluepy
+backend.
+"""
+
+import struct
+
+FLAGS = 0x01
+INCOMPLETE_16B_SERVICES = 0x02
+COMPLETE_16B_SERVICES = 0x03
+INCOMPLETE_32B_SERVICES = 0x04
+COMPLETE_32B_SERVICES = 0x05
+INCOMPLETE_128B_SERVICES = 0x06
+COMPLETE_128B_SERVICES = 0x07
+SHORT_LOCAL_NAME = 0x08
+COMPLETE_LOCAL_NAME = 0x09
+TX_POWER = 0x0A
+SERVICE_DATA_16B = 0x16
+APPEARANCE = 0x19
+SERVICE_DATA_32B = 0x20
+SERVICE_DATA_128B = 0x21
+MANUFACTURER_DATA = 0xFF
+
+UUID_16B_TYPES = (INCOMPLETE_16B_SERVICES, COMPLETE_16B_SERVICES)
+UUID_32B_TYPES = (INCOMPLETE_32B_SERVICES, COMPLETE_32B_SERVICES)
+UUID_128B_TYPES = (INCOMPLETE_128B_SERVICES, COMPLETE_128B_SERVICES)
+NAME_TYPES = (SHORT_LOCAL_NAME, COMPLETE_LOCAL_NAME)
+
+BASE_UUID_SUFFIX = "-0000-1000-8000-00805f9b34fb"
+
+_u8 = struct.Struct('<B')
+_s8 = struct.Struct('<b')
+_u16 = struct.Struct('<H')
+_u32 = struct.Struct('<I')
+_u128 = struct.Struct('<QQ')
+
+def ad_fields(buf, offset=0, end=None):
+    """Yields (ad_type, start, stop) for each structure in buf, so the
+    value of each is buf[start:stop]. Parsing stops at the first
+    zero-length structure (the rest is padding) or at a structure that
+    runs past end."""
+    if end is None:
+        end = len(buf)
+    unpack_from = _u8.unpack_from
+
+    while offset < end:
+        field_len = unpack_from(buf, offset)[0]
+        if field_len == 0 or offset+1+field_len > end:
+            return
+        yield unpack_from(buf, offset+1)[0], offset+2, offset+1+field_len
+        offset += 1+field_len
+
+def find(buf, ad_types, offset=0, end=None):
+    """Returns (ad_type, start, stop) of the first structure with a type
+    in ad_types, or None."""
+    for field in ad_fields(buf, offset, end):
+        if field[0] in ad_types:
+            return field
+    return None
+
+def uuid16(value):
+    return "%08x"%value+BASE_UUID_SUFFIX
+
+def uuid128(buf, offset=0):
+    "Formats the little-endian 128-bit uuid at buf[offset:]."
+    lo,hi = _u128.unpack_from(buf, offset)
+    s = "%016x%016x"%(hi,lo)
+    return '-'.join((s[0:8],s[8:12],s[12:16],s[16:20],s[20:32]))
+
+def uuid_list(buf, ad_type, start, stop):
+    "Returns the uuids in a 16, 32 or 128-bit service uuid list."
+    if ad_type in UUID_16B_TYPES:
+        return [uuid16(_u16.unpack_from(buf, i)[0])
+                for i in range(start, stop-1, 2)]
+    elif ad_type in UUID_32B_TYPES:
+        return [uuid16(_u32.unpack_from(buf, i)[0])
+                for i in range(start, stop-3, 4)]
+    elif ad_type in UUID_128B_TYPES:
+        return [uuid128(buf, i)
+                for i in range(start, stop-15, 16)]
+    return []
+
+def decode(data, offset=0, end=None):
+    """Decodes the advertising data in data[offset:end].
+
+    Returns a dict with the keys that are present among:
+
+      - flags, tx_power, appearance: ints
+
+      - name: the complete local name, or else the shortened one
+
+      - short_name: the shortened local name
+
+      - uuids: list of service uuids from all the 16, 32 and 128-bit
+        lists, as canonical strings
+
+      - service_data: dict of {uuid: bytestring}
+
+      - manufacturer_data: dict of {company_id: bytestring}
+
+      - other: dict of {ad_type: bytestring} for other types
+    """
+    view = memoryview(data)
+    return decode_fields((ad_type, view[start:stop])
+                         for ad_type,start,stop in ad_fields(data, offset, end))
+
+def decode_fields(fields):
+    """Same as decode(), but takes (ad_type, value) pairs such as the
+    ones bluepy keeps in ScanEntry.scanData."""
+    ret = {}
+    for ad_type,value in fields:
+        value = memoryview(value)
+        n = len(value)
+
+        if ad_type in NAME_TYPES:
+            name = value.tobytes()
+            if ad_type == COMPLETE_LOCAL_NAME:
+                ret['name'] = name
+            else:
+                ret['short_name'] = name
+                ret.setdefault('name', name)
+        elif ad_type == FLAGS and n >= 1:
+            ret['flags'] = _u8.unpack_from(value)[0]
+        elif ad_type in UUID_16B_TYPES+UUID_32B_TYPES+UUID_128B_TYPES:
+            ret.setdefault('uuids', []).extend(uuid_list(value, ad_type, 0, n))
+        elif ad_type == TX_POWER and n >= 1:
+            ret['tx_power'] = _s8.unpack_from(value)[0]
+        elif ad_type == APPEARANCE and n >= 2:
+            ret['appearance'] = _u16.unpack_from(value)[0]
+        elif ad_type == SERVICE_DATA_16B and n >= 2:
+            uuid = uuid16(_u16.unpack_from(value)[0])
+            ret.setdefault('service_data', {})[uuid] = value[2:].tobytes()
+        elif ad_type == SERVICE_DATA_32B and n >= 4:
+            uuid = uuid16(_u32.unpack_from(value)[0])
+            ret.setdefault('service_data', {})[uuid] = value[4:].tobytes()
+        elif ad_type == SERVICE_DATA_128B and n >= 16:
+            uuid = uuid128(value)
+            ret.setdefault('service_data', {})[uuid] = value[16:].tobytes()
+        elif ad_type == MANUFACTURER_DATA and n >= 2:
+            company = _u16.unpack_from(value)[0]
+            ret.setdefault('manufacturer_data', {})[company] = value[2:].tobytes()
+        else:
+            ret.setdefault('other', {})[ad_type] = value.tobytes()
+
+    return ret
+
+def name(data):
+    "Returns just the local name in data, or None. Complete wins."
+    short = None
+    for ad_type,start,stop in ad_fields(data):
+        if ad_type == COMPLETE_LOCAL_NAME:
+            return memoryview(data)[start:stop].tobytes()
+        elif ad_type == SHORT_LOCAL_NAME and short is None:
+            short = memoryview(data)[start:stop].tobytes()
+    return short
+
+class AdFilter(object):
+    """An accept/reject test on raw advertising data, cheap enough to
+    run on every report before anything is built from it.
+
+    A report passes when its RSSI is at least rssi, it lists one of
+    uuids (as a service uuid or in service data) and it carries one of
+    names as its local name. Criteria left as None always pass.
+    """
+
+    def __init__(self, uuids=None, rssi=None, names=None):
+        if isinstance(uuids, basestring):
+            uuids = [uuids]
+        if isinstance(names, basestring):
+            names = [names]
+
+        self.rssi = rssi
+        self.names = None if names is None else set(names)
+        self.short_uuids = None
+        self.long_uuids = None
+
+        if uuids is not None:
+            # uuids built on the base uuid are compared as integers,
+            # without formatting anything from the report.
+            self.short_uuids = set()
+            self.long_uuids = set()
+            for uuid in uuids:
+                uuid = str(uuid).lower()
+                if uuid.endswith(BASE_UUID_SUFFIX):
+                    self.short_uuids.add(int(uuid[:8],16))
+                else:
+                    self.long_uuids.add(uuid)
+
+    def _uuid_hit(self, buf, ad_type, start, stop):
+        if ad_type in UUID_16B_TYPES:
+            for i in range(start, stop-1, 2):
+                if _u16.unpack_from(buf, i)[0] in self.short_uuids:
+                    return True
+        elif ad_type in UUID_32B_TYPES:
+            for i in range(start, stop-3, 4):
+                if _u32.unpack_from(buf, i)[0] in self.short_uuids:
+                    return True
+        elif ad_type in UUID_128B_TYPES:
+            if self.long_uuids:
+                for i in range(start, stop-15, 16):
+                    if uuid128(buf, i) in self.long_uuids:
+                        return True
+        elif ad_type == SERVICE_DATA_16B and stop-start >= 2:
+            return _u16.unpack_from(buf, start)[0] in self.short_uuids
+        elif ad_type == SERVICE_DATA_32B and stop-start >= 4:
+            return _u32.unpack_from(buf, start)[0] in self.short_uuids
+        elif ad_type == SERVICE_DATA_128B and stop-start >= 16:
+            return bool(self.long_uuids) and uuid128(buf, start) in self.long_uuids
+        return False
+
+    def _name_hit(self, buf, ad_type, start, stop):
+        return (ad_type in NAME_TYPES and
+                memoryview(buf)[start:stop].tobytes() in self.names)
+
+    def match(self, buf, offset=0, end=None, rssi=None):
+        """Tests the advertising data in buf[offset:end], received with
+        the given rssi."""
+        if self.rssi is not None and rssi is not None and rssi < self.rssi:
+            return False
+        uuid_ok = self.short_uuids is None
+        name_ok = self.names is None
+        if uuid_ok and name_ok:
+            return True
+
+        for ad_type,start,stop in ad_fields(buf, offset, end):
+            if not uuid_ok:
+                uuid_ok = self._uuid_hit(buf, ad_type, start, stop)
+            if not name_ok:
+                name_ok = self._name_hit(buf, ad_type, start, stop)
+            if uuid_ok and name_ok:
+                return True
+        return False
+
+    def match_fields(self, fields, rssi=None):
+        """Same as match(), but takes (ad_type, value) pairs such as the
+        ones bluepy keeps in ScanEntry.scanData."""
+        if self.rssi is not None and rssi is not None and rssi < self.rssi:
+            return False
+        uuid_ok = self.short_uuids is None
+        name_ok = self.names is None
+        if uuid_ok and name_ok:
+            return True
+
+        for ad_type,value in fields:
+            if not uuid_ok:
+                uuid_ok = self._uuid_hit(value, ad_type, 0, len(value))
+            if not name_ok:
+                name_ok = self._name_hit(value, ad_type, 0, len(value))
+            if uuid_ok and name_ok:
+                return True
+        return False
@@ -0,0 +1,411 @@
+#!/usr/bin/python2
+
+"""The Attribute Protocol, spoken in-process.
+
+encode_*() build request PDUs and decode_*() take responses apart,
+as plain strings. AttClient runs requests, one at a time as ATT
+requires, over a connected SOCK_SEQPACKET socket: the LE ATT channel
+(see ble_att.py), or one end of a socketpair with a fake server on the
+other. Notifications and indications that arrive in between are handed
+to a callback, and indications confirmed.
+
+AttClient also has the GATT procedures built on these requests:
+service, characteristic and descriptor discovery, long reads.
+"""
+
+import time
+import uuid
+import socket
+import struct
+import threading
+
+import uuids
+
+DEFAULT_MTU = 23
+MAX_MTU = 517
+TIMEOUT = 30.0 # ATT transaction timeout
+
+ERROR_RSP = 0x01
+EXCHANGE_MTU_REQ = 0x02
+EXCHANGE_MTU_RSP = 0x03
+FIND_INFORMATION_REQ = 0x04
+FIND_INFORMATION_RSP = 0x05
+FIND_BY_TYPE_VALUE_REQ = 0x06
+FIND_BY_TYPE_VALUE_RSP = 0x07
+READ_BY_TYPE_REQ = 0x08
+READ_BY_TYPE_RSP = 0x09
+READ_REQ = 0x0a
+READ_RSP = 0x0b
+READ_BLOB_REQ = 0x0c
+READ_BLOB_RSP = 0x0d
+READ_BY_GROUP_TYPE_REQ = 0x10
+READ_BY_GROUP_TYPE_RSP = 0x11
+WRITE_REQ = 0x12
+WRITE_RSP = 0x13
+HANDLE_VALUE_NTF = 0x1b
+HANDLE_VALUE_IND = 0x1d
+HANDLE_VALUE_CFM = 0x1e
+WRITE_CMD = 0x52
+
+# Requests a peer's client may send us; all get REQUEST_NOT_SUPPORTED.
+REQUESTS = (EXCHANGE_MTU_REQ, FIND_INFORMATION_REQ, FIND_BY_TYPE_VALUE_REQ,
+            READ_BY_TYPE_REQ, READ_REQ, READ_BLOB_REQ, 0x0e, # read multiple
+            READ_BY_GROUP_TYPE_REQ, WRITE_REQ, 0x16, 0x18) # prepare, execute
+
+INVALID_HANDLE = 0x01
+READ_NOT_PERMITTED = 0x02
+WRITE_NOT_PERMITTED = 0x03
+INVALID_PDU = 0x04
+INSUFFICIENT_AUTHENTICATION = 0x05
+REQUEST_NOT_SUPPORTED = 0x06
+INVALID_OFFSET = 0x07
+INSUFFICIENT_AUTHORIZATION = 0x08
+ATTRIBUTE_NOT_FOUND = 0x0a
+ATTRIBUTE_NOT_LONG = 0x0b
+INSUFFICIENT_ENCRYPTION = 0x0f
+UNSUPPORTED_GROUP_TYPE = 0x10
+
+ERRORS = {0x01: 'Invalid Handle',
+          0x02: 'Read Not Permitted',
+          0x03: 'Write Not Permitted',
+          0x04: 'Invalid PDU',
+          0x05: 'Insufficient Authentication',
+          0x06: 'Request Not Supported',
+          0x07: 'Invalid Offset',
+          0x08: 'Insufficient Authorization',
+          0x09: 'Prepare Queue Full',
+          0x0a: 'Attribute Not Found',
+          0x0b: 'Attribute Not Long',
+          0x0c: 'Insufficient Encryption Key Size',
+          0x0d: 'Invalid Attribute Value Length',
+          0x0e: 'Unlikely Error',
+          0x0f: 'Insufficient Encryption',
+          0x10: 'Unsupported Group Type',
+          0x11: 'Insufficient Resources'}
+
+# GATT attribute types
+PRIMARY_SERVICE = 0x2800
+CHARACTERISTIC = 0x2803
+
+# Characteristic properties
+PROP_BROADCAST = 0x01
+PROP_READ = 0x02
+PROP_WRITE_NO_RESP = 0x04
+PROP_WRITE = 0x08
+PROP_NOTIFY = 0x10
+PROP_INDICATE = 0x20
+
+BASE_UUID = '-0000-1000-8000-00805f9b34fb'
+
+class AttError(Exception):
+    "An Error Response from the server."
+
+    def __init__(self, request, handle, code):
+        Exception.__init__(self, "%s (0x%02x) for request 0x%02x, handle 0x%04x"%(
+            ERRORS.get(code, 'Error'), code, request, handle))
+        self.request = request
+        self.handle = handle
+        self.code = code
+
+class Disconnected(IOError): pass
+
+_op = struct.Struct('<B')
+_op_u16 = struct.Struct('<BH')
+_op_u16_u16 = struct.Struct('<BHH')
+_op_range_u16 = struct.Struct('<BHHH')
+_error = struct.Struct('<BBHB')
+_u16 = struct.Struct('<H')
+_u16_u16 = struct.Struct('<HH')
+_characteristic = struct.Struct('<BH')
+
+def uuid_bytes(u):
+    """A uuid (string or int, as for uuids.canonical_uuid()) in ATT
+    form: 2 bytes for a Bluetooth base uuid, else 16, little-endian."""
+    u = uuids.canonical_uuid(u).lower()
+    if u.startswith('0000') and u.endswith(BASE_UUID):
+        return _u16.pack(int(u[4:8], 16))
+    return uuid.UUID(u).bytes[::-1]
+
+def uuid_str(b):
+    "The inverse of uuid_bytes(), giving uuids' canonical form."
+    if len(b) == 2:
+        return "%08x%s"%(_u16.unpack(b)[0], BASE_UUID)
+    if len(b) == 16:
+        return str(uuid.UUID(bytes=b[::-1]))
+    raise ValueError("bad uuid length %d"%len(b))
+
+def encode_exchange_mtu_req(mtu):
+    return _op_u16.pack(EXCHANGE_MTU_REQ, mtu)
+
+def encode_find_information_req(start, end):
+    return _op_u16_u16.pack(FIND_INFORMATION_REQ, start, end)
+
+def encode_find_by_type_value_req(start, end, att_type, value):
+    return _op_range_u16.pack(FIND_BY_TYPE_VALUE_REQ, start, end,
+                              att_type)+value
+
+def encode_read_by_type_req(start, end, att_type):
+    return _op_u16_u16.pack(READ_BY_TYPE_REQ, start, end)+uuid_bytes(att_type)
+
+def encode_read_by_group_type_req(start, end, group_type):
+    return (_op_u16_u16.pack(READ_BY_GROUP_TYPE_REQ, start, end)+
+            uuid_bytes(group_type))
+
+def encode_read_req(handle):
+    return _op_u16.pack(READ_REQ, handle)
+
+def encode_read_blob_req(handle, offset):
+    return _op_u16_u16.pack(READ_BLOB_REQ, handle, offset)
+
+def encode_write_req(handle, value):
+    return _op_u16.pack(WRITE_REQ, handle)+value
+
+def encode_write_cmd(handle, value):
+    return _op_u16.pack(WRITE_CMD, handle)+value
+
+def encode_error_rsp(request, handle, code):
+    return _error.pack(ERROR_RSP, request, handle, code)
+
+def decode_error_rsp(pdu):
+    "Returns the AttError a response stands for."
+    _,request,handle,code = _error.unpack_from(pdu)
+    return AttError(request, handle, code)
+
+def decode_exchange_mtu_rsp(pdu):
+    return _op_u16.unpack_from(pdu)[1]
+
+def decode_find_information_rsp(pdu):
+    "Returns [(handle, uuid)]."
+    fmt = ord(pdu[1])
+    if fmt == 1:
+        size = 2
+    elif fmt == 2:
+        size = 16
+    else:
+        raise ValueError("bad Find Information format %d"%fmt)
+    step = 2+size
+    if (len(pdu)-2) % step:
+        raise ValueError("bad Find Information length")
+    return [(_u16.unpack_from(pdu, pos)[0], uuid_str(pdu[pos+2:pos+step]))
+            for pos in xrange(2, len(pdu), step)]
+
+def decode_find_by_type_value_rsp(pdu):
+    "Returns [(found handle, group end handle)]."
+    if (len(pdu)-1) % 4:
+        raise ValueError("bad Find By Type Value length")
+    return [_u16_u16.unpack_from(pdu, pos) for pos in xrange(1, len(pdu), 4)]
+
+def decode_read_by_type_rsp(pdu):
+    "Returns [(handle, value)]."
+    step = ord(pdu[1])
+    if step < 2 or (len(pdu)-2) % step:
+        raise ValueError("bad Read By Type length")
+    return [(_u16.unpack_from(pdu, pos)[0], pdu[pos+2:pos+step])
+            for pos in xrange(2, len(pdu), step)]
+
+def decode_read_by_group_type_rsp(pdu):
+    "Returns [(start handle, end handle, value)]."
+    step = ord(pdu[1])
+    if step < 4 or (len(pdu)-2) % step:
+        raise ValueError("bad Read By Group Type length")
+    return [_u16_u16.unpack_from(pdu, pos)+(pdu[pos+4:pos+step],)
+            for pos in xrange(2, len(pdu), step)]
+
+def decode_characteristic(value):
+    """A characteristic declaration's value -> (properties, value
+    handle, uuid)."""
+    properties,value_handle = _characteristic.unpack_from(value)
+    return properties, value_handle, uuid_str(value[3:])
+
+def decode_handle_value(pdu):
+    "A notification or indication -> (handle, value)."
+    return _op_u16.unpack_from(pdu)[1], pdu[3:]
+
+class AttClient(object):
+    """The client side of an ATT bearer.
+
+    on_notification(handle, value) is called for each notification
+    and indication, from whichever thread is waiting on the socket:
+    one running a request, or process().
+    """
+
+    def __init__(self, sock, on_notification=None, timeout=TIMEOUT):
+        self.sock = sock
+        self.on_notification = on_notification
+        self.timeout = timeout
+        self.mtu = DEFAULT_MTU
+        self.connected = True
+        self.lock = threading.RLock()
+        self._buf = bytearray(MAX_MTU)
+        self._view = memoryview(self._buf)
+        self._sock_timeout = sock.gettimeout()
+
+    def _recv(self, timeout):
+        if timeout != self._sock_timeout:
+            self.sock.settimeout(timeout)
+            self._sock_timeout = timeout
+        n = self.sock.recv_into(self._buf)
+        if not n:
+            self.connected = False
+            raise Disconnected("ATT bearer closed")
+        return self._view[:n].tobytes()
+
+    def _dispatch(self, pdu):
+        "Handles a PDU that is not the response being waited for."
+        opcode = ord(pdu[0])
+        if opcode in (HANDLE_VALUE_NTF, HANDLE_VALUE_IND):
+            handle,value = decode_handle_value(pdu)
+            if self.on_notification is not None:
+                self.on_notification(handle, value)
+            if opcode == HANDLE_VALUE_IND:
+                self.sock.sendall(_op.pack(HANDLE_VALUE_CFM))
+        elif opcode in REQUESTS:
+            # We are no server; say so rather than leave the peer
+            # waiting out its timeout.
+            self.sock.sendall(encode_error_rsp(opcode, 0,
+                                               REQUEST_NOT_SUPPORTED))
+
+    def request(self, pdu, response):
+        """Sends a request and returns the PDU of the expected response
+        opcode. Raises AttError for an Error Response, socket.timeout
+        after timeout seconds."""
+        with self.lock:
+            self.sock.sendall(pdu)
+            t_end = time.time()+self.timeout
+            while 1:
+                remaining = t_end-time.time()
+                if remaining <= 0:
+                    raise socket.timeout("no ATT response")
+                rsp = self._recv(remaining)
+                opcode = ord(rsp[0])
+                if opcode == response:
+                    return rsp
+                if opcode == ERROR_RSP:
+                    err = decode_error_rsp(rsp)
+                    if err.request == ord(pdu[0]):
+                        raise err
+                    continue
+                self._dispatch(rsp)
+
+    def command(self, pdu):
+        with self.lock:
+            self.sock.sendall(pdu)
+
+    def process(self, timeout=None):
+        """Waits up to timeout seconds for one PDU from the server and
+        handles it. Returns False if nothing came."""
+        with self.lock:
+            try:
+                pdu = self._recv(timeout)
+            except socket.timeout:
+                return False
+        self._dispatch(pdu)
+        return True
+
+    def exchange_mtu(self, mtu=MAX_MTU):
+        "Negotiates the MTU, returning the one to use."
+        rsp = self.request(encode_exchange_mtu_req(mtu), EXCHANGE_MTU_RSP)
+        self.mtu = max(DEFAULT_MTU, min(mtu, decode_exchange_mtu_rsp(rsp)))
+        return self.mtu
+
+    def _each(self, start, end, encode, response, decode):
+        """Runs a discovery request over start..end until the server
+        runs out, yielding (last handle, item) for each item found."""
+        while start <= end:
+            try:
+                rsp = self.request(encode(start, end), response)
+            except AttError as err:
+                if err.code == ATTRIBUTE_NOT_FOUND:
+                    return
+                raise
+            items = decode(rsp)
+            if not items:
+                return
+            for last,item in items:
+                yield last,item
+            if last < start or last >= end:
+                return
+            start = last+1
+
+    def primary_services(self, start=1, end=0xffff):
+        "Returns [(start handle, end handle, uuid)] of every primary service."
+        def decode(rsp):
+            return [(e, (s, e, uuid_str(v)))
+                    for s,e,v in decode_read_by_group_type_rsp(rsp)]
+        return [item for _,item in self._each(
+            start, end,
+            lambda s,e: encode_read_by_group_type_req(s, e, PRIMARY_SERVICE),
+            READ_BY_GROUP_TYPE_RSP, decode)]
+
+    def primary_service_by_uuid(self, u, start=1, end=0xffff):
+        "Returns [(start handle, end handle)] of the primary services u."
+        value = uuid_bytes(u)
+        def decode(rsp):
+            return [(e, (s, e)) for s,e in decode_find_by_type_value_rsp(rsp)]
+        return [item for _,item in self._each(
+            start, end,
+            lambda s,e: encode_find_by_type_value_req(s, e, PRIMARY_SERVICE,
+                                                      value),
+            FIND_BY_TYPE_VALUE_RSP, decode)]
+
+    def characteristics(self, start, end):
+        """Returns [(declaration handle, properties, value handle, uuid)]
+        of the characteristics declared in start..end."""
+        def decode(rsp):
+            return [(h, (h,)+decode_characteristic(v))
+                    for h,v in decode_read_by_type_rsp(rsp)]
+        return [item for _,item in self._each(
+            start, end,
+            lambda s,e: encode_read_by_type_req(s, e, CHARACTERISTIC),
+            READ_BY_TYPE_RSP, decode)]
+
+    def find_information(self, start, end):
+        "Returns [(handle, uuid)] of every attribute in start..end."
+        def decode(rsp):
+            return [(h, (h, u)) for h,u in decode_find_information_rsp(rsp)]
+        return [item for _,item in self._each(
+            start, end, encode_find_information_req,
+            FIND_INFORMATION_RSP, decode)]
+
+    def read_by_type(self, att_type, start=1, end=0xffff):
+        """Returns [(handle, value)] of the attributes of att_type, from
+        one request."""
+        rsp = self.request(encode_read_by_type_req(start, end, att_type),
+                           READ_BY_TYPE_RSP)
+        return decode_read_by_type_rsp(rsp)
+
+    def read(self, handle):
+        "Reads a value, with Read Blob requests for the rest of a long one."
+        value = self.request(encode_read_req(handle), READ_RSP)[1:]
+        if len(value) < self.mtu-1:
+            return value
+        parts = [value]
+        offset = len(value)
+        while 1:
+            try:
+                part = self.request(encode_read_blob_req(handle, offset),
+                                    READ_BLOB_RSP)[1:]
+            except AttError as err:
+                if err.code in (ATTRIBUTE_NOT_LONG, INVALID_OFFSET):
+                    break
+                raise
+            parts.append(part)
+            offset += len(part)
+            if len(part) < self.mtu-1:
+                break
+        return ''.join(parts)
+
+    def write(self, handle, value, response=True):
+        """Writes value with a Write Request (waiting for the response)
+        or, without response, a Write Command."""
+        if len(value) > self.mtu-3:
+            raise ValueError("%d bytes do not fit the MTU of %d"%(
+                len(value), self.mtu))
+        if response:
+            self.request(encode_write_req(handle, value), WRITE_RSP)
+        else:
+            self.command(encode_write_cmd(handle, value))
+
+    def close(self):
+        self.connected = False
+        self.sock.close()
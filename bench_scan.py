@@ -0,0 +1,123 @@
+#!/usr/bin/python2
+
+"""Throughput benchmark for the advertising report decoder in scan.py.
+
+Usage: bench_scan.py [capture]
+
+The events come from a btsnoop or pcap capture, as recorded by
+scan.py -w: the received LE Advertising Report events in it, in the
+format read from the scan socket. Without a capture, the synthetic
+events below stand in: hand-made reports for a heart rate monitor,
+power meters and beacons, with made up names and addresses. Either
+way they are concatenated into one buffer and decoded in place, the
+way HciScanSource hands them to the decoder.
+"""
+
+import sys
+import time
+import binascii
+
+import scan
+import advdata
+import capture
+
+synthetic_events = [
+    # one report: heart rate monitor, flags + 16-bit uuids + name
+    '043e21020100015e1ca32283cd1502010605030d180f180b094341544559455f48'
+    '524dc3',
+    # three reports: iBeacon, Eddystone-URL, scan response
+    '043e6902030301221100fa12f41e02011a1aff4c000215e2c56db5dffb48d2b060'
+    'd0f5a71096e000010002c5b000001371da7d1a00180201060303aafe1016aafe10'
+    'eb03676f6f2e676c2f616263b804015e1ca32283cd130f094578616d706c652044'
+    '6576696365020a04c4',
+    # four power meters batched into one event
+    '043e5602040001000000eeffc00b0201060303181803198404ce0001010000eeff'
+    'c00b0201060303181803198404cd0001020000eeffc00b02010603031818031984'
+    '04cc0001030000eeffc00b0201060303181803198404cb',
+    # one report with no advertising data
+    '043e0c02010201ccbbaa3936d400a6',
+]
+
+def load_events(path=None):
+    """Returns the advertising report events received in the capture at
+    path, or the synthetic events if path is None."""
+    if path is None:
+        return [binascii.unhexlify(e) for e in synthetic_events]
+    events = []
+    for timestamp,packet,received in capture.open_capture(path):
+        if not received or packet[:1] != chr(scan.HCI_EVENT_PKT):
+            continue
+        try:
+            if scan.decode_reports(packet):
+                events.append(packet)
+        except ValueError: # truncated, or not an LE meta event
+            pass
+    if not events:
+        raise capture.CaptureError("%s: no advertising reports"%path)
+    return events
+
+def event_buffer(events):
+    """Returns the events packed into one bytearray, and the
+    (offset, length) of each event in it."""
+    buf = bytearray()
+    spans = []
+    for e in events:
+        spans.append((len(buf), len(e)))
+        buf.extend(e)
+    return buf, spans
+
+def bench_decode_reports(events, seconds=2.0):
+    "Returns the number of reports per second decoded by decode_reports()."
+    buf, spans = event_buffer(events)
+    decode_reports = scan.decode_reports
+
+    reports = 0
+    t0 = time.time()
+    while time.time()-t0 < seconds:
+        for _ in range(1000):
+            for offset,length in spans:
+                reports += len(decode_reports(buf, offset, length))
+    return reports/(time.time()-t0)
+
+def bench_decode_event(events, seconds=2.0):
+    """Returns the number of reports per second decoded by the
+    one-report-per-event decode_event(), for comparison."""
+    decode_event = scan.decode_event
+
+    reports = 0
+    t0 = time.time()
+    while time.time()-t0 < seconds:
+        for _ in range(1000):
+            for e in events:
+                decode_event(e)
+                reports += 1
+    return reports/(time.time()-t0)
+
+def bench_advdata(events, seconds=2.0):
+    """Returns the number of reports per second whose advertising data
+    is fully decoded by advdata.decode()."""
+    buf, spans = event_buffer(events)
+    payloads = [r['data']
+                for offset,length in spans
+                for r in scan.decode_reports(buf, offset, length)]
+    decode = advdata.decode
+
+    reports = 0
+    t0 = time.time()
+    while time.time()-t0 < seconds:
+        for _ in range(1000):
+            for data in payloads:
+                decode(data)
+            reports += len(payloads)
+    return reports/(time.time()-t0)
+
+if __name__=="__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else None
+    events = load_events(path)
+    buf, spans = event_buffer(events)
+    total = sum(len(scan.decode_reports(buf, o, l)) for o,l in spans)
+    print "%d events, %d reports from %s"%(len(spans), total,
+                                           path or "the synthetic set")
+    print "decode_reports: %8.0f reports/s"%bench_decode_reports(events)
+    print "decode_event:   %8.0f reports/s (first report only)"%bench_decode_event(events)
+    print "advdata.decode: %8.0f reports/s"%bench_advdata(events)
@@ -2,9 +2,14 @@
 
 if 1:
     from ble_bluepy import *
+elif 0:
+    from ble_att import *
 else:
     from ble_dbus import *
 
+from scan import (ScanParameters, SCAN_DEFAULT, SCAN_LOW_POWER,
+                  SCAN_MAX_CAPTURE, SCAN_EXTENDED)
+
 try:    
     uuid_registry.load_classes()
 except AttributeError:
@@ -0,0 +1,869 @@
+#!/usr/bin/python2
+
+"""A backend that talks ATT to the device itself, over an LE L2CAP
+socket on the ATT channel (CID 4), with no helper process or
+bluetoothd in between. PDUs are built and taken apart in-process by
+att.py. Scanning is done with scan.py.
+
+The Device/Service/Characteristic API is that of ble_bluepy; select
+the backend in ble.py.
+"""
+
+import os
+import errno
+import ctypes
+import socket
+import struct
+import binascii
+
+import uuids
+import uuid_registry
+import advdata
+import devtable
+import gattcache
+import scan
+import att
+
+import threading,Queue
+
+class NotSupportedException(Exception): pass
+class NoNotifyException(Exception): pass
+class BleException(Exception): pass
+
+COMMAND='command'
+REQUEST='request'
+NOTIFY='notify'
+INDICATE='indicate'
+DISALLOWED='disallowed'
+
+notify_lock=threading.Lock()
+
+# Attribute types that start a service or characteristic, as opposed
+# to descriptors.
+DECLARATION_UUIDS = (uuids.canonical_uuid('0x2800'),
+                     uuids.canonical_uuid('0x2801'),
+                     uuids.canonical_uuid('0x2802'),
+                     uuids.canonical_uuid('0x2803'))
+
+# GATT databases of devices connected before, see gattcache.py; the
+# same files as ble_bluepy's. Set to None to always discover.
+gatt_cache=gattcache.GattCache()
+
+BTPROTO_L2CAP = 0
+ATT_CID = 4
+BDADDR_LE_PUBLIC = 1
+BDADDR_LE_RANDOM = 2
+SOL_BLUETOOTH = 274
+BT_SECURITY = 4
+SECURITY_LEVELS = {'low': 1, 'medium': 2, 'high': 3}
+
+# Connection attempts that failed to get through, rather than failed.
+RETRY_ERRNOS = (errno.ECONNREFUSED, errno.ECONNRESET, errno.ECONNABORTED)
+
+class SockaddrL2(ctypes.Structure):
+    _fields_ = [("l2_family", ctypes.c_ushort),
+                ("l2_psm", ctypes.c_ushort),
+                ("l2_bdaddr", scan.BdAddr),
+                ("l2_cid", ctypes.c_ushort),
+                ("l2_bdaddr_type", ctypes.c_uint8)]
+
+libc = None
+
+def _libc():
+    global libc
+    if libc is None:
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    return libc
+
+def _check(ret, name):
+    if ret >= 0:
+        return ret
+    err = ctypes.get_errno()
+    raise socket.error(err, "%s: %s"%(name, os.strerror(err)))
+
+def _sockaddr(bdaddr, address_type):
+    "bdaddr is the 6 address bytes, LSB first."
+    sa = SockaddrL2()
+    sa.l2_family = scan.AF_BLUETOOTH
+    for i,b in enumerate(bytearray(bdaddr)):
+        sa.l2_bdaddr.b[i] = b
+    sa.l2_cid = ATT_CID # little-endian, as the kernel wants it
+    sa.l2_bdaddr_type = address_type
+    return sa
+
+def _address_bytes(address):
+    "'aa:bb:cc:dd:ee:ff' -> the 6 bytes, LSB first"
+    return binascii.unhexlify(address.replace(':',''))[::-1]
+
+def _adapter_bdaddr(adapter):
+    "The address of adapter (hci number or name), or BDADDR_ANY if None."
+    if adapter is None:
+        return '\0'*6
+    if isinstance(adapter, basestring):
+        adapter = int(adapter[3:])
+    bdaddr = scan.BdAddr()
+    _check(scan.libbluetooth().hci_devba(adapter, ctypes.byref(bdaddr)),
+           "hci_devba")
+    return str(bytearray(bdaddr.b))
+
+def l2cap_connect(address, atype='random', adapter=None, security='low',
+                  timeout=10.0):
+    """Opens the ATT channel to address, a 'public' or 'random' (atype)
+    LE address, through adapter (hci number or name, any if None).
+    Returns the connected SOCK_SEQPACKET socket."""
+    libc = _libc()
+    fd = _check(libc.socket(scan.AF_BLUETOOTH, socket.SOCK_SEQPACKET,
+                               BTPROTO_L2CAP), "socket")
+    try:
+        sock = socket.fromfd(fd, scan.AF_BLUETOOTH, socket.SOCK_SEQPACKET,
+                             BTPROTO_L2CAP)
+    finally:
+        os.close(fd)
+
+    try:
+        local = _sockaddr(_adapter_bdaddr(adapter), BDADDR_LE_PUBLIC)
+        _check(libc.bind(sock.fileno(), ctypes.byref(local),
+                         ctypes.sizeof(local)), "bind")
+        sock.setsockopt(SOL_BLUETOOTH, BT_SECURITY,
+                        struct.pack('BB', SECURITY_LEVELS[security], 0))
+        # The kernel gives up connecting after the send timeout.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                        struct.pack('ll', int(timeout),
+                                    int(timeout%1*1000000)))
+        remote = _sockaddr(_address_bytes(address),
+                           BDADDR_LE_RANDOM if atype == 'random'
+                           else BDADDR_LE_PUBLIC)
+        _check(libc.connect(sock.fileno(), ctypes.byref(remote),
+                            ctypes.sizeof(remote)), "connect")
+    except:
+        sock.close()
+        raise
+    return sock
+
+class Descriptor(object):
+    def __init__(self, device, uuid, handle):
+        self.device = device
+        self.uuid = uuid
+        self.handle = handle
+
+    def read(self):
+        return self.device.client.read(self.handle)
+
+    def write(self, value, response=True):
+        self.device.client.write(self.handle, value, response)
+
+    def __repr__(self):
+        return uuids.uuid_printable(self.uuid)
+
+class Characteristic(uuid_registry.UUIDClass):
+    """Represents GATT characteristic.
+
+    properties:
+
+      - value: the classes value, as decoded by the profile, or a list
+        of uint8 values otherwise.
+
+      - raw: the raw values in/out, as bytestring.
+
+      - write_type. Set to ble.COMMAND or ble.REQUEST' as desired.
+
+      - read_type. Set to ble.COMMAND, ble.REQUEST, ble.NOTIFY, ble.INDICATE
+
+    """
+
+    def __init__(self, device, record):
+        """record is the characteristic's entry in the gattcache
+        record of device."""
+        self.device = device
+        self.uuid = str(record['uuid'])
+        self.handle = record['handle']
+        self.value_handle = record['value_handle']
+        self.properties = record['properties']
+
+        flags = []
+
+        # Start with read/write disabled, choose default per props flags
+        self._write_procedure=DISALLOWED
+        self._read_procedure=DISALLOWED
+
+        if self.properties & att.PROP_READ:
+            flags.append('read')
+            self._read_procedure=REQUEST
+        if self.properties & att.PROP_INDICATE:
+            flags.append('indicate')
+        if self.properties & att.PROP_NOTIFY:
+            flags.append('notify')
+
+        if self.properties & att.PROP_WRITE_NO_RESP:
+            self._write_procedure=COMMAND
+            flags.append('write_no_resp')
+        if self.properties & att.PROP_WRITE:
+            self._write_procedure=REQUEST
+            flags.append('write')
+        self.flags=flags
+
+        self._notify_timeout=15.0
+        self.notify_counter=0
+        self.notify_queue=Queue.Queue()
+        self.value_lock=threading.Lock()
+
+        self.descriptors=[]
+        self.cccd=None
+
+    def add_descriptors(self, descriptors):
+        self.descriptors+=descriptors
+        for d in descriptors:
+            if d.uuid==uuids.client_characteristic_configuration:
+                self.cccd = d
+
+    def _cccd_handle(self):
+        if self.cccd is not None:
+            return self.cccd.handle
+        return self.value_handle+1
+
+    def write_cccd(self, val):
+        self.device.client.write(self._cccd_handle(), val, True)
+
+    def read_cccd(self):
+        return self.device.client.read(self._cccd_handle())
+
+    def __repr__(self):
+        return uuids.uuid_printable(self.uuid)
+
+    @property
+    def readable(self):
+        return 'read' in self.flags
+
+    @property
+    def notifyable(self):
+        return 'notify' in self.flags
+
+    @property
+    def indicatable(self):
+        return 'indicate' in self.flags
+
+    @property
+    def writeable(self):
+        return 'write_no_resp' in self.flags
+
+    @property
+    def write_requestable(self):
+        return 'write' in self.flags
+
+    def read(self):
+        return self.device.client.read(self.value_handle)
+
+    def write(self, value, response=None):
+        if response is None:
+            response = self._write_procedure==REQUEST
+        val = ''.join(chr(c) for c in value)
+        try:
+            self.device.client.write(self.value_handle, val, response)
+        except att.AttError as e:
+            raise BleException(e)
+
+    @property
+    def notify_timeout(self):
+        return self._notify_timeout
+
+    @notify_timeout.setter
+    def notify_timeout(self,value):
+        self._notify_timeout=float(value)
+
+    @property
+    def read_procedure(self):
+        return self._read_procedure
+    @read_procedure.setter
+    def read_procedure(self,proc):
+        if proc==REQUEST:
+            if not self.readable:
+                raise ValueError("read request not allowed")
+        elif proc==COMMAND:
+            if not self.readable:
+                raise ValueError("read command not allowed")
+        elif proc==NOTIFY:
+            if not self.notifyable:
+                raise ValueError("notify not allowed")
+            self.notifying=True
+        elif proc==INDICATE:
+            if not self.indicatable:
+                raise ValueError("indicate not allowed")
+            self.notifying=True
+        else:
+            raise ValueError("unknown read procedure")
+        self._read_procedure=proc
+
+    @property
+    def write_procedure(self):
+        return self._write_procedure
+    @write_procedure.setter
+    def write_procedure(self,proc):
+        if proc==REQUEST:
+            if not self.write_requestable:
+                raise ValueError("write request not allowed")
+        elif proc==COMMAND:
+            if not self.writeable:
+                raise ValueError("write command not allowed")
+        else:
+            raise ValueError("unknown write procedure")
+
+        self._write_procedure=proc
+
+    @property
+    def raw(self):
+        if self._read_procedure in (REQUEST,COMMAND):
+            return self.read()
+        elif self._read_procedure in (NOTIFY,INDICATE):
+            try:
+                return self.notify_queue.get(block=False)
+            except Queue.Empty:
+                self._wait_notify(self._notify_timeout)
+                return self.notify_queue.get(block=False)
+        else:
+            raise IOError("Read not allowed or notifications not set")
+
+    @raw.setter
+    def raw(self,val):
+        if self._write_procedure==COMMAND:
+            return self.device.client.write(self.value_handle, val, False)
+        elif self._write_procedure==REQUEST:
+            return self.device.client.write(self.value_handle, val, True)
+        else:
+            raise IOError("Write not allowed")
+
+    @property
+    def value(self):
+        if 'String' in repr(self) or 'Name' in repr(self):
+            return self.raw.rstrip('\0')
+        else:
+            return [ord(c) for c in self.raw]
+
+    @value.setter
+    def value(self, val):
+        if 'String' in repr(self) or 'Name' in repr(self):
+            self.raw=str(val)+'\0'
+        else:
+            self.raw=''.join(chr(c) for c in val)
+
+    def _notify_cb(self, data):
+        with self.value_lock:
+            self.notify_queue.put(data)
+            self._last_raw = data
+            self.notify_counter+=1
+
+    @property
+    def last_raw(self):
+        with self.value_lock:
+            ret=self._last_raw
+        return ret
+
+    @property
+    def notifying(self):
+        return self.read_cccd() != '\0\0'
+
+    @notifying.setter
+    def notifying(self, value):
+        if not self.notifyable and not self.indicatable:
+            raise Exception("not notifyable")
+        if value:
+            with notify_lock:
+                self.device.notification_callbacks[self.value_handle]=self._notify_cb
+
+            if self.indicatable:
+                self.write_cccd('\2\0')
+                self._read_procedure = INDICATE
+            else:
+                self.write_cccd('\1\0')
+                self._read_procedure = NOTIFY
+
+        else:
+            self.write_cccd('\0\0')
+
+    def _wait_notify(self, timeout):
+        timeout_time=time.time()+timeout
+        with self.value_lock:
+            initial_counter = self.notify_counter
+
+        while 1:
+            with self.value_lock:
+                if initial_counter != self.notify_counter:
+                    break
+            remaining = timeout_time-time.time()
+            if remaining <= 0 or not self.device.client.process(remaining):
+                raise NoNotifyException(str(self.notify_timeout))
+
+class Service(uuid_registry.UUIDClass):
+    def __init__(self, device, record):
+        """record is the service's entry in the gattcache record of
+        device; discovered characteristics are filled into it."""
+        self.device = device
+        self.record = record
+        self.uuid = str(record['uuid'])
+        self.start = record['start']
+        self.end = record['end']
+        self._chars = None # lazy-load characteristics to avoid
+                           # unnessary discovery.
+        self._discovered = None # called after discovering characteristics
+
+    def __getattr__(self,item):
+        self.characteristics
+        return self.__dict__[item]
+
+    def _find_descriptors(self, start, end):
+        if start > end:
+            return []
+        return [(h,u) for h,u in self.device.client.find_information(start, end)
+                if u not in DECLARATION_UUIDS]
+
+    def _find_trailing_descriptors(self, start, end):
+        """For a range running to the end of the database, which many
+        devices refuse whole: asks one handle at a time and stops at
+        the first one past the device's last handle."""
+        found = []
+        for handle in range(start, end+1):
+            try:
+                one = self._find_descriptors(handle, handle)
+            except att.AttError:
+                break
+            if not one:
+                break
+            found += one
+        return found
+
+    def _discover_descriptors(self, chars):
+        """Finds the descriptors of chars (characteristic records, in
+        handle order) with Find Information over the rest of the
+        service, and hands them out by handle range."""
+        pending = [c for c in chars if c['descriptors'] is None]
+        if not pending:
+            return
+
+        # Each characteristic's descriptors lie between its value and
+        # the next declaration.
+        ends = [c['handle']-1 for c in chars[1:]]+[self.end]
+        ranges = [(c['value_handle']+1, end) for c,end in zip(chars,ends)]
+
+        start = min(c['value_handle'] for c in pending)+1
+        try:
+            found = self._find_descriptors(start, self.end)
+        except att.AttError:
+            # Some devices fail a request spanning everything; ask
+            # for each characteristic's range.
+            found = []
+            for char,(first,last) in zip(chars,ranges):
+                if char['descriptors'] is None:
+                    if last >= 0xffff:
+                        found += self._find_trailing_descriptors(first, last)
+                    else:
+                        found += self._find_descriptors(first, last)
+
+        for char,(first,last) in zip(chars,ranges):
+            if char['descriptors'] is None:
+                char['descriptors'] = [[u,h] for h,u in found
+                                       if first <= h <= last]
+
+    def _get_characteristics(self):
+        discovered = self.record['characteristics'] is None
+        if discovered:
+            self.record['characteristics'] = [
+                {'uuid': u, 'handle': h, 'value_handle': vh,
+                 'properties': p, 'descriptors': None}
+                for h,p,vh,u in self.device.client.characteristics(
+                        self.start, self.end)]
+        chars = self.record['characteristics']
+        if any(c['descriptors'] is None for c in chars):
+            discovered = True
+            self._discover_descriptors(chars)
+
+        ret = []
+        for char in chars:
+            try:
+                cls = uuid_registry.lookup_uuid(str(char['uuid']))
+            except KeyError:
+                cls = Characteristic
+            c=cls(self.device, char)
+            c.add_descriptors([Descriptor(self.device, str(u), h)
+                               for u,h in char['descriptors']])
+
+            try:
+                setattr(self,uuids.uuid_identifier(c.uuid),c)
+            except KeyError:
+                pass # unknown uuid: only in characteristics
+            ret.append(c)
+
+        if discovered and self._discovered is not None:
+            self._discovered()
+        return ret
+
+    @property
+    def characteristics(self):
+        if self._chars is None:
+            self._chars = self._get_characteristics()
+        return self._chars
+
+    def __repr__(self):
+        return uuids.uuid_printable(self.uuid)
+
+class ScanResult(object):
+    """A device heard by scan.py, as handed to scan filters: its
+    devtable entry and the latest report.
+
+    device() (or connect()) turns the result into a full Device.
+    """
+    __slots__ = ('entry', 'report')
+
+    def __init__(self, entry, report):
+        self.entry = entry
+        self.report = report
+
+    @property
+    def address(self):
+        return self.entry.address
+
+    @property
+    def atype(self):
+        return 'random' if self.report['bdaddr_type'] == 1 else 'public'
+
+    @property
+    def rssi(self):
+        return self.entry.rssi
+
+    @property
+    def adapter(self):
+        "Name of the adapter that heard the device."
+        return self.report.get('adapter')
+
+    @property
+    def advdata(self):
+        "The decoded advertising data, see advdata.decode()."
+        return self.entry.advdata
+
+    @property
+    def name(self):
+        return self.advdata.get('name')
+
+    @property
+    def uuids(self):
+        return self.advdata.get('uuids', [])
+
+    @property
+    def decoded(self):
+        return self.entry.decoded
+
+    def __getitem__(self, item):
+        "'Name', or a key of advdata."
+        if item == 'Name':
+            return self.name
+        return self.advdata.get(item)
+
+    def device(self):
+        return Device(self)
+
+    def connect(self):
+        return self.device().connect()
+
+    def __repr__(self):
+        return "ScanResult('%s')"%self.address
+
+class Device(uuid_registry.UUIDClass):
+    def __init__(self, device, atype='random', adapter=None):
+        """device is an address, with its atype ('public' or 'random'),
+        or a ScanResult. adapter is the hci number or name to connect
+        through; a ScanResult's is the one that heard it."""
+        self.client = None
+        if isinstance(device, basestring):
+            self.address = device
+            self.atype = atype
+            self.adapter = adapter
+        else:
+            self.scan_result = device
+            self.address = device.address
+            self.atype = device.atype
+            self.adapter = device.adapter if adapter is None else adapter
+
+    @property
+    def advdata(self):
+        return self.scan_result.advdata
+
+    @property
+    def uuids(self):
+        return self.scan_result.uuids
+
+    @property
+    def decoded(self):
+        return self.scan_result.decoded
+
+    def _notify_cb(self, handle, data):
+        with notify_lock:
+            try:
+                cb = self.notification_callbacks[handle]
+            except KeyError:
+                print "got notification for unexpected callback %d"%handle
+                cb = lambda x:None
+
+        return cb(data)
+
+    def _read_db_hash(self):
+        "The Database Hash as hex, read by type without discovery."
+        try:
+            found = self.client.read_by_type(gattcache.DATABASE_HASH)
+        except att.AttError:
+            return None
+        if not found:
+            return None
+        return binascii.hexlify(found[0][1])
+
+    def _cache_valid(self, record):
+        """Checks a cached record against the device's Database Hash,
+        if it has one."""
+        if record['db_hash'] is None:
+            return True
+        return self._read_db_hash() == record['db_hash']
+
+    def _service_changed_cb(self, data):
+        if gatt_cache is not None:
+            gatt_cache.invalidate(self.address)
+        self.services_changed = True
+
+    def _watch_service_changed(self):
+        """Asks for Service Changed indications, which invalidate the
+        cached database."""
+        serv = self.__dict__.get(uuids.uuid_identifier(uuids.generic_attribute)
+                                 +'_service')
+        if serv is None:
+            return
+        try:
+            chars = serv.characteristics
+        except att.AttError:
+            return
+        for c in chars:
+            if c.uuid == uuids.service_changed:
+                with notify_lock:
+                    self.notification_callbacks[c.value_handle]=self._service_changed_cb
+                try:
+                    c.write_cccd('\2\0')
+                except att.AttError:
+                    pass
+
+    def _save_gatt_cache(self):
+        # Only the whole database is cached, not the few services
+        # found by uuid.
+        if (gatt_cache is not None and self._complete and
+            not self.services_changed):
+            gatt_cache.store(self.address, self._record)
+
+    def _add_service(self, record):
+        "Wraps a service record and sets it as an attribute."
+        try:
+            cls = uuid_registry.lookup_uuid(str(record['uuid']))
+        except KeyError:
+            cls = Service
+
+        s = cls(self, record)
+        s._discovered = self._save_gatt_cache
+
+        try:
+            name = uuids.uuid_identifier(s.uuid)
+        except KeyError:
+            return s # unknown uuid: only in services
+        if not name.endswith('_service'):
+            name+='_service'
+        setattr(self,name,s)
+        return s
+
+    def _service_by_uuid(self, uuid):
+        """Discovers the service uuid alone, or returns None if the
+        device doesn't have it."""
+        if self._complete:
+            return None # it would have been set up
+        uuid = uuids.canonical_uuid(uuid)
+        found = self.client.primary_service_by_uuid(uuid)
+        if not found:
+            return None
+        start,end = found[0]
+        record = {'uuid': uuid, 'start': start, 'end': end,
+                  'characteristics': None}
+        self._record['services'].append(record)
+        s = self._add_service(record)
+        self.services.append(s)
+        return s
+
+    def _services(self, use_cache=True, services=None):
+        self.notification_callbacks={}
+        self.services_changed = False
+        self._complete = False
+        record = None
+        if use_cache and gatt_cache is not None:
+            record = gatt_cache.load(self.address)
+            if record is not None and not self._cache_valid(record):
+                gatt_cache.invalidate(self.address)
+                record = None
+
+        cached = record is not None
+        if cached:
+            self._complete = True
+        elif services is None:
+            record = {'db_hash': self._read_db_hash(),
+                      'services': [{'uuid': u, 'start': s, 'end': e,
+                                    'characteristics': None}
+                                   for s,e,u in self.client.primary_services()]}
+            self._complete = True
+        else:
+            record = {'db_hash': None, 'services': []}
+        self._record = record
+
+        if services is None or cached:
+            ret = [self._add_service(s) for s in record['services']]
+            self._watch_service_changed()
+            if not cached:
+                self._save_gatt_cache()
+            if services is None:
+                return ret
+            # The cache has every service set up for free; list the
+            # ones asked for.
+            wanted = [uuids.canonical_uuid(u).lower() for u in services]
+            return [s for u in wanted for s in ret if s.uuid.lower() == u]
+
+        self.services = []
+        for uuid in services:
+            self._service_by_uuid(uuid)
+        return self.services
+
+    def __getattr__(self, name):
+        """Services left out by connect(services=...) are discovered
+        when first used, as in dev.battery_service."""
+        if (not name.endswith('_service') or
+            '_record' not in self.__dict__ or self._complete):
+            raise AttributeError(name)
+        uuid = getattr(uuids, name[:-len('_service')], None)
+        if not isinstance(uuid, basestring):
+            uuid = getattr(uuids, name, None)
+        if (not isinstance(uuid, basestring) or
+            self._service_by_uuid(uuid) is None):
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+    def connect(self, use_cache=True, services=None, security='low',
+                mtu=att.MAX_MTU, timeout=10.0):
+        """Connects and sets up the services. The services,
+        characteristics and descriptors of a device connected before
+        come from gatt_cache, unless use_cache is False.
+
+        With services, a list of service uuids, only those are
+        discovered (by uuid) and set up; others are discovered when
+        first used.
+
+        security is 'low', 'medium' or 'high'; mtu is the ATT MTU
+        asked for."""
+        for attempt in range(10):
+            try:
+                sock = l2cap_connect(self.address, self.atype, self.adapter,
+                                     security, timeout)
+                break
+            except socket.error as e:
+                if e.errno not in RETRY_ERRNOS:
+                    raise
+            print "Attempt",attempt
+        else:
+            raise BleException("could not connect to %s"%self.address)
+
+        self.client = att.AttClient(sock, self._notify_cb)
+        try:
+            self.client.exchange_mtu(mtu)
+        except att.AttError:
+            pass # stays at the default
+        self.services=self._services(use_cache, services)
+        return self
+
+    def disconnect(self):
+        if self.client is not None:
+            self.client.close()
+
+    def connected(self):
+        return self.client is not None and self.client.connected
+
+    def __repr__(self):
+        return "Device('%s')"%self.address
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exception_type,exception_value,traceback):
+        self.disconnect()
+        return False
+
+def power(onoff=True, block=True):
+    "Adapters are used as they are; see ble_reset.sh."
+    return
+
+def discover(onoff=True, block=True):
+    "Scanning is started by discover_devices()."
+    return
+
+import time
+
+def discover_devices(scanfunc=None, uuid=None, timeout=6, limitone=False,
+                     rssi=None, name=None, table=None, params=scan.SCAN_DEFAULT,
+                     adapters=None):
+    """Yields devices that pass scanfunc, scanning with scan.py. uuid,
+    rssi (minimum) and name are checked on the raw advertising data
+    as it is decoded, so reports that fail them cost no decoding or
+    table entry. scanfunc is given a ScanResult.
+
+    Every advertisement that passes is recorded in table, a
+    devtable.DeviceTable (a default sized one is used if None).
+    params is a scan.ScanParameters. adapters is a list of hci numbers
+    to scan on at once, or 'all'."""
+
+    if table is None:
+        table = devtable.DeviceTable()
+
+    if scanfunc is None: scanfunc=lambda d:True
+
+    if uuid is None and rssi is None and name is None:
+        ad_filter = None
+    else:
+        ad_filter = advdata.AdFilter(uuid, rssi, name)
+
+    matched=set()
+    t0=time.time()
+
+    s = scan.scanner(adapters or (None,), ad_filter=ad_filter, params=params)
+    try:
+        while 1:
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = t0+timeout-time.time()
+                if remaining <= 0:
+                    return
+
+            for report in s.poll(remaining):
+                entry = table.add_report(report)
+                if entry.address in matched:
+                    continue
+
+                # Re-check a device whenever its data changes; the scan
+                # response carrying the name often comes after the
+                # advertisement.
+                result=ScanResult(entry, report)
+                if scanfunc(result):
+                    matched.add(entry.address)
+                    yield result.device()
+                    if limitone:
+                        return
+    finally:
+        s.close()
+
+def discover_device(scanfunc=None, uuid=None, timeout=30, rssi=None, name=None):
+    for d in discover_devices(scanfunc, uuid, timeout, limitone=True,
+                              rssi=rssi, name=name):
+        return d
+    raise IOError("Couldn't find device")
+
+def done():
+    pass
+
+if __name__=="__main__":
+    for d in discover_devices():
+        print d.uuids
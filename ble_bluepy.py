@@ -2,6 +2,12 @@
 
 import uuids
 import uuid_registry
+import adv_registry
+import advdata
+import devtable
+import gattcache
+import scan
+import binascii
 
 from bluepy import btle
 
@@ -14,7 +20,7 @@ def DBG(*args):
 btle.DBG=DBG
 btle.Debugging=True
 
-import threading,Queue
+import threading,Queue,collections
 
 class NotSupportedException(Exception): pass
 class NoNotifyException(Exception): pass
@@ -28,6 +34,58 @@ DISALLOWED='disallowed'
 
 notify_lock=threading.Lock()
 
+# Attribute types that start a service or characteristic, as opposed
+# to descriptors.
+DECLARATION_UUIDS = (uuids.canonical_uuid('0x2800'),
+                     uuids.canonical_uuid('0x2801'),
+                     uuids.canonical_uuid('0x2802'),
+                     uuids.canonical_uuid('0x2803'))
+
+# GATT databases of devices connected before, see gattcache.py. Set to
+# None to always discover.
+gatt_cache=gattcache.GattCache()
+
+def _gatt_record(peripheral, db_hash=None):
+    "The gattcache record of what is known of peripheral's database."
+    services = []
+    for serv in sorted(peripheral._serviceMap.values(),
+                       key=lambda s: s.hndStart):
+        chars = None
+        if serv.chars is not None:
+            chars = []
+            for c in serv.chars:
+                descs = None
+                if c.descs is not None:
+                    descs = [[str(d.uuid), d.handle] for d in c.descs]
+                chars.append({'uuid': str(c.uuid),
+                              'handle': c.handle,
+                              'value_handle': c.valHandle,
+                              'properties': c.properties,
+                              'descriptors': descs})
+        services.append({'uuid': str(serv.uuid),
+                         'start': serv.hndStart,
+                         'end': serv.hndEnd,
+                         'characteristics': chars})
+    return {'db_hash': db_hash, 'services': services}
+
+def _restore_services(peripheral, record):
+    """Fills in peripheral's services, characteristics and descriptors
+    from a gattcache record, as if they had been discovered."""
+    service_map = {}
+    for s in record['services']:
+        serv = btle.Service(peripheral, s['uuid'], s['start'], s['end'])
+        if s['characteristics'] is not None:
+            serv.chars = []
+            for c in s['characteristics']:
+                char = btle.Characteristic(peripheral, c['uuid'], c['handle'],
+                                           c['properties'], c['value_handle'])
+                if c['descriptors'] is not None:
+                    char.descs = [btle.Descriptor(peripheral, uuid, handle)
+                                  for uuid,handle in c['descriptors']]
+                serv.chars.append(char)
+        service_map[serv.uuid] = serv
+    peripheral._serviceMap = service_map
+
 class Characteristic(uuid_registry.UUIDClass):   
     """Represents GATT characteristic.
 
@@ -277,19 +335,74 @@ class Service(uuid_registry.UUIDClass):
         self.uuid = str(btle_service.uuid)
         self._chars = None # lazy-load characteristics to avoid
                            # unnessary discovery.
+        self._discovered = None # called after discovering characteristics
 
     def __getattr__(self,att):
         self.characteristics
         return self.__dict__[att]
 
+    def _find_descriptors(self, start, end):
+        if start > end:
+            return []
+        return self.serv.peripheral.getDescriptors(start, end)
+
+    def _find_trailing_descriptors(self, start, end):
+        """For a range running to the end of the database, which many
+        devices refuse whole: asks one handle at a time and stops at
+        the first one past the device's last handle."""
+        found = []
+        for handle in range(start, end+1):
+            try:
+                found += self.serv.peripheral.getDescriptors(handle, handle)
+            except btle.BTLEException:
+                break
+        return found
+
+    def _discover_descriptors(self, chars):
+        """Finds the descriptors of chars (btle characteristics, in
+        handle order) with one Find Information request over the rest
+        of the service, and hands them out by handle range."""
+        pending = [c for c in chars if c.descs is None]
+        if not pending:
+            return
+
+        # Each characteristic's descriptors lie between its value and
+        # the next declaration.
+        ends = [c.handle-1 for c in chars[1:]]+[self.serv.hndEnd]
+        ranges = [(c.valHandle+1, end) for c,end in zip(chars,ends)]
+
+        start = min(c.valHandle for c in pending)+1
+        try:
+            found = self._find_descriptors(start, self.serv.hndEnd)
+        except btle.BTLEException:
+            # Some devices fail a request spanning everything; ask
+            # for each characteristic's range.
+            found = []
+            for char,(first,last) in zip(chars,ranges):
+                if char.descs is None:
+                    if last >= 65535:
+                        found += self._find_trailing_descriptors(first, last)
+                    else:
+                        found += self._find_descriptors(first, last)
+
+        for char,(first,last) in zip(chars,ranges):
+            if char.descs is None:
+                char.descs = [d for d in found
+                              if first <= d.handle <= last and
+                              str(d.uuid) not in DECLARATION_UUIDS]
+
     def _get_characteristics(self):
         ret = []
-        chars = list(self.serv.getCharacteristics())
-        handle_pairs=[]
-        char_handles=[c.getHandle() for c in chars]+[self.serv.hndEnd+1]
-        handle_pairs = zip(char_handles[:-1],char_handles[1:])
-
-        for char,(start,end) in zip(chars,handle_pairs):
+        # Restored from the cache, nothing is asked of the device.
+        # (btle's getCharacteristics() asks again for an empty list.)
+        discovered = self.serv.chars is None
+        chars = sorted(self.serv.chars if not discovered else
+                       self.serv.getCharacteristics(), key=lambda c: c.handle)
+        if any(c.descs is None for c in chars):
+            discovered = True
+            self._discover_descriptors(chars)
+
+        for char in chars:
             uuid = str(char.uuid)
 
             cls=None
@@ -298,21 +411,16 @@ class Service(uuid_registry.UUIDClass):
             except KeyError:
                 cls = Characteristic
             c=cls(char)
+            c.add_descriptors(char.descs)
 
-            for handle in range(start+1,end):
-                try:
-                    more_descriptors = char.peripheral.getDescriptors(handle,handle)
-                except btle.BTLEException:
-                    if end < 65535:
-                        raise
-                    break
-
-                c.add_descriptors(more_descriptors)
-                
-            name = uuids.uuid_identifier(c.uuid)
-            setattr(self,name,c)
+            try:
+                setattr(self,uuids.uuid_identifier(c.uuid),c)
+            except KeyError:
+                pass # unknown uuid, such as the Database Hash: only in characteristics
             ret.append(c)
 
+        if discovered and self._discovered is not None:
+            self._discovered()
         return ret
 
     @property
@@ -324,76 +432,130 @@ class Service(uuid_registry.UUIDClass):
     def __repr__(self):
         return uuids.uuid_printable(self.uuid)
 
-class Device(uuid_registry.UUIDClass):
-    def __init__(self, bluepy_device):
+class ScanResult(object):
+    """A cheap view of one bluepy scan entry, as handed to scan filters.
 
-        if type(bluepy_device) in (str,unicode):
-            self.address = bluepy_device
-            self.atype = btle.ADDR_TYPE_RANDOM
-            
-        else:
-            self.scanentry=bluepy_device
+    Advertising data is only decoded when a field is first looked at.
+    device() (or connect()) turns the result into a full Device.
+    """
+    __slots__ = ('entry', '_advdata', '_scandata', '_decoded')
 
-            self.scandata={}
-            for _,name,val in self.scanentry.getScanData():
-                self.scandata[name]=val
-            
-            try:
-                localname = str(self.scandata['Complete Local Name'])
-            except KeyError:
-                localname = None
+    def __init__(self, entry):
+        self.entry = entry
+        self._advdata = None
+        self._scandata = None
+        self._decoded = None
 
-            self.scandata['Name']=localname
-                
-            self.uuids=[]
+    @property
+    def address(self):
+        return self.entry.addr
 
-            try:
-                uuid_scan=self.scandata['Complete 16b Services']
-            except KeyError:
-                uuid_scan=""
+    @property
+    def atype(self):
+        # not sure when this attribute name changed so, check both
+        try:
+            return self.entry.addrType
+        except AttributeError:
+            return self.entry.atype
 
-            uuid_iter = iter(uuid_scan)
-            def uuid_16s():
-                while 1:
-                    lsb = int(uuid_iter.next()+uuid_iter.next(),16)
-                    msb = int(uuid_iter.next()+uuid_iter.next(),16)
-                    yield uuids.canonical_uuid(256*msb+lsb)
-                    
-            self.uuids.extend(list(uuid_16s()))
+    @property
+    def rssi(self):
+        return self.entry.rssi
 
-            try:
-                uuid_scan=self.scandata['Incomplete 128b Services']
-            except KeyError:
-                uuid_scan=""
+    @property
+    def adapter(self):
+        "Name of the adapter that heard the device."
+        return "hci%d"%self.entry.iface
 
-            uuid_iter = iter(uuid_scan)
+    @property
+    def advdata(self):
+        "The decoded advertising data, see advdata.decode()."
+        if self._advdata is None:
+            # scanData holds the raw value of each AD structure,
+            # merged over advertisements and scan responses.
+            self._advdata = advdata.decode_fields(self.entry.scanData.iteritems())
+        return self._advdata
 
-            def uuid_128s():
-                while 1:
-                    byte_list=[]
-                    for x in range(128/8):
-                        byte_list.append(int(uuid_iter.next()+uuid_iter.next(),16))
-                    byte_list.reverse()
+    @property
+    def name(self):
+        return self.advdata.get('name')
 
-                    def part(s):
-                        return ''.join('%02x' for b in s)
+    @property
+    def uuids(self):
+        return self.advdata.get('uuids', [])
 
-                    yield '-'.join([part(byte_list[0:4]),
-                                    part(byte_list[4:6]),
-                                    part(byte_list[6:8]),
-                                    part(byte_list[8:10]),
-                                    part(byte_list[10:16])])
+    @property
+    def decoded(self):
+        """The manufacturer and service data as interpreted by the
+        decoders in adv_registry, e.g. {'ibeacon': {...}}."""
+        if self._decoded is None:
+            self._decoded = adv_registry.decode(self.advdata, self.address)
+        return self._decoded
 
-            self.uuids.extend(list(uuid_128s()))
+    @property
+    def scandata(self):
+        """The AD values keyed by bluepy's descriptions, names as text
+        and everything else as hex, plus 'Name'."""
+        if self._scandata is None:
+            scandata={}
+            for sdid,val in self.entry.scanData.iteritems():
+                name = self.entry.getDescription(sdid)
+                if sdid in advdata.NAME_TYPES:
+                    scandata[name]=str(val)
+                else:
+                    scandata[name]=binascii.hexlify(val)
+
+            scandata['Name']=self.name
+            self._scandata = scandata
+        return self._scandata
 
-            self.address = self.scanentry.addr
+    def __getitem__(self, item):
+        return self.scandata[item]
 
-            # not sure when this attribute name changed so, check both
-            try:
-                self.atype = self.scanentry.addrType
-            except AttributeError:
-                self.atype = self.scanentry.atype
+    def device(self):
+        return Device(self)
+
+    def connect(self):
+        return self.device().connect()
+
+    def __repr__(self):
+        return "ScanResult('%s')"%self.address
+
+class Device(uuid_registry.UUIDClass):
+    def __init__(self, bluepy_device):
 
+        self.iface = None
+
+        if type(bluepy_device) in (str,unicode):
+            self.address = bluepy_device
+            self.atype = btle.ADDR_TYPE_RANDOM
+            
+        else:
+            if not isinstance(bluepy_device, ScanResult):
+                bluepy_device = ScanResult(bluepy_device)
+
+            self.scan_result = bluepy_device
+            self.scanentry = bluepy_device.entry
+            self.address = bluepy_device.address
+            self.atype = bluepy_device.atype
+            # connect through the adapter that heard it
+            self.iface = bluepy_device.entry.iface
+
+    @property
+    def advdata(self):
+        return self.scan_result.advdata
+
+    @property
+    def scandata(self):
+        return self.scan_result.scandata
+
+    @property
+    def uuids(self):
+        return self.scan_result.uuids
+
+    @property
+    def decoded(self):
+        return self.scan_result.decoded
 
     def _notify_cb(self, handle, data):
         with notify_lock:
@@ -406,27 +568,166 @@ class Device(uuid_registry.UUIDClass):
         return cb(data)
 
 
-    def _services(self): 
-        self.dev.delegate.notification_callbacks={}
-        self.dev.delegate.handleNotification=self._notify_cb
+    def _cache_valid(self, record):
+        """Checks a cached record against the device's Database Hash,
+        if it has one."""
+        if record['db_hash'] is None:
+            return True
+        for s in record['services']:
+            for c in s['characteristics'] or []:
+                if c['uuid'] == gattcache.DATABASE_HASH:
+                    try:
+                        db_hash = self.dev.readCharacteristic(c['value_handle'])
+                    except btle.BTLEException:
+                        return False
+                    self._db_hash = binascii.hexlify(db_hash)
+                    return self._db_hash == record['db_hash']
+        return False
 
-        ret = []
-                
-        for service in self.dev.getServices():
-            try:
-                cls = uuid_registry.lookup_uuid(str(service.uuid))
-            except KeyError:
-                cls = Service
+    def _gatt_characteristic(self, uuid):
+        """The btle characteristic uuid in the Generic Attribute service,
+        or None."""
+        known = self.dev._serviceMap or {}
+        serv = known.get(btle.UUID(uuids.generic_attribute))
+        if serv is None:
+            return None
+        try:
+            for char in serv.getCharacteristics():
+                if str(char.uuid) == uuid:
+                    return char
+        except btle.BTLEException:
+            pass
+        return None
 
-            s = cls(service)
+    def _read_db_hash(self):
+        char = self._gatt_characteristic(gattcache.DATABASE_HASH)
+        if char is None:
+            return None
+        try:
+            return binascii.hexlify(char.read())
+        except btle.BTLEException:
+            return None
+
+    def _service_changed_cb(self, data):
+        if gatt_cache is not None:
+            gatt_cache.invalidate(self.address)
+        self.services_changed = True
+
+    def _watch_service_changed(self):
+        """Asks for Service Changed indications, which invalidate the
+        cached database."""
+        char = self._gatt_characteristic(uuids.service_changed)
+        if char is None:
+            return
+        with notify_lock:
+            self.dev.delegate.notification_callbacks[char.valHandle]=self._service_changed_cb
 
-            name = uuids.uuid_identifier(s.uuid)
-            #print "name",name,"=",s
-            if not name.endswith('_service'):
-                name+='_service'
-            setattr(self,name,s)
-            ret.append(s)
-        return ret
+        cccd = char.valHandle+1
+        for d in char.descs or []:
+            if str(d.uuid) == uuids.client_characteristic_configuration:
+                cccd = d.handle
+        try:
+            self.dev.writeCharacteristic(cccd, '\2\0', True)
+        except btle.BTLEException:
+            pass
+
+    def _save_gatt_cache(self):
+        # Only the whole database is cached, not the few services
+        # found by uuid, and only if discovery added to it.
+        if (gatt_cache is not None and self._complete and
+            self._gatt_changed and not self.services_changed):
+            gatt_cache.store(self.address,
+                             _gatt_record(self.dev, self._db_hash))
+        self._gatt_changed = False
+
+    def _service_discovered(self):
+        """Called after a service's characteristics are discovered.
+        The database is stored once all of it is known (or at
+        disconnect), not after each service."""
+        self._gatt_changed = True
+        if all(s.chars is not None and
+               all(c.descs is not None for c in s.chars)
+               for s in self.dev._serviceMap.values()):
+            self._save_gatt_cache()
+
+    def _add_service(self, service):
+        "Wraps a btle service and sets it as an attribute."
+        try:
+            cls = uuid_registry.lookup_uuid(str(service.uuid))
+        except KeyError:
+            cls = Service
+
+        s = cls(service)
+        s._discovered = self._service_discovered
+
+        name = uuids.uuid_identifier(s.uuid)
+        #print "name",name,"=",s
+        if not name.endswith('_service'):
+            name+='_service'
+        setattr(self,name,s)
+        return s
+
+    def _service_by_uuid(self, uuid):
+        """Discovers the service uuid alone, or returns None if the
+        device doesn't have it."""
+        uuid = uuids.canonical_uuid(uuid)
+        known = self.dev._serviceMap or {}
+        if self._complete and btle.UUID(uuid) not in known:
+            return None
+        try:
+            service = self.dev.getServiceByUUID(uuid)
+        except btle.BTLEException: # not found
+            return None
+        s = self._add_service(service)
+        self.services.append(s)
+        return s
+
+    def _services(self, use_cache=True, services=None): 
+        self.dev.delegate.notification_callbacks={}
+        self.dev.delegate.handleNotification=self._notify_cb
+
+        self.services_changed = False
+        self._gatt_changed = False
+        self._db_hash = None
+        self._complete = False
+        record = None
+        if use_cache and gatt_cache is not None:
+            record = gatt_cache.load(self.address)
+            if record is not None and not self._cache_valid(record):
+                gatt_cache.invalidate(self.address)
+                record = None
+
+        if record is not None:
+            _restore_services(self.dev, record)
+            self._complete = True
+        elif services is None:
+            self.dev.discoverServices()
+            self._complete = True
+            self._gatt_changed = True
+            self._db_hash = self._read_db_hash()
+        self._watch_service_changed()
+
+        if services is None:
+            return [self._add_service(service)
+                    for service in self.dev.getServices()]
+
+        self.services = []
+        for uuid in services:
+            self._service_by_uuid(uuid)
+        return self.services
+
+    def __getattr__(self, name):
+        """Services left out by connect(services=...) are discovered
+        when first used, as in dev.battery_service."""
+        if not name.endswith('_service') or 'dev' not in self.__dict__:
+            raise AttributeError(name)
+        uuid = getattr(uuids, name[:-len('_service')], None)
+        if not isinstance(uuid, basestring):
+            uuid = getattr(uuids, name, None)
+        if (not isinstance(uuid, basestring) or
+            self._service_by_uuid(uuid) is None):
+            raise AttributeError(name)
+        return self.__dict__[name]
     
     @property
     def props(self):
@@ -435,12 +736,20 @@ class Device(uuid_registry.UUIDClass):
     def __getitem__(self, item):
         return self.scandata[item]
 
-    def connect(self):
+    def connect(self, use_cache=True, services=None):
+        """Connects and sets up the services. The services,
+        characteristics and descriptors of a device connected before
+        come from gatt_cache, unless use_cache is False.
+
+        With services, a list of service uuids, only those are
+        discovered (by uuid) and set up; others are discovered when
+        first used."""
         for attempt in range(10):
             try:
                 self.dev = btle.Peripheral(self.address,
-                                           self.atype)
-                self.services=self._services()
+                                           self.atype,
+                                           self.iface)
+                self.services=self._services(use_cache, services)
                 return self
 
             except btle.BTLEException as e:
@@ -450,6 +759,8 @@ class Device(uuid_registry.UUIDClass):
         raise
 
     def disconnect(self):
+        if getattr(self, '_gatt_changed', False):
+            self._save_gatt_cache() # what was discovered before stopping
         self.dev.disconnect()
     
     def connected(self):
@@ -496,35 +807,266 @@ def discover(onoff=True, block=True):
 
 import time
 
-class ScanPrint(btle.DefaultDelegate):
-    def handleDiscovery(self, dev, isNewDev, isNewData):
-        pass
+# Longest Scanner.process() call, and so the longest an entry waits
+# to be handed out.
+PROCESS_SLICE = 0.1
 
-def discover_devices(scanfunc=None, uuid=None, timeout=6, limitone=False):
+class ScanSession(btle.DefaultDelegate):
+    """A long-lived bluepy scan.
 
-    if scanfunc is None: scanfunc=lambda d:True
+    The controller is started once and keeps scanning until stop() (or
+    the end of a with block). Scan entries reported to handleDiscovery
+    are handed out by entries() or passed to a callback by run(), each
+    time a device is first seen or its advertising data changes.
 
-    scanner = btle.Scanner().withDelegate(ScanPrint())
+    If table (a devtable.DeviceTable) is given, every advertisement is
+    recorded in it, and devices it evicts are also dropped from the
+    bluepy Scanner so that a long scan doesn't grow without bound.
 
-    t0=time.time()
-    
-    scanned=set()
+    Of params (a scan.ScanParameters), bluepy-helper only lets us
+    choose active or passive scanning; it picks the interval, window
+    and duplicate filtering itself.
+
+    With every_report, every advertisement is handed out, not only new
+    or changed ones.
+    """
+
+    def __init__(self, iface=0, table=None, params=scan.SCAN_DEFAULT,
+                 every_report=False):
+        btle.DefaultDelegate.__init__(self)
+        self.iface = iface
+        self.scanner = btle.Scanner(iface).withDelegate(self)
+        self.params = params
+        self.every_report = every_report
+        self.pending = collections.deque()
+        self.scanning = False
+
+        self.table = table
+        self._chained_evict = None
+
+    def _on_evict(self, entry):
+        self.scanner.scanned.pop(entry.address, None)
+        if self._chained_evict is not None:
+            self._chained_evict(entry)
+
+    def handleDiscovery(self, entry, isNewDev, isNewData):
+        if self.table is not None:
+            self.table.update(entry.addr, entry.rssi,
+                              dict(entry.scanData) if isNewData else None)
+        if isNewDev or isNewData or self.every_report:
+            self.pending.append(entry)
+
+    def start(self):
+        if not self.scanning:
+            if self.table is not None:
+                self._chained_evict = self.table.on_evict
+                self.table.on_evict = self._on_evict
+            self.scanner.clear()
+            if self.params.active:
+                self.scanner.start()
+            else:
+                self.scanner.start(passive=True)
+            self.scanning = True
+        return self
 
-    while time.time() < t0+timeout:
+    def stop(self):
+        if self.scanning:
+            self.scanning = False
+            if self.table is not None:
+                self.table.on_evict = self._chained_evict
+            self.scanner.stop()
 
-        # Scanner.scan() has no way to return early
-        # so we will just do a succession of really short scans
+    def entries(self, timeout=None):
+        """Generates bluepy ScanEntry objects until timeout seconds have
+        passed, or forever if timeout is None."""
+        self.start()
+        if timeout is not None:
+            t_end = time.time()+timeout
 
-        for d in scanner.scan(timeout = 0.1):
-            if not d.addr in scanned:
-                scanned.add(d.addr)
+        while 1:
+            while self.pending:
+                yield self.pending.popleft()
+
+            # Short process() calls, so entries go out soon after
+            # they arrive. (process(0) would never return.)
+            if timeout is None:
+                remaining = PROCESS_SLICE
+            else:
+                remaining = t_end-time.time()
+                if remaining <= 0:
+                    return
+            self.scanner.process(min(remaining, PROCESS_SLICE))
+
+    def run(self, callback, timeout=None):
+        """Calls callback(entry) for each entry. Stops at timeout, or
+        when the callback returns False."""
+        for entry in self.entries(timeout):
+            if callback(entry) is False:
+                break
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,exception_type,exception_value,traceback):
+        self.stop()
+        return False
+
+class MultiScanSession(object):
+    """ScanSessions on several adapters at once, one thread each, merged
+    into one stream with the same interface as ScanSession.
+
+    Every advertisement goes through the calling thread, which records
+    it in table (a default sized devtable.DeviceTable if None), and
+    hands out an entry when the advertising data of its address
+    differs from the last one handed out, whichever adapter heard
+    it. entry.iface tells which adapter that was.
+    """
+
+    def __init__(self, ifaces, table=None, params=scan.SCAN_DEFAULT):
+        if table is None:
+            table = devtable.DeviceTable()
+        self.table = table
+        self.sessions = [ScanSession(iface, params=params, every_report=True)
+                         for iface in ifaces]
+        self.queue = Queue.Queue()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def _worker(self, session):
+        try:
+            with session:
+                while not self.stopping.is_set():
+                    for entry in session.entries(0.5):
+                        self.queue.put(entry)
+        except Exception as e:
+            self.queue.put(e)
+
+    def _on_evict(self, entry):
+        for session in self.sessions:
+            session.scanner.scanned.pop(entry.address, None)
+        if self._chained_evict is not None:
+            self._chained_evict(entry)
+
+    def start(self):
+        if not self.threads:
+            self._chained_evict = self.table.on_evict
+            self.table.on_evict = self._on_evict
+            self.stopping.clear()
+            for session in self.sessions:
+                t = threading.Thread(target=self._worker, args=(session,))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+        return self
 
-                device=Device(d)
-                if scanfunc(device):
-                    yield device
+    def stop(self):
+        if self.threads:
+            self.stopping.set()
+            for t in self.threads:
+                t.join()
+            self.threads = []
+            self.table.on_evict = self._chained_evict
+
+    def entries(self, timeout=None):
+        """Generates bluepy ScanEntry objects until timeout seconds have
+        passed, or forever if timeout is None."""
+        self.start()
+        if timeout is not None:
+            t_end = time.time()+timeout
 
-def discover_device(scanfunc=None, uuid=None, timeout=30):
-    for d in discover_devices(scanfunc, uuid, timeout, limitone=True):
+        while 1:
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = t_end-time.time()
+                if remaining <= 0:
+                    return
+            try:
+                entry = self.queue.get(timeout=remaining)
+            except Queue.Empty:
+                return
+            if isinstance(entry, Exception):
+                raise entry
+
+            data = dict(entry.scanData)
+            known = self.table.get(entry.addr)
+            changed = known is None or known.data != data
+            self.table.update(entry.addr, entry.rssi, data)
+            if changed:
+                yield entry
+
+    def run(self, callback, timeout=None):
+        """Calls callback(entry) for each entry. Stops at timeout, or
+        when the callback returns False."""
+        for entry in self.entries(timeout):
+            if callback(entry) is False:
+                break
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,exception_type,exception_value,traceback):
+        self.stop()
+        return False
+
+def scan_session(adapters=None, table=None, params=scan.SCAN_DEFAULT):
+    """Returns a ScanSession for adapters (a list of hci numbers, or
+    'all'), or a MultiScanSession if there is more than one. None
+    means the default adapter."""
+    if adapters == 'all':
+        adapters = scan.adapter_ids()
+    if not adapters:
+        adapters = [0]
+    if len(adapters) == 1:
+        return ScanSession(adapters[0], table=table, params=params)
+    return MultiScanSession(adapters, table=table, params=params)
+
+def discover_devices(scanfunc=None, uuid=None, timeout=6, limitone=False,
+                     rssi=None, name=None, table=None, params=scan.SCAN_DEFAULT,
+                     adapters=None):
+    """Yields devices that pass scanfunc. uuid, rssi (minimum) and name
+    are checked on the raw advertising data first, so devices that
+    fail them cost no Device construction. scanfunc is given a
+    ScanResult.
+
+    Every advertisement heard is recorded in table, a
+    devtable.DeviceTable (a default sized one is used if None).
+    params is a scan.ScanParameters, see ScanSession. adapters is a
+    list of hci numbers to scan on at once, or 'all'."""
+
+    if table is None:
+        table = devtable.DeviceTable()
+
+    if scanfunc is None: scanfunc=lambda d:True
+
+    if uuid is None and rssi is None and name is None:
+        ad_filter = None
+    else:
+        ad_filter = advdata.AdFilter(uuid, rssi, name)
+
+    matched=set()
+
+    with scan_session(adapters, table, params) as session:
+        for entry in session.entries(timeout):
+            if entry.addr in matched:
+                continue
+            if ad_filter is not None and not ad_filter.match_fields(
+                    entry.scanData.iteritems(), entry.rssi):
+                continue
+
+            # Re-check a device whenever its data changes; the scan
+            # response carrying the name often comes after the
+            # advertisement.
+            result=ScanResult(entry)
+            if scanfunc(result):
+                matched.add(entry.addr)
+                yield result.device()
+                if limitone:
+                    return
+
+def discover_device(scanfunc=None, uuid=None, timeout=30, rssi=None, name=None):
+    for d in discover_devices(scanfunc, uuid, timeout, limitone=True,
+                              rssi=rssi, name=name):
         return d
     raise IOError("Couldn't find device")
 
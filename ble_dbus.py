@@ -4,7 +4,12 @@
 
 import uuids
 import uuid_registry
+import adv_registry
+import devtable
+import scan
+import gattfd
 
+import socket
 import dbus
 import dbus.service
 try:
@@ -17,7 +22,7 @@ from dbus.mainloop.glib import DBusGMainLoop,threads_init
 threads_init()
 DBusGMainLoop(set_as_default=True)
 
-import threading,Queue
+import threading,Queue,weakref
 
 mainloop = GObject.MainLoop()
 
@@ -76,6 +81,46 @@ def introspect_characteristics(service_path):
     return filtered_child_names(service_path,
                                 lambda n: n.startswith('char'))
 
+# Characteristics by path, for _characteristic_changed(). One match
+# rule serves them all, rather than one per characteristic.
+_characteristics = weakref.WeakValueDictionary()
+_watch_lock = threading.Lock()
+_watching = []
+
+def _watch_characteristics():
+    with _watch_lock:
+        if _watching:
+            return
+        _watching.append(system_bus.add_signal_receiver(
+            _characteristic_changed,
+            signal_name='PropertiesChanged',
+            dbus_interface='org.freedesktop.DBus.Properties',
+            bus_name='org.bluez',
+            arg0='org.bluez.GattCharacteristic1',
+            path_keyword='path'))
+
+def _characteristic_changed(iface, changed, invalidated, path=None):
+    c = _characteristics.get(str(path))
+    if c is not None:
+        c._properties_changed(changed, invalidated)
+
+def managed_objects(path):
+    """Returns {object path: {interface: properties}} for the objects
+    below path, all from one GetManagedObjects call."""
+    # Subscribe first, so no change after the snapshot is missed.
+    _watch_characteristics()
+    prefix = path+'/'
+    return dict((str(p), ifaces)
+                for p,ifaces in manager.GetManagedObjects().items()
+                if p.startswith(prefix))
+
+def child_objects(objects, iface, parent_prop, parent_path):
+    """The (path, properties) of the objects with iface whose
+    parent_prop names parent_path, in handle order."""
+    return sorted((p, ifaces[iface]) for p,ifaces in objects.items()
+                  if iface in ifaces and
+                  str(ifaces[iface].get(parent_prop)) == parent_path)
+
 class NotSupportedException(Exception): pass
 class NoNotifyException(Exception): pass
 class BleException(Exception): pass
@@ -88,6 +133,55 @@ DISALLOWED='disallowed'
 
 notify_lock=threading.Lock()
 
+def wait_property(path, iface, name, value=True, timeout=10.0):
+    """Blocks until property name of iface on the object at path equals
+    value, woken by PropertiesChanged rather than polling. Raises
+    BleException after timeout seconds (None waits for ever)."""
+    done = threading.Event()
+    def changed(changed_iface, changed, invalidated):
+        if name in changed and changed[name] == value:
+            done.set()
+    # Subscribe before looking, so a change in between is not missed.
+    match = system_bus.add_signal_receiver(
+        changed,
+        signal_name='PropertiesChanged',
+        dbus_interface='org.freedesktop.DBus.Properties',
+        bus_name='org.bluez',
+        path=path,
+        arg0=iface)
+    try:
+        obj = system_bus.get_object("org.bluez", path, introspect=False)
+        if dbus.Interface(obj,"org.freedesktop.DBus.Properties").Get(
+                iface, name) == value:
+            return
+        if timeout is None:
+            while not done.wait(1.0):
+                pass
+        elif not done.wait(timeout):
+            raise BleException("%s: %s not %s after %gs"%(
+                path, name, value, timeout))
+    finally:
+        match.remove()
+
+class Descriptor(object):
+    "A GATT descriptor, from its org.bluez.GattDescriptor1 properties."
+
+    def __init__(self, path, props):
+        self.path=path
+        self.uuid=str(props['UUID'])
+        self.flags=[str(f) for f in props.get('Flags', [])]
+        self.devnode=system_bus.get_object("org.bluez", self.path,
+                                           introspect=False)
+
+    def read(self):
+        return dbus.Interface(self.devnode,"org.bluez.GattDescriptor1").ReadValue()
+
+    def write(self, value):
+        dbus.Interface(self.devnode,"org.bluez.GattDescriptor1").WriteValue(value)
+
+    def __repr__(self):
+        return uuids.uuid_printable(self.uuid)
+
 class Characteristic(uuid_registry.UUIDClass):
     """Represents GATT characteristic.
 
@@ -102,15 +196,41 @@ class Characteristic(uuid_registry.UUIDClass):
 
       - read_type. Set to ble.COMMAND, ble.REQUEST, ble.NOTIFY, ble.INDICATE
 
+    Its GattCharacteristic1 properties are read once and then kept
+    current from PropertiesChanged signals, so self['Notifying'] and
+    the like make no D-Bus call.
+
+    For high rates, acquire_notify() and acquire_write() move
+    notifications and write commands onto sockets from bluez, see
+    gattfd.py; raw then uses those.
     """
 
-    def __init__(self,char_name): 
-        """char_name is a path in dbus, eg /org/bluez/hci0/dev_CB.../service0012/char0013"""
+    def __init__(self,char_name,props=None,objects=None): 
+        """char_name is a path in dbus, eg /org/bluez/hci0/dev_CB.../service0012/char0013
+
+        props are its GattCharacteristic1 properties and objects the
+        managed objects holding its descriptors, as from
+        managed_objects(); both are fetched if None."""
         self.path=char_name
-        self.devnode = system_bus.get_object("org.bluez", self.path)
+        self.devnode = system_bus.get_object("org.bluez", self.path,
+                                             introspect=False)
         self.props = dbus.Interface(self.devnode,"org.freedesktop.DBus.Properties")
         self.methods = dbus.Interface(self.devnode,"org.bluez.GattCharacteristic1")
-        self.uuid = str(self['UUID'])
+        if props is None:
+            _watch_characteristics()
+            props = self.props.GetAll('org.bluez.GattCharacteristic1')
+        self._cached_props = dict(props)
+        _characteristics[self.path] = self
+        self._queue_values = False
+        self.uuid = str(props['UUID'])
+        self._flags = [str(f) for f in props.get('Flags', [])]
+
+        if objects is None:
+            objects = managed_objects(self.path)
+        self.descriptors = [Descriptor(path, desc_props)
+                            for path,desc_props in child_objects(
+                                    objects, 'org.bluez.GattDescriptor1',
+                                    'Characteristic', self.path)]
 
         try:
             self.__class__ = uuid_registry.lookup_uuid(self.uuid)
@@ -135,9 +255,26 @@ class Characteristic(uuid_registry.UUIDClass):
             self._write_procedure=REQUEST
 
         self.notify_event=threading.Event()
+        self._notify_sock=None
+        self._write_sock=None
 
     def __getitem__(self, item):
-        return self.props.Get('org.bluez.GattCharacteristic1',item)
+        try:
+            return self._cached_props[item]
+        except KeyError:
+            # Never seen, or invalidated since.
+            value = self.props.Get('org.bluez.GattCharacteristic1',item)
+            self._cached_props[item] = value
+            return value
+
+    def _properties_changed(self, changed, invalidated):
+        "Called from the main loop with the signal's arguments."
+        self._cached_props.update(changed)
+        for item in invalidated:
+            self._cached_props.pop(item, None)
+        if self._queue_values:
+            self._notify_cb('org.bluez.GattCharacteristic1',
+                            changed, invalidated)
 
     def __repr__(self):
         return uuids.uuid_printable(self.uuid)
@@ -145,8 +282,8 @@ class Characteristic(uuid_registry.UUIDClass):
 
     @property
     def flags(self):
-        return [str(f) 
-                for f in self['Flags']]
+        # Fixed for the life of the object, so taken once at creation.
+        return self._flags
 
     @property
     def readable(self):
@@ -177,6 +314,46 @@ class Characteristic(uuid_registry.UUIDClass):
         except:
             raise BleException
 
+    def acquire_notify(self):
+        """Has bluez deliver notifications on a socket (AcquireNotify)
+        rather than as PropertiesChanged signals, and sets the read
+        procedure to NOTIFY. Returns the gattfd.NotifySocket, whose
+        recv_into() avoids even the copy raw makes."""
+        if not self.notifyable:
+            raise ValueError("notify not allowed")
+        if self._notify_sock is None:
+            fd,mtu = self.methods.AcquireNotify(
+                dbus.Dictionary({}, signature='sv'))
+            self._notify_sock = gattfd.NotifySocket(gattfd.from_fd(fd),
+                                                    int(mtu))
+            self._read_procedure = NOTIFY
+        return self._notify_sock
+
+    def acquire_write(self):
+        """Sends write commands on a socket from bluez (AcquireWrite)
+        rather than by WriteValue, and sets the write procedure to
+        COMMAND. Returns the gattfd.WriteSocket."""
+        if not self.writeable:
+            raise ValueError("write command not allowed")
+        if self._write_sock is None:
+            fd,mtu = self.methods.AcquireWrite(
+                dbus.Dictionary({}, signature='sv'))
+            self._write_sock = gattfd.WriteSocket(gattfd.from_fd(fd),
+                                                  int(mtu))
+            self._write_procedure = COMMAND
+        return self._write_sock
+
+    def release(self):
+        """Closes the sockets from acquire_notify() and acquire_write(),
+        which stops bluez notifying over them."""
+        for sock in (self._notify_sock, self._write_sock):
+            if sock is not None:
+                sock.close()
+        if self._notify_sock is not None:
+            self._notify_sock = None
+            self._read_procedure = REQUEST if self.readable else DISALLOWED
+        self._write_sock = None
+
     @property
     def notify_timeout(self):
         return self._notify_timeout
@@ -228,6 +405,15 @@ class Characteristic(uuid_registry.UUIDClass):
     def raw(self):
         if self._read_procedure in (REQUEST,COMMAND):
             return self.read()
+        elif self._notify_sock is not None:
+            try:
+                value = self._notify_sock.recv(self._notify_timeout)
+            except socket.timeout:
+                raise Queue.Empty
+            with self.value_lock:
+                self._last_raw = value
+                self.notify_counter+=1
+            return value
         elif self._read_procedure in (NOTIFY,INDICATE):
             return self.notify_queue.get(timeout=self._notify_timeout)
         else:
@@ -237,7 +423,9 @@ class Characteristic(uuid_registry.UUIDClass):
     def raw(self,val):
         # no API way to distinguish write command and write request
         # that I can discern.
-        if self._write_procedure in (COMMAND, REQUEST):
+        if self._write_sock is not None and self._write_procedure==COMMAND:
+            return self._write_sock.write(val)
+        elif self._write_procedure in (COMMAND, REQUEST):
             return self.write([ord(c) for c in val])
         else:
             raise IOError("Write not allowed")
@@ -272,7 +460,7 @@ class Characteristic(uuid_registry.UUIDClass):
             return
 
         # Remove the useless d-bus wrapper
-        value = ''.join(chr(d) for d in value)
+        value = str(bytearray(value))
 
         with self.value_lock:
             self.notify_queue.put(value)
@@ -306,8 +494,7 @@ class Characteristic(uuid_registry.UUIDClass):
             
         if value:
             self._val=None
-            self.props.connect_to_signal("PropertiesChanged",
-                                         self._notify_cb)
+            self._queue_values=True
 
             self.notify_event.clear()
             self.methods.StartNotify(
@@ -317,6 +504,7 @@ class Characteristic(uuid_registry.UUIDClass):
             self._read_procedure = NOTIFY
         else:
             self.methods.StopNotify()
+            self._queue_values=False
 
     def notify(self, notify_func):
         self.methods.StartNotify()
@@ -327,13 +515,20 @@ class Characteristic(uuid_registry.UUIDClass):
                                  dbus_interface="org.bluez.GattCharacteristic1")
 
 class Service(uuid_registry.UUIDClass):
-    def __init__(self,service_name): 
-        """service_name is a path in dbus, eg /org/bluez/hci0/dev_CB.../service0012"""
+    def __init__(self,service_name,props=None,objects=None): 
+        """service_name is a path in dbus, eg /org/bluez/hci0/dev_CB.../service0012
+
+        props are its GattService1 properties and objects the managed
+        objects below the device, as from managed_objects(). Without
+        objects, characteristics are fetched when first used."""
         self.path=service_name
-        devnode = system_bus.get_object("org.bluez", self.path)
+        devnode = system_bus.get_object("org.bluez", self.path,
+                                        introspect=False)
         self.props = dbus.Interface(devnode,"org.freedesktop.DBus.Properties")
-        uuid = self.props.Get('org.bluez.GattService1','UUID')
-        self.uuid = str(uuid)
+        if props is None:
+            props = self.props.GetAll('org.bluez.GattService1')
+        self.uuid = str(props['UUID'])
+        self._objects = objects
         self._chars = None # lazy-load characteristics to avoid
                            # unnessary discovery.
 
@@ -354,9 +549,13 @@ class Service(uuid_registry.UUIDClass):
     def characteristics(self):
         if self._chars == None:
             self._chars = []
-            #for char in self.props.Get('org.bluez.GattService1','Characteristics'):
-            for char in introspect_characteristics(self.path):
-                c = Characteristic(char)
+            objects = self._objects
+            if objects is None:
+                objects = managed_objects(self.path)
+            for char,props in child_objects(objects,
+                                            'org.bluez.GattCharacteristic1',
+                                            'Service', self.path):
+                c = Characteristic(char, props, objects)
                 name = uuids.uuid_identifier(c.uuid)
                 setattr(self,name,c)
                 self._chars.append(c)
@@ -367,57 +566,142 @@ class Service(uuid_registry.UUIDClass):
         return uuids.uuid_printable(self.uuid)
         return "Service('%s')"%self.path
 
+class ScanResult(object):
+    """A cheap view of a device seen during discovery, as handed to
+    scan filters. It is built from the properties carried by the
+    discovery signals and makes no D-Bus calls.
+
+    device() (or connect()) turns the result into a full Device.
+    """
+    __slots__ = ('path', 'props')
+
+    def __init__(self, path, props):
+        self.path = path
+        self.props = props
+
+    @property
+    def address(self):
+        return str(self.props['Address'])
+
+    @property
+    def name(self):
+        name = self.props.get('Name')
+        return None if name is None else str(name)
+
+    @property
+    def uuids(self):
+        return [str(uuid) for uuid in self.props.get('UUIDs', [])]
+
+    @property
+    def rssi(self):
+        return self.props.get('RSSI')
+
+    @property
+    def adapter(self):
+        "Name of the adapter that heard the device."
+        return self.path.split('/')[3]
+
+    @property
+    def decoded(self):
+        """The ManufacturerData and ServiceData as interpreted by the
+        decoders in adv_registry."""
+        return adv_registry.decode_props(self.props, self.props.get('Address'))
+
+    def __getitem__(self, item):
+        "Properties not seen (yet) read as None."
+        return self.props.get(item)
+
+    def device(self):
+        return Device(self.path, self.props)
+
+    def connect(self):
+        return self.device().connect()
+
+    def __repr__(self):
+        return "ScanResult('%s')"%self.path
+
 class Device(uuid_registry.UUIDClass):
-    def __init__(self,device_name):
-        """where device_name starts with 'dev_'"""
+    def __init__(self,device_name,props=None,adapter='hci0'):
+        """where device_name starts with 'dev_', or is a full object
+        path. props are Device1 properties already known, such as from
+        discovery."""
         if ":" in device_name:
             # we've got an address
             device_name="_".join(["dev"]+device_name.split(":"))
         
-        self.path="/org/bluez/hci0/%s"%device_name
-
-        self.devnode = system_bus.get_object("org.bluez", self.path)
+        if device_name.startswith('/'):
+            self.path=device_name
+        else:
+            self.path="%s/%s"%(adapter_path(adapter),device_name)
 
-        uuids = self['UUIDs']
+        # Device1 and Properties calls need no introspection data.
+        self.devnode = system_bus.get_object("org.bluez", self.path,
+                                             introspect=False)
         self.iface = dbus.Interface(self.devnode, "org.bluez.Device1")
-        self.uuids = [str(uuid) for uuid in uuids]
-        self.address = self['Address']
+        self._known_props = dict(props or {})
 
-    def _services(self):
-        ret=[]
-        t0=time.time()
-        timed_out=False
-        if 0:
-        # GattServices property does not show until discovery finishes
-            while not timed_out:
-                try:
-                    #service_list = self['GattServices']
-                    break
-                except:
-                    timed_out = time.time() > (t0+10)
+    def _known(self, item):
+        try:
+            return self._known_props[item]
+        except KeyError:
+            value = self._known_props[item] = self[item]
+            return value
 
-            if timed_out:
-                raise
-                
-        else:
-            while not timed_out:
-                try:
-                    if self['ServicesResolved']:
-                        break
-                except:
-                    timed_out = time.time() > (t0+100)
-
-            if timed_out:
-                raise
-
-        for service in introspect_services(self.path):
-            s = Service(service)
-            name = uuids.uuid_identifier(s.uuid)
-            #print "name",name,"=",s
-            if not name.endswith('_service'):
-                name+='_service'
-            setattr(self,name,s)
-            ret.append(s)
+    @property
+    def uuids(self):
+        return [str(uuid) for uuid in self._known('UUIDs')]
+
+    @property
+    def address(self):
+        return str(self._known('Address'))
+
+    def _add_service(self, service):
+        "Sets a Service as an attribute."
+        name = uuids.uuid_identifier(service.uuid)
+        if not name.endswith('_service'):
+            name+='_service'
+        setattr(self,name,service)
+        return service
+
+    def _service_by_uuid(self, uuid):
+        uuid = uuids.canonical_uuid(uuid)
+        objects = managed_objects(self.path)
+        for service,props in child_objects(objects, 'org.bluez.GattService1',
+                                           'Device', self.path):
+            if str(props['UUID']) == uuid:
+                s = Service(service, props, objects)
+                self.services.append(s)
+                return self._add_service(s)
+        return None
+
+    def __getattr__(self, name):
+        """Services left out by connect(services=...) are set up when
+        first used, as in dev.battery_service."""
+        if not name.endswith('_service') or 'services' not in self.__dict__:
+            raise AttributeError(name)
+        uuid = getattr(uuids, name[:-len('_service')], None)
+        if not isinstance(uuid, basestring):
+            uuid = getattr(uuids, name, None)
+        if (not isinstance(uuid, basestring) or
+            self._service_by_uuid(uuid) is None):
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+    def _services(self, services=None, timeout=30.0):
+        ret=[]
+        # The GATT objects are complete once bluez resolves services.
+        wait_property(self.path, 'org.bluez.Device1', 'ServicesResolved',
+                      True, timeout)
+
+        # The whole tree, with every property, in one round trip.
+        objects = managed_objects(self.path)
+        if services is not None:
+            services = set(uuids.canonical_uuid(u) for u in services)
+        for service,props in child_objects(objects, 'org.bluez.GattService1',
+                                           'Device', self.path):
+            if services is not None and str(props['UUID']) not in services:
+                continue
+            ret.append(self._add_service(Service(service, props, objects)))
         return ret
     
     @property
@@ -427,12 +711,18 @@ class Device(uuid_registry.UUIDClass):
     def __getitem__(self, item):
         return self.props.Get('org.bluez.Device1',item)
 
-    def connect(self):
-        self.iface.Connect()
-        while not self.connected():
-            print "waiting"
-            pass
-        self.services=self._services()
+    def connect(self, services=None, timeout=30.0):
+        """Connects and sets up the services. With services, a list of
+        service uuids, only those are set up and others are set up
+        when first used. bluez resolves the whole database either
+        way.
+
+        Raises BleException if the connection or service resolution
+        takes longer than timeout seconds each."""
+        self.iface.Connect(timeout=timeout)
+        wait_property(self.path, 'org.bluez.Device1', 'Connected',
+                      True, timeout)
+        self.services=self._services(services, timeout)
 
         return self
     
@@ -457,18 +747,40 @@ class Device(uuid_registry.UUIDClass):
         return False
 
 
-def power(onoff=True, block=True):
+def adapter_path(name):
+    "'hci0' -> '/org/bluez/hci0'"
+    if name.startswith('/'):
+        return name
+    return '/org/bluez/'+name
+
+def adapter_names():
+    "Returns the names of all the adapters bluez knows, such as 'hci0'."
+    return sorted(str(path).split('/')[-1]
+                  for path,ifaces in manager.GetManagedObjects().items()
+                  if 'org.bluez.Adapter1' in ifaces)
+
+def adapter_interfaces(name='hci0'):
+    "Returns the (Adapter1, Properties) interfaces of an adapter."
+    if name in ('hci0', '/org/bluez/hci0'):
+        return adapter, props
+    obj = system_bus.get_object("org.bluez", adapter_path(name))
+    return (dbus.Interface(obj, 'org.bluez.Adapter1'),
+            dbus.Interface(obj, 'org.freedesktop.DBus.Properties'))
+
+def power(onoff=True, block=True, adapter_name='hci0', timeout=10.0):
+    adapter,props = adapter_interfaces(adapter_name)
     if onoff==props.Get('org.bluez.Adapter1','Powered'):
         return
 
     props.Set('org.bluez.Adapter1','Powered', onoff)
 
     if block:
-        while onoff!=props.Get('org.bluez.Adapter1','Powered'):
-            print "waiting",
+        wait_property(adapter_path(adapter_name), 'org.bluez.Adapter1',
+                      'Powered', onoff, timeout)
     
 
-def discover(onoff=True, block=True):
+def discover(onoff=True, block=True, adapter_name='hci0', timeout=10.0):
+    adapter,props = adapter_interfaces(adapter_name)
     if onoff==props.Get('org.bluez.Adapter1','Discovering'):
         return
 
@@ -478,35 +790,195 @@ def discover(onoff=True, block=True):
         adapter.StopDiscovery()
 
     if block:
-        while onoff!=props.Get('org.bluez.Adapter1','Discovering'):
-            #print "waiting",
-            pass
+        wait_property(adapter_path(adapter_name), 'org.bluez.Adapter1',
+                      'Discovering', onoff, timeout)
 
 import time
 
-def discover_devices(scanfunc=None, uuid=None, timeout=6, limitone=False):
+class DeviceWatcher(object):
+    """Reports org.bluez.Device1 objects under one or more adapters as
+    they appear or change, from ObjectManager and Properties signals.
+
+    get() returns (path, properties) pairs: first the devices bluez
+    already knows about, from a single GetManagedObjects call, then
+    one per InterfacesAdded or PropertiesChanged signal. properties
+    holds only the changed values for the latter.
+    """
+
+    def __init__(self, adapters=('hci0',)):
+        if isinstance(adapters, basestring):
+            adapters = [adapters]
+        self.prefix = tuple(adapter_path(a)+'/' for a in adapters)
+        self.queue = Queue.Queue()
+
+        # Subscribe before asking for the current objects, so nothing
+        # added in between is lost.
+        self._matches = [
+            system_bus.add_signal_receiver(
+                self._interfaces_added,
+                signal_name='InterfacesAdded',
+                dbus_interface='org.freedesktop.DBus.ObjectManager',
+                bus_name='org.bluez'),
+            system_bus.add_signal_receiver(
+                self._properties_changed,
+                signal_name='PropertiesChanged',
+                dbus_interface='org.freedesktop.DBus.Properties',
+                bus_name='org.bluez',
+                arg0='org.bluez.Device1',
+                path_keyword='path'),
+            ]
+
+        for path,ifaces in manager.GetManagedObjects().items():
+            self._interfaces_added(path, ifaces)
+
+    def _interfaces_added(self, path, ifaces):
+        if path.startswith(self.prefix) and 'org.bluez.Device1' in ifaces:
+            self.queue.put((str(path), ifaces['org.bluez.Device1']))
+
+    def _properties_changed(self, iface, changed, invalidated, path=None):
+        if path.startswith(self.prefix):
+            self.queue.put((str(path), changed))
+
+    def get(self, timeout=None):
+        "Raises Queue.Empty if nothing happens within timeout seconds."
+        return self.queue.get(timeout=timeout)
+
+    def close(self):
+        for match in self._matches:
+            match.remove()
+        self._matches = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exception_type,exception_value,traceback):
+        self.close()
+        return False
 
+def discovery_filter(uuid=None, rssi=None, transport='le',
+                     params=scan.SCAN_DEFAULT):
+    """Builds the argument for Adapter1.SetDiscoveryFilter, so that
+    bluetoothd drops non-matching devices itself.
+
+    Of params (a scan.ScanParameters), only filter_dup applies, as
+    DuplicateData; bluetoothd always scans actively and picks its own
+    interval and window."""
+    ret = {'Transport': transport}
+    if not params.filter_dup:
+        ret['DuplicateData'] = dbus.Boolean(True)
+    if uuid is not None:
+        if isinstance(uuid, basestring):
+            uuid = [uuid]
+        ret['UUIDs'] = dbus.Array(uuid, signature='s')
+    if rssi is not None:
+        ret['RSSI'] = dbus.Int16(rssi)
+    return dbus.Dictionary(ret, signature='sv')
+
+def discover_devices(scanfunc=None, uuid=None, timeout=6, limitone=False,
+                     rssi=None, name=None, table=None, params=scan.SCAN_DEFAULT,
+                     adapters=None):
+    """Yields devices that pass scanfunc. uuid and rssi (minimum) are
+    handed to bluetoothd as a discovery filter, and checked again
+    together with name on the properties from the signals, so devices
+    that fail them cost no Device construction. scanfunc is given a
+    ScanResult. A device with no RSSI yet fails rssi; with rssi or
+    scanfunc given, a device is checked again as its RSSI changes.
+
+    Every device heard is recorded in table, a devtable.DeviceTable
+    keyed by object path (a default sized one is used if None), with
+    its accumulated properties in the entries' props. params is a
+    scan.ScanParameters, see discovery_filter().
+
+    adapters is a list of adapter names to discover on at once, or
+    'all'. A device heard by several of them is yielded once, from
+    whichever adapter matched first."""
+
+    recheck_rssi = rssi is not None or scanfunc is not None
     if scanfunc is None: scanfunc=lambda d:True
 
-    power()
-    discover()
+    if table is None:
+        table = devtable.DeviceTable()
+
+    if adapters == 'all':
+        adapters = adapter_names()
+    elif not adapters:
+        adapters = ['hci0']
+
+    if isinstance(uuid, basestring):
+        uuid = [uuid]
+
+    for a in adapters:
+        power(adapter_name=a)
     t0=time.time()
-    ret=set()
-    devnames = set()
-
-    while timeout is None or time.time() < t0+timeout:
-        for devname in introspect_devices():
-            if not devname in devnames:
-                devnames.add(devname)
-                device = Device(devname)
-                if uuid is None or uuid in device.uuids:
-                    if scanfunc(device):
-                        yield device
-                        if limitone:
-                            break
-
-def discover_device(scanfunc=None, uuid=None, timeout=6):
-    for d in discover_devices(scanfunc, uuid, timeout, limitone=True):
+    matched=set() # addresses, so each device is yielded once
+
+    chained = table.on_evict
+    def on_evict(entry):
+        matched.discard((entry.props or {}).get('Address'))
+        if chained is not None:
+            chained(entry)
+    table.on_evict = on_evict
+
+    with DeviceWatcher(adapters) as watcher:
+        for a in adapters:
+            adapter_interfaces(a)[0].SetDiscoveryFilter(
+                discovery_filter(uuid, rssi, params=params))
+        try:
+            for a in adapters:
+                discover(adapter_name=a)
+
+            while 1:
+                if timeout is None:
+                    remaining = None
+                else:
+                    remaining = t0+timeout-time.time()
+                    if remaining <= 0:
+                        return
+                try:
+                    path,changed = watcher.get(remaining)
+                except Queue.Empty:
+                    return
+
+                entry = table.update(path, changed.get('RSSI'))
+                if entry.props is None:
+                    entry.props = {}
+                props = entry.props
+                props.update(changed)
+                if 'ManufacturerData' in changed or 'ServiceData' in changed:
+                    entry.invalidate()
+                if props.get('Address') in matched:
+                    continue
+
+                # Check a device again when its data changes, as the
+                # name and uuids may show up after the first
+                # advertisement. An RSSI update alone only matters to
+                # the rssi filter and scanfunc.
+                if not recheck_rssi and not set(changed) - set(['RSSI']):
+                    continue
+                if (uuid is not None and
+                    not set(uuid) & set(props.get('UUIDs', []))):
+                    continue
+                if name is not None and props.get('Name') != name:
+                    continue
+                if rssi is not None and (props.get('RSSI') is None or
+                                         props['RSSI'] < rssi):
+                    continue
+
+                result = ScanResult(path, props)
+                if scanfunc(result):
+                    matched.add(props.get('Address'))
+                    yield result.device()
+                    if limitone:
+                        return
+        finally:
+            table.on_evict = chained
+            for a in adapters:
+                adapter_interfaces(a)[0].SetDiscoveryFilter(
+                    dbus.Dictionary({}, signature='sv'))
+
+def discover_device(scanfunc=None, uuid=None, timeout=6, rssi=None, name=None):
+    for d in discover_devices(scanfunc, uuid, timeout, limitone=True,
+                              rssi=rssi, name=name):
         return d
 
 def done():
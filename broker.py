@@ -0,0 +1,393 @@
+#!/usr/bin/python2
+
+"""A scan broker: one process owns the adapters and hands advertising
+reports to any number of local clients over a Unix socket.
+
+Clients connect to the broker's SOCK_SEQPACKET socket and send a
+subscription (service uuids, addresses, minimum RSSI); the broker
+forwards only the reports that match it, one report per packet. A
+client that falls behind loses reports (counted in its dropped)
+rather than stalling the others.
+
+Frames (little-endian):
+
+  subscribe, client to broker:
+    u8 MSG_SUBSCRIBE, s8 min rssi (RSSI_ANY for none),
+    u8 uuid count, u8 address count,
+    16 bytes per uuid, 6 bytes per address (as in HCI, LSB first)
+
+  report, broker to client:
+    u8 MSG_REPORT, f64 timestamp, u16 event type, u8 address type,
+    6 bytes address, s8 rssi (RSSI_NONE if unknown),
+    u8 adapter name length, adapter name, advertising data
+
+Run the broker with
+
+  broker.py [-s socket] [all | dev_id...]
+  broker.py [-s socket] -r capture [-c clients]
+
+where -r replays a capture file (see capture.py) in place of the
+radio, after -c clients have subscribed. broker.py -l [-u uuid]
+[-a address] [-m rssi] connects as a client and prints reports.
+"""
+
+import os
+import sys
+import time
+import uuid
+import errno
+import socket
+import select
+import struct
+import threading
+import binascii
+
+import advdata
+import scan
+from uuids import canonical_uuid
+
+BROKER_PATH = '/tmp/ble-scan-broker'
+
+MSG_SUBSCRIBE = 1
+MSG_REPORT = 2
+
+RSSI_ANY = -128 # subscription without an rssi limit
+RSSI_NONE = 127 # report without rssi, as in HCI
+
+MAX_FRAME = 4096
+CLIENT_SNDBUF = 1<<20 # bytes queued for a client before dropping
+
+_subscribe_header = struct.Struct('<BbBB')
+_report_header = struct.Struct('<BdHB6sbB')
+
+class BrokerError(Exception): pass
+
+def address_bytes(address):
+    "'aa:bb:cc:dd:ee:ff' -> the 6 bytes, LSB first"
+    return binascii.unhexlify(address.replace(':',''))[::-1]
+
+def encode_report(report, timestamp=None):
+    if timestamp is None:
+        timestamp = time.time()
+    adapter = report.get('adapter') or ''
+    rssi = report['rssi']
+    return ''.join((_report_header.pack(MSG_REPORT, timestamp,
+                                        report['evt_type'],
+                                        report['bdaddr_type'],
+                                        address_bytes(report['bdaddr']),
+                                        RSSI_NONE if rssi is None else rssi,
+                                        len(adapter)),
+                    adapter, report['data']))
+
+def decode_report(frame):
+    """Returns a report dict like scan.decode_reports() makes, plus
+    timestamp."""
+    (msg,timestamp,evt_type,bdaddr_type,bdaddr,rssi,
+     adapter_len) = _report_header.unpack_from(frame)
+    if msg != MSG_REPORT:
+        raise BrokerError("unexpected message %d"%msg)
+    pos = _report_header.size
+    return {'timestamp':timestamp,
+            'evt_type':evt_type,
+            'bdaddr_type':bdaddr_type,
+            'bdaddr':scan.ba2str(bdaddr),
+            'rssi':None if rssi == RSSI_NONE else rssi,
+            'adapter':frame[pos:pos+adapter_len],
+            'data':frame[pos+adapter_len:]}
+
+class Subscription(object):
+    """Which reports a client wants: ones advertising one of uuids, from
+    one of addresses, heard at rssi or better. None matches all."""
+
+    def __init__(self, uuids=None, addresses=None, rssi=None):
+        if isinstance(uuids, basestring):
+            uuids = [uuids]
+        if isinstance(addresses, basestring):
+            addresses = [addresses]
+        # Short forms such as '180d' are put on the base uuid, for
+        # both the filter and encode().
+        self.uuids = (None if uuids is None else
+                      [canonical_uuid(u if isinstance(u, int) else str(u)).lower()
+                       for u in uuids])
+        self.addresses = (None if addresses is None else
+                          set(a.lower() for a in addresses))
+        self.rssi = rssi
+        self.ad_filter = advdata.AdFilter(uuids=self.uuids, rssi=rssi)
+
+    def match(self, report):
+        if self.addresses is not None and report['bdaddr'] not in self.addresses:
+            return False
+        return self.ad_filter.match(report['data'], rssi=report['rssi'])
+
+    def encode(self):
+        uuids = self.uuids or []
+        addresses = sorted(self.addresses or [])
+        if len(uuids) > 255 or len(addresses) > 255:
+            raise ValueError("at most 255 uuids and 255 addresses")
+        return ''.join([_subscribe_header.pack(MSG_SUBSCRIBE,
+                                               RSSI_ANY if self.rssi is None
+                                               else self.rssi,
+                                               len(uuids), len(addresses))]+
+                       [uuid.UUID(u).bytes for u in uuids]+
+                       [address_bytes(a) for a in addresses])
+
+    @classmethod
+    def decode(cls, frame):
+        msg,rssi,n_uuids,n_addresses = _subscribe_header.unpack_from(frame)
+        if msg != MSG_SUBSCRIBE:
+            raise BrokerError("unexpected message %d"%msg)
+        pos = _subscribe_header.size
+        if len(frame) != pos+16*n_uuids+6*n_addresses:
+            raise BrokerError("bad subscription length")
+
+        uuids = []
+        for _ in range(n_uuids):
+            uuids.append(str(uuid.UUID(bytes=frame[pos:pos+16])))
+            pos += 16
+        addresses = []
+        for _ in range(n_addresses):
+            addresses.append(scan.ba2str(frame[pos:pos+6]))
+            pos += 6
+        return cls(uuids or None, addresses or None,
+                   None if rssi == RSSI_ANY else rssi)
+
+class _Client(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.subscription = None # nothing is sent before the first one
+        self.sent = 0
+        self.dropped = 0
+
+class ScanBroker(object):
+    """Listens on path and forwards the reports of an HciScanner to
+    subscribed clients. A thread accepts clients and reads their
+    subscriptions; run() publishes."""
+
+    def __init__(self, path=BROKER_PATH):
+        self.path = path
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.published = 0
+        self._stopping = threading.Event()
+        self._subscribed = threading.Condition(self.lock)
+
+        self._remove_stale(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.listener.bind(path)
+        self.listener.listen(16)
+
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def _remove_stale(path):
+        """Unlinks path if it is the socket of a broker that is gone.
+        Raises BrokerError if a broker still listens on it."""
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            probe.connect(path)
+        except socket.error as err:
+            if err.errno == errno.ENOENT:
+                return
+            if err.errno != errno.ECONNREFUSED:
+                raise
+        else:
+            raise BrokerError("a broker is listening on %s"%path)
+        finally:
+            probe.close()
+
+        try:
+            os.unlink(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def _drop_client(self, client):
+        with self.lock:
+            self.clients.pop(client.sock.fileno(), None)
+        client.sock.close()
+
+    def _serve(self):
+        while not self._stopping.is_set():
+            with self.lock:
+                socks = [c.sock for c in self.clients.values()]
+            try:
+                readable,_,_ = select.select([self.listener]+socks, [], [], 0.5)
+            except select.error as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for sock in readable:
+                if sock is self.listener:
+                    conn,_ = self.listener.accept()
+                    conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                    CLIENT_SNDBUF)
+                    with self.lock:
+                        self.clients[conn.fileno()] = _Client(conn)
+                    continue
+
+                with self.lock:
+                    client = self.clients.get(sock.fileno())
+                if client is None:
+                    continue
+                try:
+                    frame = sock.recv(MAX_FRAME)
+                except socket.error:
+                    frame = ''
+                if not frame:
+                    self._drop_client(client)
+                    continue
+                try:
+                    subscription = Subscription.decode(frame)
+                except (BrokerError, ValueError, struct.error):
+                    self._drop_client(client) # speaking something else
+                    continue
+                with self.lock:
+                    client.subscription = subscription
+                    self._subscribed.notify_all()
+
+    def subscribed(self):
+        "Number of clients with a subscription."
+        with self.lock:
+            return sum(1 for c in self.clients.values()
+                       if c.subscription is not None)
+
+    def wait_clients(self, n, timeout=None):
+        """Waits until n clients have subscribed. Returns whether they
+        did before timeout."""
+        if timeout is not None:
+            t_end = time.time()+timeout
+        with self.lock:
+            while sum(1 for c in self.clients.values()
+                      if c.subscription is not None) < n:
+                if timeout is None:
+                    self._subscribed.wait(1.0)
+                else:
+                    remaining = t_end-time.time()
+                    if remaining <= 0:
+                        return False
+                    self._subscribed.wait(remaining)
+        return True
+
+    def publish(self, report, timestamp=None):
+        "Sends report to every client whose subscription matches it."
+        frame = None
+        with self.lock:
+            clients = self.clients.values()
+        for client in clients:
+            subscription = client.subscription
+            if subscription is None or not subscription.match(report):
+                continue
+            if frame is None:
+                frame = encode_report(report, timestamp)
+            try:
+                client.sock.send(frame, socket.MSG_DONTWAIT)
+                client.sent += 1
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    client.dropped += 1
+                else:
+                    # Gone; the serving thread sees end of file and
+                    # drops it.
+                    client.subscription = None
+        self.published += 1
+
+    def run(self, scanner):
+        """Publishes the reports of scanner until it runs out of sources
+        (end of a replayed capture) or close() is called."""
+        while scanner.sources and not self._stopping.is_set():
+            now = time.time()
+            for report in scanner.poll(0.5):
+                self.publish(report, now)
+
+    def close(self):
+        self._stopping.set()
+        self._thread.join()
+        with self.lock:
+            clients = self.clients.values()
+            self.clients = {}
+        for client in clients:
+            client.sock.close()
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exception_type,exception_value,traceback):
+        self.close()
+        return False
+
+class BrokerClient(object):
+    "A connection to a ScanBroker, receiving reports that match."
+
+    def __init__(self, path=BROKER_PATH, uuids=None, addresses=None,
+                 rssi=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.connect(path)
+        self.subscribe(uuids, addresses, rssi)
+
+    def subscribe(self, uuids=None, addresses=None, rssi=None):
+        "Replaces the subscription."
+        self.sock.send(Subscription(uuids, addresses, rssi).encode())
+
+    def reports(self, timeout=None):
+        """Generates report dicts (see decode_report()) until timeout
+        seconds have passed without one, or the broker goes away."""
+        self.sock.settimeout(timeout)
+        while 1:
+            try:
+                frame = self.sock.recv(MAX_FRAME)
+            except socket.timeout:
+                return
+            if not frame:
+                return
+            yield decode_report(frame)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exception_type,exception_value,traceback):
+        self.close()
+        return False
+
+if __name__=="__main__":
+    import getopt
+    opts,args = getopt.getopt(sys.argv[1:], 's:r:c:lu:a:m:')
+    opts_d = dict(opts)
+    path = opts_d.get('-s', BROKER_PATH)
+
+    if '-l' in opts_d:
+        uuids = [v for o,v in opts if o == '-u'] or None
+        addresses = [v for o,v in opts if o == '-a'] or None
+        rssi = int(opts_d['-m']) if '-m' in opts_d else None
+        with BrokerClient(path, uuids, addresses, rssi) as client:
+            for report in client.reports():
+                print report['adapter'], report['bdaddr'], scan.eir_parse_name(report['data']), report['rssi']
+        sys.exit(0)
+
+    broker = ScanBroker(path)
+    try:
+        if '-r' in opts_d:
+            import capture
+            broker.wait_clients(int(opts_d.get('-c', 0)))
+            s = scan.HciScanner([capture.ReplaySource(opts_d['-r'])])
+        elif args == ['all']:
+            s = scan.scanner('all')
+        else:
+            s = scan.scanner([int(d) for d in args] or (None,))
+        try:
+            broker.run(s)
+        finally:
+            s.close()
+    finally:
+        broker.close()
+        print "published %d reports"%broker.published
@@ -0,0 +1,281 @@
+#!/usr/bin/python2
+
+"""Capture and replay of raw HCI events.
+
+BtsnoopWriter and PcapWriter log events from the scan socket with
+timestamps, in btsnoop (as read by Wireshark and btmon) or pcap
+(LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR) format. Pass one as the
+capture of an HciScanner.
+
+open_capture() reads either format back, and ReplaySource plays a
+capture into an HciScanner as if it came from an adapter, at the
+original rate or as fast as possible, so the scan pipeline can be run
+and measured without a radio.
+"""
+
+import time
+import errno
+import socket
+import struct
+import threading
+
+import scan
+
+BTSNOOP_MAGIC = 'btsnoop\0'
+BTSNOOP_VERSION = 1
+BTSNOOP_HCI_H4 = 1002
+# btsnoop timestamps are microseconds since midnight, January 1st, 0 AD
+BTSNOOP_EPOCH_DELTA = 0x00dcddb30f2f8000
+BTSNOOP_FLAG_RECEIVED = 0x01
+BTSNOOP_FLAG_COMMAND_EVENT = 0x02
+
+HCI_COMMAND_PKT = 0x01
+
+_u8 = struct.Struct('B')
+_btsnoop_header = struct.Struct('>8sII')
+_btsnoop_record = struct.Struct('>IIIIq') # original length, included
+                                          # length, flags, drops,
+                                          # timestamp
+
+PCAP_MAGIC = 0xa1b2c3d4
+LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR = 201
+
+_pcap_header = struct.Struct('<IHHiIII')
+_pcap_record = struct.Struct('<IIII') # seconds, microseconds, included
+                                      # length, original length
+_pcap_phdr = struct.Struct('>I') # direction, 1 for received
+
+class CaptureError(ValueError): pass
+
+class _Writer(object):
+    def __init__(self, f, buffering=1<<16):
+        if isinstance(f, basestring):
+            f = open(f, 'wb', buffering)
+        self.f = f
+        self.count = 0
+        self._write_header()
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exception_type,exception_value,traceback):
+        self.close()
+        return False
+
+class BtsnoopWriter(_Writer):
+    """Writes HCI packets (starting with the H4 packet type byte, as
+    read from an HCI socket) to a btsnoop file. f is a path or a file
+    opened for binary writing."""
+
+    def _write_header(self):
+        self.f.write(_btsnoop_header.pack(BTSNOOP_MAGIC, BTSNOOP_VERSION,
+                                          BTSNOOP_HCI_H4))
+
+    def write(self, buf, length=None, timestamp=None, received=True):
+        """Logs buf[:length], received (or sent) at timestamp (a
+        time.time() value, now if None)."""
+        if length is None:
+            length = len(buf)
+        if timestamp is None:
+            timestamp = time.time()
+
+        flags = BTSNOOP_FLAG_RECEIVED if received else 0
+        if length and _u8.unpack_from(buf)[0] in (HCI_COMMAND_PKT,
+                                                  scan.HCI_EVENT_PKT):
+            flags |= BTSNOOP_FLAG_COMMAND_EVENT
+
+        usec = int(round(timestamp*1e6))+BTSNOOP_EPOCH_DELTA
+        self.f.write(_btsnoop_record.pack(length, length, flags, 0, usec))
+        self.f.write(memoryview(buf)[:length].tobytes())
+        self.count += 1
+
+class PcapWriter(_Writer):
+    """Writes HCI packets to a pcap file, with the direction header of
+    LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR. Same interface as
+    BtsnoopWriter."""
+
+    def _write_header(self):
+        self.f.write(_pcap_header.pack(PCAP_MAGIC, 2, 4, 0, 0, 0xffff,
+                                       LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR))
+
+    def write(self, buf, length=None, timestamp=None, received=True):
+        if length is None:
+            length = len(buf)
+        if timestamp is None:
+            timestamp = time.time()
+
+        sec = int(timestamp)
+        usec = int(round((timestamp-sec)*1e6))
+        if usec >= 1000000:
+            sec,usec = sec+1,usec-1000000
+        size = _pcap_phdr.size+length
+        self.f.write(_pcap_record.pack(sec, usec, size, size))
+        self.f.write(_pcap_phdr.pack(1 if received else 0))
+        self.f.write(memoryview(buf)[:length].tobytes())
+        self.count += 1
+
+def writer(path):
+    "Returns a PcapWriter for *.pcap paths, else a BtsnoopWriter."
+    if path.endswith('.pcap'):
+        return PcapWriter(path)
+    return BtsnoopWriter(path)
+
+def _read_exactly(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        if data:
+            raise CaptureError("truncated capture")
+        return None
+    return data
+
+def read_btsnoop(f):
+    """Yields (timestamp, packet, received) for each record of the
+    btsnoop file f, after its header."""
+    while 1:
+        rec = _read_exactly(f, _btsnoop_record.size)
+        if rec is None:
+            return
+        _,included,flags,_,usec = _btsnoop_record.unpack(rec)
+        data = _read_exactly(f, included)
+        if data is None:
+            raise CaptureError("truncated capture")
+        yield ((usec-BTSNOOP_EPOCH_DELTA)/1e6, data,
+               bool(flags & BTSNOOP_FLAG_RECEIVED))
+
+def read_pcap(f, endian):
+    """Yields (timestamp, packet, received) for each record of the pcap
+    file f, after its header."""
+    record = struct.Struct(endian+'IIII')
+    while 1:
+        rec = _read_exactly(f, record.size)
+        if rec is None:
+            return
+        sec,usec,included,_ = record.unpack(rec)
+        data = _read_exactly(f, included)
+        if data is None or included < _pcap_phdr.size:
+            raise CaptureError("truncated capture")
+        received = _pcap_phdr.unpack_from(data)[0] & 1
+        yield sec+usec/1e6, data[_pcap_phdr.size:], bool(received)
+
+def _records(f, path):
+    "Reads the header of f and returns the reader for the rest."
+    head = f.read(8)
+    if head == BTSNOOP_MAGIC:
+        _,version,datalink = _btsnoop_header.unpack(head+f.read(8))
+        if datalink != BTSNOOP_HCI_H4:
+            raise CaptureError("unsupported btsnoop datalink %d"%datalink)
+        return read_btsnoop(f)
+
+    for endian in '<>':
+        if struct.unpack(endian+'I', head[:4])[0] == PCAP_MAGIC:
+            rest = f.read(_pcap_header.size-8)
+            network = struct.unpack(endian+'I', rest[-4:])[0]
+            if network != LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR:
+                raise CaptureError("unsupported pcap link type %d"%network)
+            return read_pcap(f, endian)
+
+    raise CaptureError("%s is not a btsnoop or pcap file"%path)
+
+def _closing(f, records):
+    "Yields records, closing f once they run out or are dropped."
+    try:
+        for record in records:
+            yield record
+    finally:
+        f.close()
+
+def open_capture(path):
+    """Opens a btsnoop or pcap capture, telling them apart by their
+    magic. Returns an iterator of (timestamp, packet, received); the
+    file is closed when it is exhausted or dropped."""
+    f = open(path, 'rb')
+    try:
+        records = _records(f, path)
+    except:
+        f.close()
+        raise
+    return _closing(f, records)
+
+class ReplaySource(object):
+    """Plays captured events into an HciScanner, in place of an
+    HciScanSource.
+
+    A thread writes the received events of the capture to one end of
+    a socketpair, sleeping to keep the original timing scaled by
+    speed, or not at all if speed is None. The scanner reads the other
+    end, so replayed events take the same path as live ones. At the
+    end of the capture the source reports end of file and the scanner
+    drops it.
+    """
+
+    def __init__(self, capture, speed=1.0, name='replay'):
+        if isinstance(capture, basestring):
+            capture = open_capture(capture)
+        self.capture = capture
+        self.speed = speed
+        self.name = name
+
+        self.sock,self._feed = socket.socketpair(socket.AF_UNIX,
+                                                 socket.SOCK_SEQPACKET)
+        self.sock.setblocking(False)
+        self.buf = bytearray(scan.HCI_MAX_EVENT_SIZE)
+        self.reassembler = scan.ExtendedReassembler()
+        self.eof = False
+        self.sent = 0
+        self._stopping = threading.Event()
+
+        self._thread = threading.Thread(target=self._play)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _play(self):
+        t_start = None
+        try:
+            for timestamp,data,received in self.capture:
+                if not received:
+                    continue
+                if self.speed:
+                    if t_start is None:
+                        t_start = time.time()
+                        ts_start = timestamp
+                    delay = t_start+(timestamp-ts_start)/self.speed-time.time()
+                    if delay > 0 and self._stopping.wait(delay):
+                        break
+                if self._stopping.is_set():
+                    break
+                self._feed.send(data)
+                self.sent += 1
+        except socket.error:
+            pass # closed under us
+        finally:
+            self._feed.close()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_events(self):
+        """Same as HciScanSource.read_events(); sets eof at the end of
+        the capture."""
+        buf = self.buf
+        while 1:
+            try:
+                n = self.sock.recv_into(buf)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN,errno.EWOULDBLOCK,errno.EINTR):
+                    return
+                raise
+            if n == 0:
+                self.eof = True
+                return
+            yield buf,n
+
+    def close(self):
+        self._stopping.set()
+        self.sock.close()
+        self._thread.join()
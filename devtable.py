@@ -0,0 +1,207 @@
+#!/usr/bin/python2
+
+"""A bounded table of advertising devices, keyed by address.
+
+Each entry keeps first/last seen times, an advertisement count, the
+last and a smoothed RSSI, and the latest advertising data. The table
+holds at most `capacity` devices, evicting the least recently heard,
+and drops devices not heard for `max_age` seconds when expire() is
+called (update() calls it now and then).
+"""
+
+import time
+import collections
+
+import advdata
+import adv_registry
+import scan
+
+class DeviceEntry(object):
+    """One device in a DeviceTable.
+
+    data and scan_response are the latest advertising data, either
+    raw AD bytes or a dict of {ad_type: value} as kept by bluepy.
+    props holds the Device1 properties on the dbus backend.
+    """
+    __slots__ = ('address', 'first_seen', 'last_seen', 'count',
+                 'rssi', 'rssi_avg', 'data', 'scan_response', 'props',
+                 '_advdata', '_decoded')
+
+    def __init__(self, address, now):
+        self.address = address
+        self.first_seen = now
+        self.last_seen = now
+        self.count = 0
+        self.rssi = None
+        self.rssi_avg = None
+        self.data = None
+        self.scan_response = None
+        self.props = None
+        self._advdata = None
+        self._decoded = None
+
+    @property
+    def advdata(self):
+        """The latest advertising data and scan response, decoded by
+        advdata.decode()."""
+        if self._advdata is None:
+            ret = {}
+            for data in (self.data, self.scan_response):
+                if isinstance(data, dict):
+                    ret.update(advdata.decode_fields(data.iteritems()))
+                elif data is not None:
+                    ret.update(advdata.decode(data))
+            self._advdata = ret
+        return self._advdata
+
+    @property
+    def decoded(self):
+        """The manufacturer and service data as interpreted by the
+        decoders in adv_registry."""
+        if self._decoded is None:
+            if self.props is not None:
+                self._decoded = adv_registry.decode_props(self.props,
+                                                          self.address)
+            else:
+                self._decoded = adv_registry.decode(self.advdata,
+                                                    self.address)
+        return self._decoded
+
+    def invalidate(self):
+        """Drops advdata and decoded, to be worked out again after the
+        data or props changed."""
+        self._advdata = self._decoded = None
+
+    def __repr__(self):
+        return "DeviceEntry('%s', rssi=%s, count=%d)"%(self.address,
+                                                        self.rssi_avg,
+                                                        self.count)
+
+class DeviceTable(object):
+    """Devices heard while scanning, least recently heard first.
+
+    rssi_alpha is the weight of each new RSSI sample in the smoothed
+    value. on_evict, if given, is called with each entry that is
+    dropped for capacity or age.
+    """
+
+    def __init__(self, capacity=4096, max_age=None, rssi_alpha=0.25,
+                 on_evict=None):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.rssi_alpha = rssi_alpha
+        self.on_evict = on_evict
+        self.entries = collections.OrderedDict()
+        self.evicted = 0
+        self._next_expire = 0
+
+    def update(self, address, rssi=None, data=None, scan_response=False,
+               now=None):
+        """Records one advertisement (or scan response) from address.
+        data replaces the latest advertising data if given. Returns the
+        entry."""
+        if now is None:
+            now = time.time()
+
+        entries = self.entries
+        entry = entries.pop(address, None)
+        if entry is None:
+            entry = DeviceEntry(address, now)
+            if len(entries) >= self.capacity:
+                self._evict(entries.popitem(last=False)[1])
+        entries[address] = entry
+
+        entry.last_seen = now
+        entry.count += 1
+        if rssi is not None:
+            entry.rssi = rssi
+            if entry.rssi_avg is None:
+                entry.rssi_avg = float(rssi)
+            else:
+                entry.rssi_avg += self.rssi_alpha*(rssi-entry.rssi_avg)
+
+        if data is not None:
+            if scan_response:
+                if data != entry.scan_response:
+                    entry.scan_response = data
+                    entry.invalidate()
+            elif data != entry.data:
+                entry.data = data
+                entry.invalidate()
+
+        if self.max_age is not None and now >= self._next_expire:
+            self.expire(now)
+
+        return entry
+
+    def add_report(self, report, now=None):
+        "Records a report dict from scan.decode_reports()."
+        if report.get('extended'):
+            scan_response = bool(report['evt_type'] & scan.EXT_SCAN_RESPONSE)
+        else:
+            scan_response = report['evt_type'] == scan.SCAN_RSP
+        return self.update(report['bdaddr'], report['rssi'], report['data'],
+                           scan_response, now)
+
+    def _evict(self, entry):
+        self.evicted += 1
+        if self.on_evict is not None:
+            self.on_evict(entry)
+
+    def expire(self, now=None):
+        "Drops devices not heard for max_age seconds."
+        if self.max_age is None:
+            return
+        if now is None:
+            now = time.time()
+        cutoff = now-self.max_age
+        entries = self.entries
+
+        # Oldest first, so stop at the first one that is recent enough.
+        for address,entry in entries.items():
+            if entry.last_seen >= cutoff:
+                break
+            del entries[address]
+            self._evict(entry)
+
+        self._next_expire = now+self.max_age/8.
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, address):
+        return address in self.entries
+
+    def __getitem__(self, address):
+        return self.entries[address]
+
+    def get(self, address, default=None):
+        return self.entries.get(address, default)
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def query(self, min_rssi=None, seen_within=None, uuid=None,
+              predicate=None, now=None):
+        """Returns entries, most recently heard first, whose smoothed
+        RSSI is at least min_rssi, heard within the last seen_within
+        seconds, advertising uuid, and passing predicate(entry)."""
+        if seen_within is not None:
+            if now is None:
+                now = time.time()
+            cutoff = now-seen_within
+
+        ret = []
+        for entry in reversed(self.entries.values()):
+            if seen_within is not None and entry.last_seen < cutoff:
+                break
+            if min_rssi is not None and (entry.rssi_avg is None or
+                                         entry.rssi_avg < min_rssi):
+                continue
+            if uuid is not None and uuid not in entry.advdata.get('uuids', ()):
+                continue
+            if predicate is not None and not predicate(entry):
+                continue
+            ret.append(entry)
+        return ret
+
@@ -0,0 +1,188 @@
+#!/usr/bin/python2
+
+"""Adaptive scan duty cycling.
+
+AdaptiveScanner sits between an HciScanner and its user. It steps the
+scan window and interval of its sources down a ladder of levels while
+nothing new is heard, and jumps back to the top as soon as new devices
+or changed advertising data show up, or the report rate climbs. The
+radio is then only fully on while the surroundings are changing.
+
+metrics() gives the current level and duty cycle, the average duty
+cycle so far (radio-on time) and the capture ratio: the fraction of
+devices known to be present that were heard in the last check.
+"""
+
+import time
+
+import devtable
+import scan
+
+# Scan window, interval for each level, in 0.625 ms units, from
+# listening all the time down to under 1%.
+LEVELS = ((0x0040, 0x0040), # 100%
+          (0x0030, 0x0100), # 19%
+          (0x0012, 0x0200), # 3.5%
+          (0x0012, 0x0800)) # 0.9%
+
+def ladder(base=scan.SCAN_DEFAULT, windows=LEVELS):
+    """ScanParameters like base for each (window, interval) in windows.
+    Duplicate filtering is turned off: the report rate and presence
+    are measured from every advertisement, not one per device."""
+    return [base.replace(window=window, interval=interval, filter_dup=False)
+            for window,interval in windows]
+
+class AdaptiveScanner(object):
+    """Wraps scanner (an HciScanner), changing the parameters of its
+    sources with the activity seen.
+
+    Every check seconds the reports of the last check are looked at.
+    A level is dropped after quiet seconds without a new device or
+    changed data; the top level is restored when at least new_devices
+    new or changed devices are heard in a check, or when the report
+    rate is rate_rise times that of the last check at the top level
+    (the rate before stepping down, as lower duty cycles hear less).
+    Devices not heard for present seconds are no longer counted as
+    present.
+
+    levels should not filter duplicates; those of ladder() don't.
+    """
+
+    def __init__(self, scanner, base=scan.SCAN_DEFAULT, levels=None,
+                 check=5.0, quiet=30.0, new_devices=1, rate_rise=2.0,
+                 present=60.0):
+        self.scanner = scanner
+        self.levels = levels or ladder(base)
+        self.check = check
+        self.quiet = quiet
+        self.new_devices = new_devices
+        self.rate_rise = rate_rise
+        self.table = devtable.DeviceTable(max_age=present)
+
+        self.level = None
+        self.transitions = 0
+        now = time.time()
+        self._t_start = self._t_level = self._t_check = self._t_active = now
+        self._on_time = 0.0 # duty-weighted seconds at previous levels
+        self._reports = 0
+        self._changed = 0
+        self._heard = set()
+        self._ref_rate = None # what rate_rise is measured against
+        self.report_rate = 0.0
+        self.capture_ratio = None
+        self.set_level(0, now)
+
+    def set_level(self, level, now=None):
+        "Applies levels[level] to every source that can be restarted."
+        if now is None:
+            now = time.time()
+        if self.level is not None:
+            self._on_time += (now-self._t_level)*self.params.duty_cycle
+            self.transitions += 1
+        self.level = level
+        self._t_level = now
+        self.params = self.levels[level]
+        for source in self.scanner.sources.values():
+            if hasattr(source, 'restart'):
+                source.restart(self.params)
+
+    @property
+    def duty_cycle(self):
+        return self.params.duty_cycle
+
+    def average_duty_cycle(self, now=None):
+        "Radio-on time over elapsed time, since this scanner started."
+        if now is None:
+            now = time.time()
+        elapsed = now-self._t_start
+        if elapsed <= 0:
+            return self.duty_cycle
+        return (self._on_time+(now-self._t_level)*self.duty_cycle)/elapsed
+
+    def metrics(self, now=None):
+        return {'level': self.level,
+                'duty_cycle': self.duty_cycle,
+                'average_duty_cycle': self.average_duty_cycle(now),
+                'report_rate': self.report_rate,
+                'capture_ratio': self.capture_ratio,
+                'present': len(self.table),
+                'transitions': self.transitions}
+
+    def _observe(self, report, now):
+        address = report['bdaddr']
+        entry = self.table.get(address)
+        if entry is None:
+            self._changed += 1
+        elif not _scan_response(report) and entry.data != report['data']:
+            self._changed += 1
+        self.table.add_report(report, now)
+        self._heard.add(address)
+        self._reports += 1
+
+    def _adjust(self, now):
+        elapsed = now-self._t_check
+        self.report_rate = self._reports/elapsed
+        self.table.expire(now)
+        if len(self.table):
+            self.capture_ratio = float(len(self._heard))/len(self.table)
+        else:
+            self.capture_ratio = None
+
+        rate_up = (self._ref_rate is not None and self._ref_rate > 0 and
+                   self.report_rate >= self.rate_rise*self._ref_rate)
+        # Below the top level, keep the rate heard before stepping down.
+        ref_rate = self.report_rate if self.level == 0 else self._ref_rate
+        if self._changed >= self.new_devices or rate_up:
+            self._t_active = now
+            if self.level != 0:
+                self.set_level(0, now)
+                ref_rate = None # heard at a lower duty cycle
+        elif (now-self._t_active >= self.quiet and
+              self.level < len(self.levels)-1):
+            self._t_active = now # stay a while at each level
+            self.set_level(self.level+1, now)
+
+        self._ref_rate = ref_rate
+        self._t_check = now
+        self._reports = 0
+        self._changed = 0
+        self._heard = set()
+
+    def poll(self, timeout=None):
+        "Same as HciScanner.poll(), adjusting the duty cycle as it goes."
+        now = time.time()
+        wait = max(self._t_check+self.check-now, 0)
+        if timeout is not None:
+            wait = min(wait, timeout)
+
+        reports = self.scanner.poll(wait)
+        now = time.time()
+        for report in reports:
+            self._observe(report, now)
+        if now >= self._t_check+self.check:
+            self._adjust(now)
+        return reports
+
+    def reports(self, timeout=None):
+        "Same as HciScanner.reports()."
+        if timeout is not None:
+            t_end = time.time()+timeout
+
+        while self.scanner.sources:
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = t_end-time.time()
+                if remaining <= 0:
+                    return
+
+            for report in self.poll(remaining):
+                yield report
+
+    def close(self):
+        self.scanner.close()
+
+def _scan_response(report):
+    if report.get('extended'):
+        return bool(report['evt_type'] & scan.EXT_SCAN_RESPONSE)
+    return report['evt_type'] == scan.SCAN_RSP
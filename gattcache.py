@@ -0,0 +1,74 @@
+#!/usr/bin/python2
+
+"""On-disk cache of GATT databases, keyed by device address.
+
+A record is a plain dict, stored as JSON:
+
+  {'db_hash': hex string of the Database Hash characteristic, or None,
+   'services': [{'uuid': ..., 'start': handle, 'end': handle,
+                 'characteristics': None (not discovered yet) or
+                   [{'uuid': ..., 'handle': declaration handle,
+                     'value_handle': ..., 'properties': ...,
+                     'descriptors': [[uuid, handle], ...]}, ...]},
+                ...]}
+
+The backends build and read records; this module only stores them.
+A record is trusted until the device's Database Hash differs from the
+stored one, or the device indicates Service Changed, at which point
+the backend calls invalidate().
+"""
+
+import os
+import json
+import errno
+
+import uuids
+
+CACHE_DIR = os.path.expanduser('~/.cache/ble/gatt')
+CACHE_VERSION = 1
+
+DATABASE_HASH = uuids.canonical_uuid('0x2b2a')
+
+class GattCache(object):
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+
+    def _path(self, address):
+        return os.path.join(self.directory,
+                            address.lower().replace(':','')+'.json')
+
+    def load(self, address):
+        "Returns the record for address, or None."
+        try:
+            with open(self._path(address)) as f:
+                record = json.load(f)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError: # damaged; rediscover
+            return None
+        if record.get('version') != CACHE_VERSION:
+            return None
+        return record
+
+    def store(self, address, record):
+        "Writes the record for address, replacing any old one whole."
+        try:
+            os.makedirs(self.directory)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        record = dict(record, version=CACHE_VERSION)
+        path = self._path(address)
+        tmp = path+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        os.rename(tmp, path)
+
+    def invalidate(self, address):
+        try:
+            os.unlink(self._path(address))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
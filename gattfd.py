@@ -0,0 +1,90 @@
+#!/usr/bin/python2
+
+"""Characteristic values carried over the sockets handed out by
+bluez's AcquireNotify and AcquireWrite.
+
+Each packet on such a socket is one value: a notification read, or a
+write command sent, with no D-Bus marshalling on the way. The classes
+here only need a SOCK_SEQPACKET socket, so a socketpair can stand in
+for bluetoothd.
+"""
+
+import os
+import socket
+
+ATT_HEADER = 3 # opcode and handle ahead of the value in a PDU
+
+def from_fd(fd):
+    """Socket object for fd, a file descriptor received from bluez
+    (an int, or a dbus UnixFd). fd is closed; the socket owns a
+    duplicate of it."""
+    if hasattr(fd, 'take'):
+        fd = fd.take()
+    try:
+        return socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    finally:
+        os.close(fd)
+
+class NotifySocket(object):
+    """Notifications of one characteristic, read into a buffer that is
+    reused for every packet."""
+
+    def __init__(self, sock, mtu):
+        self.sock = sock
+        self.mtu = mtu
+        self.buf = bytearray(mtu)
+        self.view = memoryview(self.buf)
+        self.count = 0
+        self._timeout = sock.gettimeout()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv_into(self, timeout=None):
+        """Waits up to timeout seconds (None for ever) for a notification
+        and returns it as a memoryview of the buffer, good until the
+        next call. Raises socket.timeout, or IOError once bluez closes
+        the socket (disconnected, or notifications stopped)."""
+        if timeout != self._timeout:
+            self.sock.settimeout(timeout)
+            self._timeout = timeout
+        n = self.sock.recv_into(self.buf)
+        if not n:
+            raise IOError("notification socket closed")
+        self.count += 1
+        return self.view[:n]
+
+    def recv(self, timeout=None):
+        "Same as recv_into(), but returns a copy as a string."
+        return self.recv_into(timeout).tobytes()
+
+    def close(self):
+        self.sock.close()
+
+class WriteSocket(object):
+    "Write commands to one characteristic, one value per packet."
+
+    def __init__(self, sock, mtu):
+        self.sock = sock
+        self.mtu = mtu
+        self.count = 0
+
+    @property
+    def max_value(self):
+        "Longest value that fits a write command."
+        return self.mtu-ATT_HEADER
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def write(self, value):
+        """Sends value, a string, bytearray or memoryview, without
+        copying it. Raises ValueError if it does not fit."""
+        if len(value) > self.max_value:
+            raise ValueError("%d bytes do not fit a write command of %d"%(
+                len(value), self.max_value))
+        self.sock.sendall(value)
+        self.count += 1
+
+    def close(self):
+        self.sock.close()
@@ -1,13 +1,15 @@
 #!/usr/bin/python
 
 import ble
+import uuids
 import os
 
 device_name = os.getenv('BLE_DEVICE_NAME') or 'CATEYE_HRM'
 
 try:
     dev = ble.discover_device(lambda d: d['Name'] == device_name)
-    dev.connect()
+    # Only set up the services used below.
+    dev.connect(services=[uuids.heart_rate, uuids.battery_service])
 
     print "Location",dev.heart_rate_service.body_sensor_location.value
     print "battery level",dev.battery_service.battery_level.value
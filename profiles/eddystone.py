@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+import struct
+import binascii
+
+import adv_registry
+import advdata
+
+EDDYSTONE_UUID = advdata.uuid16(0xFEAA)
+
+FRAME_UID = 0x00
+FRAME_URL = 0x10
+FRAME_TLM = 0x20
+FRAME_EID = 0x30
+
+URL_SCHEMES = ['http://www.', 'https://www.', 'http://', 'https://']
+URL_CODES = ['.com/', '.org/', '.edu/', '.net/', '.info/', '.biz/', '.gov/',
+             '.com', '.org', '.edu', '.net', '.info', '.biz', '.gov']
+
+class EddystoneFrame(adv_registry.AdvDecoder):
+    frame_type = None
+
+    @classmethod
+    def accepts(cls, raw):
+        return len(raw) >= 2 and ord(raw[0]) == cls.frame_type
+
+class EddystoneUID(EddystoneFrame):
+    service_uuid = EDDYSTONE_UUID
+    frame_type = FRAME_UID
+    name = 'eddystone_uid'
+
+    @property
+    def value(self):
+        if len(self.raw) < 18:
+            raise ValueError("short Eddystone-UID frame")
+        return {'tx_power': struct.unpack_from('b', self.raw, 1)[0],
+                'namespace': binascii.hexlify(self.raw[2:12]),
+                'instance': binascii.hexlify(self.raw[12:18])}
+
+class EddystoneURL(EddystoneFrame):
+    service_uuid = EDDYSTONE_UUID
+    frame_type = FRAME_URL
+    name = 'eddystone_url'
+
+    @property
+    def value(self):
+        url = [URL_SCHEMES[ord(self.raw[2])]]
+        for c in self.raw[3:]:
+            code = ord(c)
+            if code < len(URL_CODES):
+                url.append(URL_CODES[code])
+            else:
+                url.append(c)
+        return {'tx_power': struct.unpack_from('b', self.raw, 1)[0],
+                'url': ''.join(url)}
+
+class EddystoneTLM(EddystoneFrame):
+    service_uuid = EDDYSTONE_UUID
+    frame_type = FRAME_TLM
+    name = 'eddystone_tlm'
+
+    @property
+    def value(self):
+        version,battery,temp,adv_count,uptime = struct.unpack_from(
+            '>BHhII', self.raw, 1)
+        if version != 0:
+            raise ValueError("encrypted Eddystone-TLM frame")
+        return {'battery_mv': battery or None,
+                'temperature': None if temp == -0x8000 else temp/256.,
+                'adv_count': adv_count,
+                'uptime': uptime/10.}
+
+class EddystoneEID(EddystoneFrame):
+    service_uuid = EDDYSTONE_UUID
+    frame_type = FRAME_EID
+    name = 'eddystone_eid'
+
+    @property
+    def value(self):
+        if len(self.raw) < 10:
+            raise ValueError("short Eddystone-EID frame")
+        return {'tx_power': struct.unpack_from('b', self.raw, 1)[0],
+                'eid': binascii.hexlify(self.raw[2:10])}
@@ -0,0 +1,28 @@
+#!/usr/bin/python
+
+import struct
+import binascii
+
+import adv_registry
+
+COMPANY_APPLE = 0x004C
+IBEACON_TYPE = 0x02
+IBEACON_LENGTH = 0x15
+
+class IBeacon(adv_registry.AdvDecoder):
+    company_id = COMPANY_APPLE
+    name = 'ibeacon'
+
+    @classmethod
+    def accepts(cls, raw):
+        return (len(raw) >= 2+IBEACON_LENGTH and
+                struct.unpack_from('BB', raw) == (IBEACON_TYPE,IBEACON_LENGTH))
+
+    @property
+    def value(self):
+        major,minor,tx_power = struct.unpack_from('>HHb', self.raw, 18)
+        s = binascii.hexlify(self.raw[2:18])
+        return {'uuid': '-'.join((s[0:8],s[8:12],s[12:16],s[16:20],s[20:32])),
+                'major': major,
+                'minor': minor,
+                'tx_power': tx_power}
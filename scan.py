@@ -1,9 +1,31 @@
 #!/usr/bin/python2
 
 import ctypes
-import os,sys,socket,errno
-
-bt = ctypes.cdll.LoadLibrary('libbluetooth.so')
+import os,sys,socket,errno,select,time,collections
+
+import advdata
+
+bt = None
+
+def libbluetooth():
+    """Load libbluetooth on first use, so that importing this module
+    doesn't require bluez."""
+    global bt
+    if bt is None:
+        bt = ctypes.cdll.LoadLibrary('libbluetooth.so')
+        bt.hci_open_dev.argtypes = [ctypes.c_int]
+        bt.hci_le_set_scan_parameters.argtypes = [ctypes.c_int,
+                                                  ctypes.c_uint8,
+                                                  ctypes.c_uint16,
+                                                  ctypes.c_uint16,
+                                                  ctypes.c_uint8,
+                                                  ctypes.c_uint8,
+                                                  ctypes.c_int]
+        bt.hci_le_set_scan_enable.argtypes = [ctypes.c_int,
+                                              ctypes.c_uint8,
+                                              ctypes.c_uint8,
+                                              ctypes.c_int]
+    return bt
 
 def errcheck(err, name):
     if err >= 0: return
@@ -56,16 +78,11 @@ class HciFilter(ctypes.Structure):
 def ba2str(ba):
     return ':'.join("%02x"%ord(c) for c in reversed(tuple(ba)))
 
-EIR_NAME_SHORT = 8
-EIR_NAME_COMPLETE = 9
+EIR_NAME_SHORT = advdata.SHORT_LOCAL_NAME
+EIR_NAME_COMPLETE = advdata.COMPLETE_LOCAL_NAME
 
-def eir_parse_name(advdata):
-    while len(advdata):
-        field_len = ord(advdata[0])
-        field,advdata = advdata[1:1+field_len],advdata[1+field_len:]
-        eir_type = ord(field[0])
-        if eir_type in [EIR_NAME_SHORT, EIR_NAME_COMPLETE]:
-            return field[1:]
+def eir_parse_name(data):
+    return advdata.name(data)
 
 def unpack(ctype_instance):
     return buffer(ctype_instance)[:]
@@ -76,19 +93,6 @@ def pack_into(ctype_instance, buf):
     return ctype_instance
 
 
-bt.hci_open_dev.argtypes = [ctypes.c_int]
-bt.hci_le_set_scan_parameters.argtypes = [ctypes.c_int,
-                                          ctypes.c_uint8,
-                                          ctypes.c_uint16,
-                                          ctypes.c_uint16,
-                                          ctypes.c_uint8,
-                                          ctypes.c_uint8,
-                                          ctypes.c_int]
-bt.hci_le_set_scan_enable.argtype = [ctypes.c_int,
-                                     ctypes.c_uint8,
-                                     ctypes.c_uint8,
-                                     ctypes.c_int]
-
 def read_flags(data):
     # TODO:
     return 0
@@ -106,122 +110,717 @@ def check_report_filter(procedure, adv_info):
     return 0;
 
 class Unimplemented(Exception): pass
+class DecodeError(ValueError): pass
 
 import struct
 
 EVT_LE_ADVERTISING_REPORT = 0x02
-
-
-def unpack_r(fmt, data):
-    size=struct.calcsize(fmt)
-    datalen = ord(data[size])
-    otherdata = data[size+1:size+1+datalen]    
-    return struct.unpack(fmt,data[:size])+(otherdata,)
-
-def decode_event(event): 
-    "pass a string or something."
-    if ord(event[0]) != HCI_EVENT_PKT:
+EVT_LE_EXTENDED_ADVERTISING_REPORT = 0x0D
+
+# evt_type of an advertising report
+ADV_IND = 0x00
+ADV_DIRECT_IND = 0x01
+ADV_SCAN_IND = 0x02
+ADV_NONCONN_IND = 0x03
+SCAN_RSP = 0x04
+
+# evt_type bits of an extended advertising report
+EXT_CONNECTABLE = 0x0001
+EXT_SCANNABLE = 0x0002
+EXT_DIRECTED = 0x0004
+EXT_SCAN_RESPONSE = 0x0008
+EXT_LEGACY = 0x0010
+EXT_DATA_STATUS_MASK = 0x0060
+EXT_DATA_COMPLETE = 0x0000
+EXT_DATA_INCOMPLETE = 0x0020 # more fragments follow
+EXT_DATA_TRUNCATED = 0x0040 # no more fragments, data is cut short
+
+PHY_1M = 0x01
+PHY_2M = 0x02
+PHY_CODED = 0x03 # in reports; as a scanning PHY bit it is 0x04
+
+_event_header = struct.Struct('<BBBBB') # packet type, event, length,
+                                        # subevent, num_reports
+_report_header = struct.Struct('<BB6BB') # evt_type, bdaddr_type,
+                                         # bdaddr, length
+_rssi = struct.Struct('<b')
+_ext_report_header = struct.Struct('<HB6BBBBbbHB6BB')
+# evt_type, bdaddr_type, bdaddr, primary_phy, secondary_phy, sid,
+# tx_power, rssi, periodic interval, direct_addr_type, direct_addr,
+# length
+
+def decode_reports(buf, offset=0, length=None, ad_filter=None,
+                   reassembler=None):
+    """Decodes every report in an LE Advertising Report or LE Extended
+    Advertising Report event.
+
+    buf is anything supporting the buffer protocol (a str or a
+    bytearray filled by recv_into()) and the event starts at offset.
+    The buffer is read in place; only the advertising data of each
+    report is copied out, so the reports stay valid after the buffer
+    is reused.
+
+    Returns a list of dicts with keys evt_type, bdaddr_type, bdaddr,
+    data and rssi. Extended reports also have extended (True),
+    primary_phy, secondary_phy, sid, tx_power and periodic_interval;
+    see decode_extended_reports(). Events that don't carry advertising
+    reports give an empty list. Reports rejected by ad_filter (an
+    advdata.AdFilter) are skipped before anything is built for them.
+    """
+    if length is None:
+        length = len(buf)-offset
+    if length < _event_header.size:
+        raise DecodeError("short event: %d bytes"%length)
+
+    ptype,evt,plen,subevent,num_reports = _event_header.unpack_from(buf, offset)
+    if ptype != HCI_EVENT_PKT:
         raise ValueError("Not an event.")
+    if evt != EVT_LE_META_EVENT:
+        return []
+
+    end = offset+3+plen
+    if end > offset+length:
+        raise DecodeError("truncated event")
+    pos = offset+_event_header.size
+
+    if subevent == EVT_LE_EXTENDED_ADVERTISING_REPORT:
+        return decode_extended_reports(buf, pos, end, num_reports,
+                                       ad_filter, reassembler)
+    if subevent != EVT_LE_ADVERTISING_REPORT:
+        return []
+
+    view = memoryview(buf)
+    ret = []
+    for i in range(num_reports):
+        if pos+_report_header.size > end:
+            raise DecodeError("truncated report %d of %d"%(i,num_reports))
+        h = _report_header.unpack_from(buf, pos)
+        data_start = pos+_report_header.size
+        pos = data_start+h[8]
+        if pos+1 > end:
+            raise DecodeError("truncated report %d of %d"%(i,num_reports))
+
+        rssi = _rssi.unpack_from(buf, pos)[0]
+        if ad_filter is not None and not ad_filter.match(buf, data_start,
+                                                         pos, rssi):
+            pos += 1
+            continue
+
+        ret.append({'evt_type':h[0],
+                    'bdaddr_type':h[1],
+                    'bdaddr':"%02x:%02x:%02x:%02x:%02x:%02x"%(h[7],h[6],h[5],
+                                                              h[4],h[3],h[2]),
+                    'data':view[data_start:pos].tobytes(),
+                    'rssi':rssi})
+        pos += 1
 
-    evt,evt_data = unpack_r("<B",event[1:])
-    ret={'evt':evt}   
+    return ret
 
-    if evt==EVT_LE_META_EVENT:
-        subevent,subevent_data = ord(evt_data[0]),evt_data[1:]
-        ret['subevent']=subevent
-        if subevent==EVT_LE_ADVERTISING_REPORT:
-            (ret['evt_type'],
-             ret['bdaddr_type'],
-             bdaddr_buf,
-             adv_data) = unpack_r("<BB6s",subevent_data[1:])
+def decode_extended_reports(buf, pos, end, num_reports, ad_filter=None,
+                            reassembler=None):
+    """Decodes the reports of an LE Extended Advertising Report event,
+    from buf[pos:end] (just after num_reports).
+
+    An advertisement longer than one event comes as several fragments.
+    With a reassembler (an ExtendedReassembler), fragments are held
+    until the last one arrives and one report with the whole data is
+    returned then. Without one, each fragment is returned as is; its
+    evt_type & EXT_DATA_STATUS_MASK tells whether more follow.
+
+    tx_power and rssi are None when the controller doesn't know them.
+    """
+    view = memoryview(buf)
+    ret = []
+    for i in range(num_reports):
+        if pos+_ext_report_header.size > end:
+            raise DecodeError("truncated report %d of %d"%(i,num_reports))
+        h = _ext_report_header.unpack_from(buf, pos)
+        data_start = pos+_ext_report_header.size
+        pos = data_start+h[21]
+        if pos > end:
+            raise DecodeError("truncated report %d of %d"%(i,num_reports))
+
+        rssi = h[12]
+        if rssi == 127:
+            rssi = None
+        evt_type = h[0]
+        complete = evt_type & EXT_DATA_STATUS_MASK != EXT_DATA_INCOMPLETE
+
+        if reassembler is None and ad_filter is not None and not ad_filter.match(
+                buf, data_start, pos, rssi):
+            continue
+
+        report = {'evt_type':evt_type,
+                  'bdaddr_type':h[1],
+                  'bdaddr':"%02x:%02x:%02x:%02x:%02x:%02x"%(h[7],h[6],h[5],
+                                                            h[4],h[3],h[2]),
+                  'data':view[data_start:pos].tobytes(),
+                  'rssi':rssi,
+                  'extended':True,
+                  'primary_phy':h[8],
+                  'secondary_phy':h[9],
+                  'sid':h[10],
+                  'tx_power':None if h[11] == 127 else h[11],
+                  'periodic_interval':h[13]}
+
+        if reassembler is not None:
+            report = reassembler.add(report, complete)
+            if report is None:
+                continue
+            if ad_filter is not None and not ad_filter.match(
+                    report['data'], rssi=report['rssi']):
+                continue
+
+        ret.append(report)
 
-            ret['name']=eir_parse_name(adv_data)
-            ret['bdaddr']=ba2str(bdaddr_buf)
-        else:
-            raise Unimplemented("subevent = %02x"%subevent)
+    return ret
 
-    else:
-        raise Unimplemented("event = %02x"%evt)
+class ExtendedReassembler(object):
+    """Joins the fragments of extended advertisements.
+
+    Fragments are keyed by address and advertising SID. At most
+    max_pending advertisements are held at once; when more start, the
+    oldest incomplete one is dropped and counted in dropped.
+    """
+
+    def __init__(self, max_pending=64):
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()
+        self.dropped = 0
+
+    def add(self, fragment, complete):
+        """Takes one fragment report. Returns the whole report when
+        complete is true (the last fragment), else None."""
+        key = (fragment['bdaddr_type'], fragment['bdaddr'], fragment['sid'])
+        chunks = self.pending.pop(key, None)
+
+        if not complete:
+            if chunks is None:
+                chunks = []
+                if len(self.pending) >= self.max_pending:
+                    self.pending.popitem(last=False)
+                    self.dropped += 1
+            chunks.append(fragment['data'])
+            self.pending[key] = chunks
+            return None
+
+        if chunks:
+            chunks.append(fragment['data'])
+            fragment['data'] = ''.join(chunks)
+        return fragment
 
+def decode_event(event): 
+    """pass a string or something. Only the first report is returned,
+    use decode_reports() to get all of them."""
+    reports = decode_reports(event)
+    if not reports:
+        raise Unimplemented("event = %02x, subevent = %02x"%
+                            _event_header.unpack_from(event)[1:4:2])
+
+    ret = reports[0]
+    ret['evt'] = EVT_LE_META_EVENT
+    ret['subevent'] = _event_header.unpack_from(event)[3]
+    ret['name'] = eir_parse_name(ret['data'])
     return ret
         
-def print_advertising_devices(dd, filter_type):
-
-    HCI_MAX_EVENT_SIZE = 260
-
-    nf = HciFilter()
-    of = HciFilter()
-
-    AF_BLUETOOTH=31
-    BTPROTO_HCI=1
-    SOL_HCI=0
-    HCI_FILTER=2
-
-    dds = socket.fromfd(dd, AF_BLUETOOTH, socket.SOCK_RAW, BTPROTO_HCI)
-
-    sockopt = dds.getsockopt(SOL_HCI, HCI_FILTER, ctypes.sizeof(of))
-    pack_into(of,sockopt)
-
-    nf.clear()
-    nf.set_ptype(HCI_EVENT_PKT)
-    nf.set_event(EVT_LE_META_EVENT)
-
-    # print " ".join("%x"%ord(b) for b in buffer(nf))
-
-    dds.setsockopt(SOL_HCI, HCI_FILTER, nf)
-
-    try:
+OWN_ADDR_PUBLIC = 0
+OWN_ADDR_RANDOM = 1
+
+# Scanning_PHYs bits of LE Set Extended Scan Parameters
+SCAN_PHY_1M = 0x01
+SCAN_PHY_CODED = 0x04
+
+class ScanParameters(object):
+    """LE scan settings.
+
+      - active: send scan requests, to get scan responses (which often
+        carry the name). Passive scanning only listens, which saves
+        air time on dense sites.
+
+      - interval, window: in units of 0.625 ms, from 0x0004 to 0x4000.
+        The radio listens for window out of every interval.
+
+      - filter_dup: let the controller drop repeated advertisements
+        from the same device. Turn it off to get every advertisement,
+        such as for RSSI tracking.
+
+      - own_type: OWN_ADDR_PUBLIC or OWN_ADDR_RANDOM, the address used
+        in scan requests.
+
+      - extended: use the Bluetooth 5 extended scanning commands, which
+        report extended advertisements (long payloads, coded PHY) as
+        well as legacy ones. The controller must support them.
+
+      - phys: for extended scanning, the PHYs to scan on, a mask of
+        SCAN_PHY_1M and SCAN_PHY_CODED. Each is scanned with the same
+        interval and window.
+    """
+
+    def __init__(self, active=True, interval=0x0010, window=0x0010,
+                 filter_dup=True, own_type=OWN_ADDR_RANDOM,
+                 extended=False, phys=None):
+        if not 0x0004 <= interval <= 0x4000:
+            raise ValueError("scan interval out of range: 0x%04x"%interval)
+        if not 0x0004 <= window <= interval:
+            raise ValueError("scan window must be from 0x0004 to the interval")
+        if own_type not in (OWN_ADDR_PUBLIC, OWN_ADDR_RANDOM):
+            raise ValueError("unknown own address type %r"%own_type)
+        if phys is None:
+            phys = SCAN_PHY_1M
+        if not phys or phys & ~(SCAN_PHY_1M|SCAN_PHY_CODED):
+            raise ValueError("bad scanning PHYs 0x%02x"%phys)
+        if phys != SCAN_PHY_1M and not extended:
+            raise ValueError("only extended scanning can use the coded PHY")
+
+        self.active = bool(active)
+        self.interval = interval
+        self.window = window
+        self.filter_dup = bool(filter_dup)
+        self.own_type = own_type
+        self.extended = bool(extended)
+        self.phys = phys
+
+    @property
+    def scan_type(self):
+        return 0x01 if self.active else 0x00
+
+    @property
+    def duty_cycle(self):
+        "Fraction of the time the radio is listening."
+        return float(self.window)/self.interval
+
+    def replace(self, **changes):
+        "Returns a copy with some settings changed."
+        settings = dict(active=self.active, interval=self.interval,
+                        window=self.window, filter_dup=self.filter_dup,
+                        own_type=self.own_type, extended=self.extended,
+                        phys=self.phys)
+        settings.update(changes)
+        return ScanParameters(**settings)
+
+    def __eq__(self, other):
+        return (isinstance(other, ScanParameters) and
+                (self.active, self.interval, self.window,
+                 self.filter_dup, self.own_type, self.extended, self.phys) ==
+                (other.active, other.interval, other.window,
+                 other.filter_dup, other.own_type, other.extended, other.phys))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return ("ScanParameters(active=%r, interval=0x%04x, window=0x%04x, "
+                "filter_dup=%r, own_type=%d, extended=%r, phys=0x%02x)"%(
+                    self.active, self.interval, self.window, self.filter_dup,
+                    self.own_type, self.extended, self.phys))
+
+# Presets.
+#
+# SCAN_DEFAULT: active, listening all the time in 10 ms slices, one
+# report per device.
+#
+# SCAN_LOW_POWER: passive, listening 11.25 ms every 1.28 s (under 1%
+# duty). Finds devices that advertise steadily, eventually.
+#
+# SCAN_MAX_CAPTURE: passive, listening all the time in 40 ms windows
+# (fewer channel changes than 10 ms ones), with duplicate filtering
+# off so every advertisement is reported.
+#
+# SCAN_EXTENDED: passive extended scanning on the 1M and coded PHYs,
+# for Bluetooth 5 extended and long-range advertisements.
+SCAN_DEFAULT = ScanParameters()
+SCAN_LOW_POWER = ScanParameters(active=False, interval=0x0800, window=0x0012)
+SCAN_MAX_CAPTURE = ScanParameters(active=False, interval=0x0040,
+                                  window=0x0040, filter_dup=False)
+SCAN_EXTENDED = ScanParameters(active=False, interval=0x0040, window=0x0040,
+                               filter_dup=False, extended=True,
+                               phys=SCAN_PHY_1M|SCAN_PHY_CODED)
+
+OGF_LE_CTL = 0x08
+OCF_LE_SET_EVENT_MASK = 0x0001
+OCF_LE_SET_EXT_SCAN_PARAMETERS = 0x0041
+OCF_LE_SET_EXT_SCAN_ENABLE = 0x0042
+
+# The default LE event mask, and that plus the LE Extended Advertising
+# Report event.
+LE_EVENT_MASK_DEFAULT = 0x1f
+LE_EVENT_MASK_EXT_SCAN = LE_EVENT_MASK_DEFAULT | (1<<12)
+
+class HciError(Exception): pass
+
+class HciRequest(ctypes.Structure):
+    _fields_ = [("ogf", ctypes.c_uint16),
+                ("ocf", ctypes.c_uint16),
+                ("event", ctypes.c_int),
+                ("cparam", ctypes.c_void_p),
+                ("clen", ctypes.c_int),
+                ("rparam", ctypes.c_void_p),
+                ("rlen", ctypes.c_int)]
+
+def hci_command(dd, ogf, ocf, params, timeout=1000):
+    """Sends an HCI command and waits for it to complete. Returns the
+    return parameters after the status, and raises HciError if the
+    status is not success."""
+    cparam = ctypes.create_string_buffer(params, len(params))
+    rparam = ctypes.create_string_buffer(HCI_MAX_EVENT_SIZE)
+    req = HciRequest(ogf, ocf, 0,
+                     ctypes.cast(cparam, ctypes.c_void_p), len(params),
+                     ctypes.cast(rparam, ctypes.c_void_p), HCI_MAX_EVENT_SIZE)
+
+    err = libbluetooth().hci_send_req(dd, ctypes.byref(req), timeout)
+    errcheck(err, "hci_send_req(0x%02x, 0x%04x)"%(ogf, ocf))
+
+    ret = rparam.raw[:req.rlen]
+    if ret and ord(ret[0]) != 0:
+        raise HciError("command 0x%02x/0x%04x: status 0x%02x"%(ogf, ocf,
+                                                              ord(ret[0])))
+    return ret[1:]
+
+def set_extended_scan_parameters(dd, params):
+    phys = [phy for phy in (SCAN_PHY_1M, SCAN_PHY_CODED) if params.phys & phy]
+    cmd = struct.pack('<BBB', params.own_type, 0x00, params.phys)
+    for phy in phys:
+        cmd += struct.pack('<BHH', params.scan_type, params.interval,
+                           params.window)
+    hci_command(dd, OGF_LE_CTL, OCF_LE_SET_EXT_SCAN_PARAMETERS, cmd)
+
+def set_extended_scan_enable(dd, enable, filter_dup):
+    # duration and period 0: scan until disabled
+    cmd = struct.pack('<BBHH', bool(enable), bool(filter_dup), 0, 0)
+    hci_command(dd, OGF_LE_CTL, OCF_LE_SET_EXT_SCAN_ENABLE, cmd)
+
+def set_le_event_mask(dd, mask):
+    hci_command(dd, OGF_LE_CTL, OCF_LE_SET_EVENT_MASK, struct.pack('<Q', mask))
+
+AF_BLUETOOTH=31
+BTPROTO_HCI=1
+SOL_HCI=0
+HCI_FILTER=2
+
+HCI_MAX_EVENT_SIZE = 260
+
+class HciScanSource(object):
+    """The raw HCI socket of one adapter, set up for LE scanning.
+
+    The socket is non-blocking and only passes LE meta events, so it
+    can be handed to select/epoll and costs nothing while idle.
+    """
+
+    def __init__(self, dev_id=None):
+        bt = libbluetooth()
+
+        if dev_id is None:
+            dev_id = bt.hci_get_route(None)
+            errcheck(dev_id, "Get dev id")
+        self.dev_id = dev_id
+        self.name = "hci%d"%dev_id
+
+        self.dd = bt.hci_open_dev(dev_id)
+        errcheck(self.dd, "open_dev")
+
+        self.sock = socket.fromfd(self.dd, AF_BLUETOOTH,
+                                  socket.SOCK_RAW, BTPROTO_HCI)
+
+        self.old_filter = HciFilter()
+        sockopt = self.sock.getsockopt(SOL_HCI, HCI_FILTER,
+                                       ctypes.sizeof(self.old_filter))
+        pack_into(self.old_filter, sockopt)
+
+        self.scanning = False
+        self.buf = bytearray(HCI_MAX_EVENT_SIZE)
+        self.reassembler = ExtendedReassembler()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def start(self, params=SCAN_DEFAULT):
+        "Starts scanning with params, a ScanParameters."
+        bt = libbluetooth()
+
+        if params.extended:
+            set_le_event_mask(self.dd, LE_EVENT_MASK_EXT_SCAN)
+            set_extended_scan_parameters(self.dd, params)
+            set_extended_scan_enable(self.dd, True, params.filter_dup)
+        else:
+            err = bt.hci_le_set_scan_parameters(self.dd, params.scan_type,
+                                                params.interval, params.window,
+                                                params.own_type, 0x00, 1000)
+            errcheck(err, "set_scan_parameters")
+
+            err = bt.hci_le_set_scan_enable(self.dd, 0x01, params.filter_dup,
+                                            1000)
+            errcheck(err, "set_scan_enable")
+        self.scanning = True
+        self.params = params
+
+        nf = HciFilter()
+        nf.clear()
+        nf.set_ptype(HCI_EVENT_PKT)
+        nf.set_event(EVT_LE_META_EVENT)
+        self.sock.setsockopt(SOL_HCI, HCI_FILTER, unpack(nf))
+        self.sock.setblocking(False)
+
+    def stop(self):
+        if not self.scanning:
+            return
+        self.sock.setblocking(True)
+        self.sock.setsockopt(SOL_HCI, HCI_FILTER, unpack(self.old_filter))
+
+        self.scanning = False
+        if self.params.extended:
+            set_extended_scan_enable(self.dd, False, self.params.filter_dup)
+            set_le_event_mask(self.dd, LE_EVENT_MASK_DEFAULT)
+        else:
+            err = libbluetooth().hci_le_set_scan_enable(self.dd, 0x00,
+                                                        self.params.filter_dup,
+                                                        1000)
+            errcheck(err, "set_scan_disable")
+
+    def restart(self, params):
+        "Stops scanning if needed and starts again with params."
+        self.stop()
+        self.start(params)
+
+    def read_events(self):
+        """Reads every event waiting on the socket, without blocking.
+
+        Each event is read into the same buffer, so this yields
+        (buffer, length) pairs that are only valid until the next
+        one."""
+        buf = self.buf
         while 1:
-            try:      
-                buf = os.read(dd, HCI_MAX_EVENT_SIZE)
-            except OSError as err:                
-                if err.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
-                    continue
+            try:
+                n = self.sock.recv_into(buf)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN,errno.EWOULDBLOCK,errno.EINTR):
+                    return
                 raise
-            
-            event_data = decode_event(buf)
-            # check_report_filter(filter_type, info):
-            print "%(bdaddr)s %(name)s"%event_data
+            yield buf,n
+
+    def close(self):
+        try:
+            self.stop()
+        finally:
+            self.sock.close()
+            err = libbluetooth().hci_close_dev(self.dd)
+            errcheck(err, "close")
+
+class HciScanner(object):
+    """Waits on one or more scan sources with epoll (or select, where
+    epoll is not available) and decodes the advertising reports they
+    deliver.
+
+    Reports are handed out by the reports() generator or passed to a
+    callback by run(); nothing is read until the kernel says a socket
+    is readable. Reports that pass ad_filter are also recorded in
+    table, if given: a devtable.DeviceTable, a scanarray.ReportArray or
+    anything else with an add_report(report, now) method.
+
+    Each report is tagged with the name of the adapter that heard it,
+    as 'adapter'. With dedup_window set, a report that another adapter
+    already delivered (same address, type and data) within that many
+    seconds is dropped, so several adapters give one stream.
+
+    If capture (such as a capture.BtsnoopWriter) is given, every raw
+    event read is written to it before decoding.
+
+    Sources that reach end of file (set eof, like capture.ReplaySource)
+    are dropped, and reports() ends when no sources are left.
+    """
+
+    def __init__(self, sources=(), ad_filter=None, table=None,
+                 dedup_window=None, capture=None):
+        self.sources = {}
+        self.ad_filter = ad_filter
+        self.table = table
+        self.capture = capture
+        self.decode_errors = 0
+        self.duplicates = 0
+
+        self.dedup_window = dedup_window
+        self._recent = {}
+        self._older = {}
+        self._next_rotate = 0
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+        else:
+            self._epoll = None
+
+        for source in sources:
+            self.add(source)
+
+    def add(self, source):
+        fd = source.fileno()
+        self.sources[fd] = source
+        if self._epoll is not None:
+            self._epoll.register(fd, select.EPOLLIN)
+
+    def remove(self, source):
+        fd = source.fileno()
+        del self.sources[fd]
+        if self._epoll is not None:
+            self._epoll.unregister(fd)
+
+    def _wait(self, timeout):
+        "Returns the sources that are ready to read."
+        try:
+            if self._epoll is not None:
+                if timeout is None:
+                    timeout = -1
+                return [self.sources[fd]
+                        for fd,_ in self._epoll.poll(timeout)
+                        if fd in self.sources]
+            else:
+                r,_,_ = select.select(self.sources.values(), [], [], timeout)
+                return r
+        except (IOError, OSError, select.error) as err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def _duplicate(self, report, adapter, now):
+        """Whether another adapter delivered this report within the
+        dedup window. Recent reports are kept in two generations that
+        rotate every window, so memory stays bounded."""
+        if now >= self._next_rotate:
+            self._older = self._recent
+            self._recent = {}
+            self._next_rotate = now+self.dedup_window
+
+        key = (report['bdaddr'], report['evt_type'], report['data'])
+        seen = self._recent.get(key) or self._older.get(key)
+        if (seen is not None and seen[0] != adapter and
+            now-seen[1] < self.dedup_window):
+            return True
+        self._recent[key] = (adapter, now)
+        return False
+
+    def poll(self, timeout=None):
+        """Waits up to timeout seconds (forever if None) for reports.
+        Returns a possibly-empty list of decoded reports."""
+        ret = []
+        for source in self._wait(timeout):
+            adapter = source.name
+            for buf,n in source.read_events():
+                if self.capture is not None:
+                    self.capture.write(buf, n)
+                try:
+                    reports = decode_reports(buf, 0, n, self.ad_filter,
+                                             source.reassembler)
+                except ValueError:
+                    self.decode_errors += 1
+                    continue
 
+                for report in reports:
+                    report['adapter'] = adapter
+                if self.dedup_window:
+                    now = time.time()
+                    unique = [r for r in reports
+                              if not self._duplicate(r, adapter, now)]
+                    self.duplicates += len(reports)-len(unique)
+                    reports = unique
+
+                if self.table is not None:
+                    now = time.time()
+                    for report in reports:
+                        self.table.add_report(report, now)
+                ret.extend(reports)
+
+            if getattr(source, 'eof', False):
+                self.remove(source)
+                source.close()
+        return ret
+
+    def reports(self, timeout=None):
+        """Generates decoded reports until timeout seconds have passed,
+        or forever if timeout is None."""
+        if timeout is not None:
+            t_end = time.time()+timeout
+
+        while self.sources:
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = t_end-time.time()
+                if remaining <= 0:
+                    return
+
+            for report in self.poll(remaining):
+                yield report
+
+    def run(self, callback, timeout=None):
+        """Calls callback(report) for each report. Stops at timeout, or
+        when the callback returns False."""
+        for report in self.reports(timeout):
+            if callback(report) is False:
+                break
+
+    def close(self):
+        for source in self.sources.values():
+            self.remove(source)
+            source.close()
+        if self._epoll is not None:
+            self._epoll.close()
+
+def adapter_ids():
+    "Returns the device ids of all the bluetooth adapters, hci0 first."
+    try:
+        names = os.listdir('/sys/class/bluetooth')
+    except OSError:
+        return []
+    return sorted(int(name[3:]) for name in names
+                  if name.startswith('hci') and name[3:].isdigit())
+
+# Two adapters hear the same advertising event on different channels
+# within a few ms, and no device advertises faster than every 20 ms.
+DEDUP_WINDOW = 0.015
+
+def scanner(dev_ids=(None,), ad_filter=None, table=None, params=SCAN_DEFAULT,
+            capture=None):
+    """Opens and starts a scan source on each of dev_ids, with params (a
+    ScanParameters), and returns an HciScanner watching all of them.
+    dev_ids may be 'all' for every adapter; reports heard by more than
+    one adapter are then merged. capture is passed to the HciScanner."""
+    if dev_ids == 'all':
+        dev_ids = adapter_ids()
+        if not dev_ids:
+            raise IOError("no bluetooth adapters")
+
+    s = HciScanner(ad_filter=ad_filter, table=table, capture=capture,
+                   dedup_window=DEDUP_WINDOW if len(dev_ids) > 1 else None)
+    try:
+        for dev_id in dev_ids:
+            source = HciScanSource(dev_id)
+            s.add(source)
+            source.start(params)
+    except:
+        s.close()
+        raise
+    return s
+
+if __name__=="__main__":
+    # scan.py [-w capture] [all | dev_id...]
+    # scan.py -r capture
+    import capture
+    args = sys.argv[1:]
+    out = None
+    if args[:1] == ['-r']:
+        s = HciScanner([capture.ReplaySource(args[1], speed=None)])
+    else:
+        if args[:1] == ['-w']:
+            out = capture.writer(args[1])
+            args = args[2:]
+        if args == ['all']:
+            dev_ids = 'all'
+        else:
+            dev_ids = [int(d) for d in args] or (None,)
+        s = scanner(dev_ids, capture=out)
+
+    try:
+        for report in s.reports():
+            print report['adapter'], report['bdaddr'], eir_parse_name(report['data']), report['rssi']
     finally:
-        dds.setsockopt(SOL_HCI, HCI_FILTER, ctypes.pointer(of))
+        s.close()
+        if out is not None:
+            out.close()
         print "wrapped up"
-
-        dds.close()
-
-    return 0
-
-
-dev_id = bt.hci_get_route(None)
-#print "dev_id",dev_id
-errcheck(dev_id, "Get dev id")
-
-dd = bt.hci_open_dev(dev_id)
-#print "dd",dd
-errcheck(dd,"open_dev")
-
-scan_type = 0x01
-interval = 0x0010
-window = 0x0010
-filter_type = 0
-own_type = 1 # 1 for random
-filter_dup = 1
-
-err = bt.hci_le_set_scan_parameters(dd, scan_type, interval, window,
-                                    own_type, 0x00, 1000)
-errcheck(err, "set_scan_parameters")
-
-try:
-    err = bt.hci_le_set_scan_enable(dd, 0x01, filter_dup, 1000)
-    errcheck(err, "set_scan_enable")
-
-    err = print_advertising_devices(dd, filter_type)
-    errcheck(err, "print_adv")
-
-finally:
-    err = bt.hci_le_set_scan_enable(dd, 0x00, filter_dup, 1000)
-    errcheck(err, "set_scan_disable")
-    
-    err = bt.hci_close_dev(dd)
-    errcheck(err, "close")
-
@@ -0,0 +1,276 @@
+#!/usr/bin/python2
+
+"""A columnar buffer of advertising reports.
+
+ReportArray keeps each report as one row of fixed-size columns
+(array.array), instead of a dict per advertisement: the address (a
+48-bit int, held exactly in a double), its type, the event type,
+RSSI, adapter, timestamp, a bitmask of the AD types present and the
+offset and length of the advertising data in a shared payload blob.
+Identical payloads, which is most of them for beacons, are stored
+once. A row costs about 35 bytes.
+
+Pass a ReportArray as the table of a scan.HciScanner to fill it. The
+batch accessors return NumPy structured arrays, and select() filters
+by address, RSSI, time window, adapter and service uuid with array
+operations. NumPy is only imported by the methods that need it.
+"""
+
+import time
+import array
+
+import advdata
+from uuids import canonical_uuid
+
+# Columns, as (name, array typecode). Python 2 arrays have no 64-bit
+# integer typecode on 32-bit builds, so the address is kept in a
+# double (exact up to 2**53) and the ad_types bitmask in two halves.
+COLUMNS = (
+    ('address', 'd'),
+    ('address_type', 'B'),
+    ('evt_type', 'B'),
+    ('rssi', 'h'),
+    ('adapter', 'B'),
+    ('timestamp', 'd'),
+    ('ad_types_lo', 'I'),
+    ('ad_types_hi', 'I'),
+    ('offset', 'I'),
+    ('length', 'H'),
+)
+
+# Fields of the numpy export, as (name, dtype); address and ad_types
+# are 64-bit there.
+FIELDS = (
+    ('address', 'u8'),
+    ('address_type', 'u1'),
+    ('evt_type', 'u1'),
+    ('rssi', 'i2'),
+    ('adapter', 'u1'),
+    ('timestamp', 'f8'),
+    ('ad_types', 'u8'),
+    ('offset', 'u4'),
+    ('length', 'u2'),
+)
+
+RSSI_NONE = -32768 # rssi column value for reports without one
+AD_TYPE_OTHER = 63 # ad_types bit for AD types above 62
+
+def address_int(address):
+    "'aa:bb:cc:dd:ee:ff' -> 0xaabbccddeeff"
+    return int(address.replace(':',''), 16)
+
+def address_str(value):
+    "0xaabbccddeeff -> 'aa:bb:cc:dd:ee:ff'"
+    s = "%012x"%value
+    return ':'.join(s[i:i+2] for i in range(0, 12, 2))
+
+def ad_type_bit(ad_type):
+    "The bit standing for ad_type in the ad_types column."
+    return 1 << min(ad_type, AD_TYPE_OTHER)
+
+def ad_type_mask(buf, offset=0, end=None):
+    "Returns the ad_types bitmask of the advertising data in buf."
+    mask = 0
+    for ad_type,_,_ in advdata.ad_fields(buf, offset, end):
+        mask |= 1 << min(ad_type, AD_TYPE_OTHER)
+    return mask
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("ReportArray batch export needs numpy")
+    return numpy
+
+class ReportArray(object):
+    """Advertising reports in columns, oldest first.
+
+    capacity bounds the number of rows; when it is reached the oldest
+    half is dropped (and counted in dropped), along with any payloads
+    only they used.
+    """
+
+    def __init__(self, capacity=1<<20):
+        self.capacity = capacity
+        self.adapters = [] # adapter names, indexed by the adapter column
+        self.dropped = 0
+        self.clear()
+
+    def clear(self):
+        "Drops every row and payload."
+        for name,typecode in COLUMNS:
+            setattr(self, name, array.array(typecode))
+        self.payloads = bytearray()
+        self._payload_offsets = {} # payload -> offset in payloads
+        self._payload_masks = {} # offset -> ad_types
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def _adapter_index(self, name):
+        try:
+            return self.adapters.index(name)
+        except ValueError:
+            self.adapters.append(name)
+            return len(self.adapters)-1
+
+    def _store_payload(self, data):
+        offset = self._payload_offsets.get(data)
+        if offset is None:
+            offset = len(self.payloads)
+            self.payloads.extend(data)
+            self._payload_offsets[data] = offset
+            self._payload_masks[offset] = ad_type_mask(data)
+        return offset
+
+    def append(self, address, rssi=None, data='', address_type=0,
+               evt_type=0, adapter=None, now=None):
+        "Adds one report. data is the raw advertising data."
+        if now is None:
+            now = time.time()
+        if len(self.timestamp) >= self.capacity:
+            self._drop_oldest(len(self.timestamp)-self.capacity//2)
+
+        if not isinstance(data, str):
+            data = memoryview(data).tobytes()
+        offset = self._store_payload(data)
+
+        mask = self._payload_masks[offset]
+        self.address.append(address_int(address))
+        self.address_type.append(address_type)
+        self.evt_type.append(evt_type)
+        self.rssi.append(RSSI_NONE if rssi is None else rssi)
+        self.adapter.append(self._adapter_index(adapter))
+        self.timestamp.append(now)
+        self.ad_types_lo.append(mask & 0xffffffff)
+        self.ad_types_hi.append(mask >> 32)
+        self.offset.append(offset)
+        self.length.append(len(data))
+
+    def add_report(self, report, now=None):
+        "Adds a report dict from scan.decode_reports()."
+        self.append(report['bdaddr'], report['rssi'], report['data'],
+                    report['bdaddr_type'], report['evt_type'],
+                    report.get('adapter'), now)
+
+    def _drop_oldest(self, n):
+        for name,_ in COLUMNS:
+            del getattr(self, name)[:n]
+        self.dropped += n
+
+        # Repack the payloads still referenced.
+        old_payloads = self.payloads
+        old_masks = self._payload_masks
+        self.payloads = bytearray()
+        self._payload_offsets = {}
+        self._payload_masks = {}
+        moved = {}
+        offsets = self.offset
+        for i in range(len(offsets)):
+            old = offsets[i]
+            new = moved.get(old)
+            if new is None:
+                data = bytes(old_payloads[old:old+self.length[i]])
+                new = moved[old] = len(self.payloads)
+                self.payloads.extend(data)
+                self._payload_offsets[data] = new
+                self._payload_masks[new] = old_masks[old]
+            offsets[i] = new
+
+    def payload(self, i):
+        "The advertising data of row i."
+        offset = self.offset[i]
+        return bytes(self.payloads[offset:offset+self.length[i]])
+
+    def row(self, i):
+        "Row i as a dict like the reports of scan.decode_reports()."
+        rssi = self.rssi[i]
+        return {'bdaddr': address_str(int(self.address[i])),
+                'bdaddr_type': self.address_type[i],
+                'evt_type': self.evt_type[i],
+                'rssi': None if rssi == RSSI_NONE else rssi,
+                'adapter': self.adapters[self.adapter[i]],
+                'timestamp': self.timestamp[i],
+                'data': self.payload(i)}
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.row(i)
+
+    def dtype(self):
+        "The numpy dtype of the arrays returned by to_numpy()."
+        np = _numpy()
+        return np.dtype(list(FIELDS))
+
+    def to_numpy(self):
+        """Returns all rows as a numpy structured array with a field
+        per column. The payloads stay in self.payloads."""
+        np = _numpy()
+        ret = np.empty(len(self), dtype=self.dtype())
+        # An array typecode and the numpy dtype of the same letter are
+        # the same C type.
+        column = dict((name, np.frombuffer(getattr(self, name),
+                                           dtype=typecode))
+                      for name,typecode in COLUMNS)
+        for name,_ in FIELDS:
+            if name != 'ad_types':
+                ret[name] = column[name]
+        ret['ad_types'] = ((column['ad_types_hi'].astype('u8') << 32) |
+                           column['ad_types_lo'])
+        return ret
+
+    def uuid_payloads(self, uuids):
+        """Returns the payload offsets whose advertising data lists one
+        of uuids, as a service uuid or in service data. Each distinct
+        payload is looked at once."""
+        if isinstance(uuids, (basestring, int)):
+            uuids = [uuids]
+        test = advdata.AdFilter(uuids=[canonical_uuid(u) for u in uuids])
+        payloads = self.payloads
+        return [offset for data,offset in self._payload_offsets.iteritems()
+                if test.match(payloads, offset, offset+len(data))]
+
+    def mask(self, uuid=None, min_rssi=None, since=None, until=None,
+             adapter=None, address=None, ad_type=None, rows=None):
+        """Returns a numpy boolean array selecting the rows of rows (by
+        default to_numpy()) that advertise uuid (one or a list), have
+        rssi at least min_rssi, a timestamp in [since, until), came from
+        adapter, are from address or carry ad_type."""
+        np = _numpy()
+        if rows is None:
+            rows = self.to_numpy()
+        keep = np.ones(len(rows), dtype=bool)
+
+        if min_rssi is not None:
+            keep &= rows['rssi'] >= min_rssi
+        if since is not None:
+            keep &= rows['timestamp'] >= since
+        if until is not None:
+            keep &= rows['timestamp'] < until
+        if adapter is not None:
+            if adapter not in self.adapters:
+                keep[:] = False
+            else:
+                keep &= rows['adapter'] == self.adapters.index(adapter)
+        if address is not None:
+            keep &= rows['address'] == address_int(address)
+        if ad_type is not None:
+            keep &= (rows['ad_types'] & np.uint64(ad_type_bit(ad_type))) != 0
+        if uuid is not None:
+            offsets = np.array(self.uuid_payloads(uuid), dtype='u4')
+            keep &= np.in1d(rows['offset'], offsets)
+        return keep
+
+    def select(self, **criteria):
+        """Returns the rows matching criteria (the arguments of mask())
+        as a numpy structured array."""
+        rows = self.to_numpy()
+        return rows[self.mask(rows=rows, **criteria)]
+
+    def take(self):
+        """Returns (rows, payloads): every row as a numpy structured
+        array and the payload blob its offsets point into, and clears
+        the buffer for the next batch."""
+        ret = self.to_numpy(), bytes(self.payloads)
+        self.clear()
+        return ret
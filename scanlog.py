@@ -0,0 +1,221 @@
+#!/usr/bin/python2
+
+"""Long-running scan logger.
+
+  python -m scanlog [options] [all | dev_id...]
+
+    -o base      write to base-YYYYmmdd-HHMMSS.jsonl (or .bin)
+                 (default scan)
+    -f format    json (one JSON object per line, the default) or binary
+    -s bytes     start a new file after this many bytes
+    -t seconds   start a new file after this many seconds
+    -i seconds   print stats to stderr this often (default 10, 0 for
+                 never)
+    -p preset    default, low_power, max_capture or extended
+    -r capture   replay a capture file (see capture.py), as fast as
+                 possible, instead of scanning
+
+Records are encoded as they arrive but written in batches, flushed at
+least every FLUSH_INTERVAL seconds. The binary format is a u16 length
+(little-endian) before each record, the record being a broker.py
+report frame; read_binary() reads it back.
+"""
+
+import sys
+import json
+import time
+import getopt
+import struct
+import binascii
+
+import scan
+import broker
+
+FLUSH_INTERVAL = 1.0
+FLUSH_BYTES = 1<<16
+
+PRESETS = {'default': scan.SCAN_DEFAULT,
+           'low_power': scan.SCAN_LOW_POWER,
+           'max_capture': scan.SCAN_MAX_CAPTURE,
+           'extended': scan.SCAN_EXTENDED}
+
+_length = struct.Struct('<H')
+
+def encode_json(report, timestamp):
+    rssi = report['rssi']
+    return json.dumps({'timestamp': round(timestamp, 6),
+                       'adapter': report.get('adapter'),
+                       'address': report['bdaddr'],
+                       'address_type': report['bdaddr_type'],
+                       'evt_type': report['evt_type'],
+                       'rssi': rssi,
+                       'data': binascii.hexlify(report['data'])},
+                      separators=(',',':'), sort_keys=True)+'\n'
+
+def encode_binary(report, timestamp):
+    frame = broker.encode_report(report, timestamp)
+    return _length.pack(len(frame))+frame
+
+FORMATS = {'json': ('.jsonl', encode_json),
+           'binary': ('.bin', encode_binary)}
+
+def read_binary(path):
+    "Yields the reports of a binary log, see broker.decode_report()."
+    with open(path, 'rb') as f:
+        while 1:
+            head = f.read(_length.size)
+            if len(head) < _length.size:
+                return
+            frame = f.read(_length.unpack(head)[0])
+            if len(frame) < _length.unpack(head)[0]:
+                return # cut short by a crash; the rest is lost
+            yield broker.decode_report(frame)
+
+class RotatingLog(object):
+    """Writes encoded records to base-<start time><suffix>, opening a
+    new file past max_bytes or max_seconds. Records are batched and
+    written at flush_bytes or every flush_interval seconds."""
+
+    def __init__(self, base, suffix, max_bytes=None, max_seconds=None,
+                 flush_bytes=FLUSH_BYTES, flush_interval=FLUSH_INTERVAL):
+        self.base = base
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+
+        self.f = None
+        self.path = None
+        self._last_path = None
+        self.files = 0
+        self.records = 0
+        self._batch = []
+        self._batch_bytes = 0
+        self._last_flush = time.time()
+
+    def _open(self, now):
+        if self.f is not None:
+            self.f.close()
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+        self.path = "%s-%s%s"%(self.base, stamp, self.suffix)
+        if self.path == self._last_path:
+            self.path = "%s-%s.%d%s"%(self.base, stamp, self.files, self.suffix)
+        self._last_path = self.path
+        self.f = open(self.path, 'ab', self.flush_bytes)
+        self.files += 1
+        self._opened = now
+        self._size = 0
+
+    def write(self, record, now=None):
+        if now is None:
+            now = time.time()
+        self._batch.append(record)
+        self._batch_bytes += len(record)
+        self.records += 1
+        if (self._batch_bytes >= self.flush_bytes or
+            now-self._last_flush >= self.flush_interval):
+            self.flush(now)
+
+    def flush(self, now=None):
+        if now is None:
+            now = time.time()
+        self._last_flush = now
+        if not self._batch:
+            return
+
+        if (self.f is None or
+            (self.max_bytes is not None and self._size >= self.max_bytes) or
+            (self.max_seconds is not None and
+             now-self._opened >= self.max_seconds)):
+            self._open(now)
+
+        self.f.write(''.join(self._batch))
+        self.f.flush()
+        self._size += self._batch_bytes
+        self._batch = []
+        self._batch_bytes = 0
+
+    def close(self):
+        self.flush()
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+class Stats(object):
+    "Counts for the periodic stats line."
+
+    def __init__(self, scanner):
+        self.scanner = scanner
+        self.t_start = self.t_last = time.time()
+        self.reports = self.reports_last = 0
+
+    def dropped(self):
+        "Extended reports given up on while reassembling."
+        return sum(source.reassembler.dropped
+                   for source in self.scanner.sources.values())
+
+    def line(self, now=None):
+        if now is None:
+            now = time.time()
+        rate = (self.reports-self.reports_last)/max(now-self.t_last, 1e-6)
+        self.t_last = now
+        self.reports_last = self.reports
+        return ("%.0fs: %d reports, %.1f reports/s, %d dropped, "
+                "%d decode errors, %d duplicates"%(
+                    now-self.t_start, self.reports, rate, self.dropped(),
+                    self.scanner.decode_errors, self.scanner.duplicates))
+
+def run(scanner, log, encode, stats_interval=10, stats_file=sys.stderr):
+    "Logs the reports of scanner until it runs out of sources."
+    stats = Stats(scanner)
+    next_stats = time.time()+stats_interval if stats_interval else None
+    write = log.write
+
+    while scanner.sources:
+        reports = scanner.poll(log.flush_interval)
+        now = time.time()
+        for report in reports:
+            write(encode(report, now), now)
+        stats.reports += len(reports)
+        if not reports:
+            log.flush(now)
+
+        if next_stats is not None and now >= next_stats:
+            print >> stats_file, stats.line(now)
+            next_stats = now+stats_interval
+
+    log.flush()
+    if stats_interval:
+        print >> stats_file, stats.line()
+
+def main(argv):
+    opts,args = getopt.getopt(argv, 'o:f:s:t:i:p:r:')
+    opts = dict(opts)
+
+    suffix,encode = FORMATS[opts.get('-f', 'json')]
+    log = RotatingLog(opts.get('-o', 'scan'), suffix,
+                      int(opts['-s']) if '-s' in opts else None,
+                      float(opts['-t']) if '-t' in opts else None)
+
+    if '-r' in opts:
+        import capture
+        s = scan.HciScanner([capture.ReplaySource(opts['-r'], speed=None)])
+    else:
+        params = PRESETS[opts.get('-p', 'default')]
+        if args == ['all']:
+            dev_ids = 'all'
+        else:
+            dev_ids = [int(d) for d in args] or (None,)
+        s = scan.scanner(dev_ids, params=params)
+
+    try:
+        run(s, log, encode, float(opts.get('-i', 10)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        s.close()
+        log.close()
+
+if __name__=="__main__":
+    main(sys.argv[1:])
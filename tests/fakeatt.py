@@ -0,0 +1,192 @@
+#!/usr/bin/python2
+
+"""A GATT server on one end of a socketpair, standing in for a device
+on the ATT channel.
+
+The database is a dict of handle -> (attribute type, value), both as
+ATT bytes. Responses follow the spec closely enough for the client's
+discovery loops: they are cut at the MTU and grouped by value length.
+Every opcode received is recorded in log.
+"""
+
+import os
+import sys
+import socket
+import struct
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import att
+
+def u16(value):
+    return struct.pack('<H', value)
+
+def declaration(properties, value_handle, uuid16):
+    return struct.pack('<BH', properties, value_handle)+u16(uuid16)
+
+DEVICE_NAME = 'A device name long enough to need Read Blob requests'
+DB_HASH = '\x11'*16
+
+def heart_rate_database():
+    "GAP, GATT (with Service Changed and Database Hash), heart rate, battery."
+    return {1: (u16(0x2800), u16(0x1800)),
+            2: (u16(0x2803), declaration(att.PROP_READ, 3, 0x2a00)),
+            3: (u16(0x2a00), DEVICE_NAME),
+            4: (u16(0x2800), u16(0x1801)),
+            5: (u16(0x2803), declaration(att.PROP_INDICATE, 6, 0x2a05)),
+            6: (u16(0x2a05), ''),
+            7: (u16(0x2902), '\0\0'),
+            8: (u16(0x2803), declaration(att.PROP_READ, 9, 0x2b2a)),
+            9: (u16(0x2b2a), DB_HASH),
+            10: (u16(0x2800), u16(0x180d)),
+            11: (u16(0x2803), declaration(att.PROP_NOTIFY, 12, 0x2a37)),
+            12: (u16(0x2a37), ''),
+            13: (u16(0x2902), '\0\0'),
+            14: (u16(0x2803), declaration(att.PROP_READ, 15, 0x2a38)),
+            15: (u16(0x2a38), '\x01'),
+            16: (u16(0x2803), declaration(att.PROP_WRITE, 17, 0x2a39)),
+            17: (u16(0x2a39), ''),
+            18: (u16(0x2800), u16(0x180f)),
+            19: (u16(0x2803), declaration(att.PROP_READ|att.PROP_NOTIFY,
+                                          20, 0x2a19)),
+            20: (u16(0x2a19), '\x57'),
+            21: (u16(0x2902), '\0\0')}
+
+class FakeServer(threading.Thread):
+    last_end = None # end handle of the last service, the last handle if None
+    find_limit = None # Find Information past this handle is refused
+
+    def __init__(self, sock, db=None, mtu=50):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = sock
+        self.db = heart_rate_database() if db is None else db
+        self.server_mtu = mtu
+        self.mtu = att.DEFAULT_MTU
+        self.log = []
+        self.confirmations = 0
+        self.before_response = [] # PDUs sent ahead of the next response
+        self.start()
+
+    @classmethod
+    def pair(cls, *args, **kwargs):
+        "Returns (client socket, server)."
+        client,server = socket.socketpair(socket.AF_UNIX,
+                                          socket.SOCK_SEQPACKET)
+        return client, cls(server, *args, **kwargs)
+
+    def send(self, pdu):
+        self.sock.send(pdu)
+
+    def notify(self, handle, value, indicate=False):
+        self.send(struct.pack('<BH', att.HANDLE_VALUE_IND if indicate
+                              else att.HANDLE_VALUE_NTF, handle)+value)
+
+    def _groups(self):
+        starts = sorted(h for h,(t,v) in self.db.items() if t == u16(0x2800))
+        ends = [s-1 for s in starts[1:]]+[self.last_end or max(self.db)]
+        return zip(starts, ends)
+
+    def _fit(self, items, header):
+        "Leading items of the same length that fit in the MTU."
+        ret = []
+        for item in items:
+            if len(item) != len(items[0]) or header+len(item)*(len(ret)+1) > self.mtu:
+                break
+            ret.append(item)
+        return ret
+
+    def _error(self, opcode, handle, code):
+        return att.encode_error_rsp(opcode, handle, code)
+
+    def respond(self, pdu):
+        opcode = ord(pdu[0])
+        if opcode == att.EXCHANGE_MTU_REQ:
+            self.mtu = min(struct.unpack_from('<H', pdu, 1)[0], self.server_mtu)
+            return struct.pack('<BH', att.EXCHANGE_MTU_RSP, self.server_mtu)
+
+        if opcode == att.READ_BY_GROUP_TYPE_REQ:
+            start,end = struct.unpack_from('<HH', pdu, 1)
+            items = [struct.pack('<HH', s, e)+self.db[s][1]
+                     for s,e in self._groups() if start <= s <= end]
+            if not items:
+                return self._error(opcode, start, att.ATTRIBUTE_NOT_FOUND)
+            items = self._fit(items, 2)
+            return chr(att.READ_BY_GROUP_TYPE_RSP)+chr(len(items[0]))+''.join(items)
+
+        if opcode == att.FIND_BY_TYPE_VALUE_REQ:
+            start,end,_ = struct.unpack_from('<HHH', pdu, 1)
+            value = pdu[7:]
+            found = [struct.pack('<HH', s, e) for s,e in self._groups()
+                     if start <= s <= end and self.db[s][1] == value]
+            if not found:
+                return self._error(opcode, start, att.ATTRIBUTE_NOT_FOUND)
+            return chr(att.FIND_BY_TYPE_VALUE_RSP)+''.join(found)
+
+        if opcode == att.READ_BY_TYPE_REQ:
+            start,end = struct.unpack_from('<HH', pdu, 1)
+            att_type = pdu[5:]
+            items = [u16(h)+self.db[h][1] for h in sorted(self.db)
+                     if start <= h <= end and self.db[h][0] == att_type]
+            if not items:
+                return self._error(opcode, start, att.ATTRIBUTE_NOT_FOUND)
+            items = self._fit(items, 2)
+            return chr(att.READ_BY_TYPE_RSP)+chr(len(items[0]))+''.join(items)
+
+        if opcode == att.FIND_INFORMATION_REQ:
+            start,end = struct.unpack_from('<HH', pdu, 1)
+            if self.find_limit is not None and end > self.find_limit:
+                return self._error(opcode, start, att.INVALID_HANDLE)
+            items = [u16(h)+self.db[h][0] for h in sorted(self.db)
+                     if start <= h <= end]
+            if not items:
+                return self._error(opcode, start, att.ATTRIBUTE_NOT_FOUND)
+            return chr(att.FIND_INFORMATION_RSP)+'\x01'+''.join(self._fit(items, 2))
+
+        if opcode == att.READ_REQ:
+            handle = struct.unpack_from('<H', pdu, 1)[0]
+            if handle not in self.db:
+                return self._error(opcode, handle, att.INVALID_HANDLE)
+            return chr(att.READ_RSP)+self.db[handle][1][:self.mtu-1]
+
+        if opcode == att.READ_BLOB_REQ:
+            handle,offset = struct.unpack_from('<HH', pdu, 1)
+            value = self.db[handle][1]
+            if offset > len(value):
+                return self._error(opcode, handle, att.INVALID_OFFSET)
+            return chr(att.READ_BLOB_RSP)+value[offset:offset+self.mtu-1]
+
+        if opcode in (att.WRITE_REQ, att.WRITE_CMD):
+            handle = struct.unpack_from('<H', pdu, 1)[0]
+            self.db[handle] = (self.db[handle][0], pdu[3:])
+            if opcode == att.WRITE_REQ:
+                return chr(att.WRITE_RSP)
+            return None
+
+        if opcode == att.HANDLE_VALUE_CFM:
+            self.confirmations += 1
+            return None
+
+        if opcode == att.ERROR_RSP:
+            return None
+        return self._error(opcode, 0, att.REQUEST_NOT_SUPPORTED)
+
+    def run(self):
+        while 1:
+            try:
+                pdu = self.sock.recv(att.MAX_MTU)
+            except socket.error:
+                return
+            if not pdu:
+                return
+            self.log.append(ord(pdu[0]))
+            response = self.respond(pdu)
+            if response is not None:
+                for extra in self.before_response:
+                    self.send(extra)
+                self.before_response = []
+                self.send(response)
+
+    def close(self):
+        self.sock.close()
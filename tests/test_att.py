@@ -0,0 +1,237 @@
+#!/usr/bin/python2
+
+"""AttClient and ble_att.Device against fakeatt.FakeServer.
+
+Run from the top of the tree with:  python -m unittest discover tests
+"""
+
+import shutil
+import tempfile
+import unittest
+
+from fakeatt import FakeServer, heart_rate_database, u16, DEVICE_NAME
+
+import att
+import uuids
+import gattcache
+import ble_att
+
+ADDRESS = 'c0:ff:ee:c0:ff:ee'
+
+class RefusingServer(FakeServer):
+    "Ends the last service at 0xffff, and fails Find Information past it."
+    last_end = 0xffff
+    find_limit = 21
+
+class AttClientTest(unittest.TestCase):
+    def setUp(self):
+        self.notifications = []
+        sock,self.server = FakeServer.pair()
+        self.client = att.AttClient(sock, self._notified, timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def _notified(self, handle, value):
+        self.notifications.append((handle, value))
+
+    def test_exchange_mtu(self):
+        self.assertEqual(self.client.exchange_mtu(517), 50)
+        self.assertEqual(self.client.mtu, 50)
+        self.assertEqual(self.client.exchange_mtu(40), 40)
+        self.assertEqual(self.server.mtu, 40)
+
+    def test_primary_services(self):
+        # Three services fit a response at the default MTU.
+        self.assertEqual(self.client.primary_services(),
+                         [(1, 3, uuids.generic_access),
+                          (4, 9, uuids.generic_attribute),
+                          (10, 17, uuids.heart_rate),
+                          (18, 21, uuids.battery_service)])
+        self.assertEqual(self.server.log, [att.READ_BY_GROUP_TYPE_REQ]*3)
+
+    def test_primary_service_by_uuid(self):
+        self.assertEqual(self.client.primary_service_by_uuid(uuids.heart_rate),
+                         [(10, 17)])
+        self.assertEqual(
+            self.client.primary_service_by_uuid(uuids.device_information), [])
+
+    def test_characteristics(self):
+        found = self.client.characteristics(1, 21)
+        self.assertEqual([(h, vh) for h,p,vh,u in found],
+                         [(2, 3), (5, 6), (8, 9), (11, 12), (14, 15),
+                          (16, 17), (19, 20)])
+        self.assertEqual(found[3], (11, att.PROP_NOTIFY, 12,
+                                    uuids.heart_rate_measurement))
+        # Three declarations to a response, then one past the last.
+        self.assertEqual(self.server.log, [att.READ_BY_TYPE_REQ]*4)
+
+    def test_find_information(self):
+        found = self.client.find_information(10, 17)
+        self.assertEqual([h for h,u in found], range(10, 18))
+        self.assertEqual(found[3],
+                         (13, uuids.client_characteristic_configuration))
+        self.assertEqual(self.server.log, [att.FIND_INFORMATION_REQ]*2)
+
+    def test_long_read(self):
+        self.assertEqual(self.client.read(3), DEVICE_NAME)
+        self.assertEqual(self.server.log,
+                         [att.READ_REQ, att.READ_BLOB_REQ, att.READ_BLOB_REQ])
+
+    def test_long_read_after_mtu_exchange(self):
+        self.client.exchange_mtu(517)
+        self.assertEqual(self.client.read(3), DEVICE_NAME)
+        self.assertEqual(self.server.log[1:],
+                         [att.READ_REQ, att.READ_BLOB_REQ])
+
+    def test_error_response(self):
+        with self.assertRaises(att.AttError) as cm:
+            self.client.read(99)
+        self.assertEqual(cm.exception.code, att.INVALID_HANDLE)
+        self.assertEqual(cm.exception.handle, 99)
+
+    def test_notification_during_request(self):
+        self.server.before_response = [
+            '\x1b'+u16(12)+'\x00\x48',
+            '\x1d'+u16(6)+u16(1)+u16(0xffff)]
+        self.assertEqual(self.client.read(15), '\x01')
+        self.assertEqual(self.notifications,
+                         [(12, '\x00\x48'), (6, u16(1)+u16(0xffff))])
+        # The indication's confirmation reaches the server ahead of
+        # the next request.
+        self.client.read(15)
+        self.assertEqual(self.server.confirmations, 1)
+
+    def test_error_for_other_request(self):
+        self.server.before_response = [
+            att.encode_error_rsp(att.WRITE_REQ, 17, att.WRITE_NOT_PERMITTED)]
+        self.assertEqual(self.client.read(15), '\x01')
+
+    def test_write(self):
+        self.client.write(17, '\x01')
+        self.client.write(13, '\x01\x00', response=False)
+        self.client.read(15) # the command is handled by now
+        self.assertEqual(self.server.db[17][1], '\x01')
+        self.assertEqual(self.server.db[13][1], '\x01\x00')
+        self.assertRaises(ValueError, self.client.write, 17, 'x'*21)
+
+    def test_process(self):
+        self.assertFalse(self.client.process(0.01))
+        self.server.notify(20, '\x56')
+        self.assertTrue(self.client.process(1))
+        self.assertEqual(self.notifications, [(20, '\x56')])
+
+class DeviceTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.saved = ble_att.gatt_cache, ble_att.l2cap_connect
+        ble_att.gatt_cache = gattcache.GattCache(self.cache_dir)
+        self.servers = []
+
+    def tearDown(self):
+        ble_att.gatt_cache, ble_att.l2cap_connect = self.saved
+        for server in self.servers:
+            server.close()
+        shutil.rmtree(self.cache_dir)
+
+    def connect(self, db=None, server_class=FakeServer, **kwargs):
+        sock,server = server_class.pair(db)
+        self.servers.append(server)
+        ble_att.l2cap_connect = lambda *args: sock
+        return ble_att.Device(ADDRESS).connect(**kwargs), server
+
+    def discover_all(self, dev):
+        for s in dev.services:
+            s.characteristics
+
+    def test_discovery(self):
+        dev,server = self.connect()
+        self.assertEqual(dev.client.mtu, 50)
+        self.assertEqual([s.uuid for s in dev.services],
+                         [uuids.generic_access, uuids.generic_attribute,
+                          uuids.heart_rate, uuids.battery_service])
+        self.assertEqual(dev.generic_access_service.device_name.value,
+                         DEVICE_NAME)
+        hrm = dev.heart_rate_service.heart_rate_measurement
+        self.assertEqual(hrm.cccd.handle, 13)
+        self.assertEqual(dev.battery_service.battery_level.value, [0x57])
+        dev.disconnect()
+        self.assertFalse(dev.connected())
+
+    def test_notify(self):
+        dev,server = self.connect()
+        hrm = dev.heart_rate_service.heart_rate_measurement
+        hrm.notifying = True
+        self.assertEqual(server.db[13][1], '\x01\x00')
+        server.notify(12, '\x00\x48')
+        self.assertEqual(hrm.value, [0x00, 0x48])
+        hrm.notify_timeout = 0.05
+        self.assertRaises(ble_att.NoNotifyException, lambda: hrm.value)
+
+    def test_cache_reuse(self):
+        dev,server = self.connect()
+        self.discover_all(dev)
+        dev.disconnect()
+
+        # MTU exchange, the Database Hash, and Service Changed
+        # indications turned on: nothing is discovered.
+        dev,server = self.connect()
+        self.discover_all(dev)
+        self.assertEqual(server.log, [att.EXCHANGE_MTU_REQ,
+                                      att.READ_BY_TYPE_REQ, att.WRITE_REQ])
+        self.assertEqual(dev.heart_rate_service.heart_rate_measurement.cccd.handle,
+                         13)
+
+        dev,server = self.connect(use_cache=False)
+        self.assertIn(att.READ_BY_GROUP_TYPE_REQ, server.log)
+
+    def test_cache_with_services(self):
+        dev,server = self.connect()
+        self.discover_all(dev)
+        dev.disconnect()
+
+        dev,server = self.connect(services=[uuids.battery_service])
+        self.assertEqual([s.uuid for s in dev.services],
+                         [uuids.battery_service])
+        self.assertEqual(dev.battery_service.battery_level.value, [0x57])
+        self.assertEqual(dev.heart_rate_service.start, 10)
+        self.assertNotIn(att.READ_BY_GROUP_TYPE_REQ, server.log)
+        self.assertNotIn(att.FIND_BY_TYPE_VALUE_REQ, server.log)
+
+    def test_trailing_descriptors(self):
+        dev,server = self.connect(server_class=RefusingServer, use_cache=False)
+        self.assertEqual(dev.battery_service.end, 0xffff)
+        self.assertEqual(dev.battery_service.battery_level.cccd.handle, 21)
+        self.assertEqual(
+            dev.heart_rate_service.heart_rate_measurement.cccd.handle, 13)
+
+    def test_cache_stale_hash(self):
+        dev,server = self.connect()
+        self.discover_all(dev)
+        dev.disconnect()
+
+        db = heart_rate_database()
+        db[9] = (db[9][0], '\x22'*16)
+        dev,server = self.connect(db)
+        self.assertIn(att.READ_BY_GROUP_TYPE_REQ, server.log)
+
+    def test_service_changed(self):
+        dev,server = self.connect()
+        self.discover_all(dev)
+        self.assertIsNotNone(ble_att.gatt_cache.load(ADDRESS))
+        server.notify(6, u16(1)+u16(0xffff), indicate=True)
+        dev.client.process(1)
+        self.assertIsNone(ble_att.gatt_cache.load(ADDRESS))
+
+    def test_services_by_uuid(self):
+        dev,server = self.connect(services=[uuids.battery_service],
+                                  use_cache=False)
+        self.assertEqual([s.uuid for s in dev.services],
+                         [uuids.battery_service])
+        self.assertNotIn(att.READ_BY_GROUP_TYPE_REQ, server.log)
+        # Others are found when first used.
+        self.assertEqual(dev.heart_rate_service.start, 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python2
+
+"""ScanBroker end to end: a btsnoop file of HCI events, replayed by
+capture.ReplaySource, published to filtered BrokerClients.
+
+Run from the top of the tree with:  python -m unittest discover tests
+"""
+
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scan
+import broker
+import capture
+
+HRM = 'c0:ff:ee:00:00:01'
+BATTERY = 'c0:ff:ee:00:00:02'
+BEACON = 'c0:ff:ee:00:00:03'
+
+HRM_DATA = '\x02\x01\x06\x03\x03\x0d\x18\x04\x09HRM'
+BATTERY_DATA = '\x02\x01\x06\x03\x03\x0f\x18'
+BEACON_DATA = '\x02\x01\x06\x05\xff\x59\x00\x01\x02'
+
+def adv_event(address, data, rssi, evt_type=scan.ADV_IND):
+    "An LE Advertising Report event with one report, as read from HCI."
+    params = (struct.pack('<BBBB', 0x02, 1, evt_type, 0)+
+              broker.address_bytes(address)+
+              chr(len(data))+data+struct.pack('b', rssi))
+    return struct.pack('<BBB', scan.HCI_EVENT_PKT, scan.EVT_LE_META_EVENT,
+                       len(params))+params
+
+# What an HciScanner with a capture records: the events, and (sent,
+# not replayed) the commands of whoever else uses the adapter.
+RECORDING = [
+    ('\x01\x0c\x20\x02\x01\x00', False), # LE Set Scan Enable
+    ('\x04\x0e\x04\x01\x0c\x20\x00', True), # its Command Complete
+    (adv_event(HRM, HRM_DATA, -50), True),
+    (adv_event(BATTERY, BATTERY_DATA, -80), True),
+    (adv_event(BEACON, BEACON_DATA, -40, scan.ADV_NONCONN_IND), True),
+    (adv_event(HRM, HRM_DATA, -55), True),
+]
+
+class BrokerReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.capture = os.path.join(self.dir, 'scan.btsnoop')
+        with capture.BtsnoopWriter(self.capture) as w:
+            for i,(packet,received) in enumerate(RECORDING):
+                w.write(packet, timestamp=1500000000+i*0.1,
+                        received=received)
+        self.broker = broker.ScanBroker(os.path.join(self.dir, 'broker'))
+
+    def tearDown(self):
+        self.broker.close()
+        shutil.rmtree(self.dir)
+
+    def replay(self, **subscriptions):
+        """Replays the capture to a client for each subscription (the
+        arguments of BrokerClient) and returns the reports each got."""
+        clients = dict((name, broker.BrokerClient(self.broker.path, **kwargs))
+                       for name,kwargs in subscriptions.items())
+        try:
+            self.assertTrue(self.broker.wait_clients(len(clients), 5.0))
+            scanner = scan.HciScanner([capture.ReplaySource(self.capture,
+                                                            speed=None)])
+            try:
+                self.broker.run(scanner)
+            finally:
+                scanner.close()
+            return dict((name, list(client.reports(0.5)))
+                        for name,client in clients.items())
+        finally:
+            for client in clients.values():
+                client.close()
+
+    def test_filtered_subscriptions(self):
+        got = self.replay(heart_rate={'uuids': ['180d']},
+                          near={'rssi': -60},
+                          battery={'addresses': [BATTERY.upper()]},
+                          everything={})
+        bdaddrs = lambda name: [r['bdaddr'] for r in got[name]]
+        self.assertEqual(bdaddrs('heart_rate'), [HRM, HRM])
+        self.assertEqual(bdaddrs('near'), [HRM, BEACON, HRM])
+        self.assertEqual(bdaddrs('battery'), [BATTERY])
+        self.assertEqual(bdaddrs('everything'), [HRM, BATTERY, BEACON, HRM])
+        self.assertEqual(self.broker.published, 4)
+
+    def test_report_fields(self):
+        got = self.replay(heart_rate={'uuids': [0x180d]})
+        first,second = got['heart_rate']
+        self.assertEqual(first['data'], HRM_DATA)
+        self.assertEqual(first['rssi'], -50)
+        self.assertEqual(second['rssi'], -55)
+        self.assertEqual(first['evt_type'], scan.ADV_IND)
+        self.assertEqual(first['adapter'], 'replay')
+
+if __name__ == '__main__':
+    unittest.main()
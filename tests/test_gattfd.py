@@ -0,0 +1,157 @@
+#!/usr/bin/python2
+
+"""gattfd sockets, and the ble_dbus characteristics using them, with a
+socketpair standing in for bluetoothd.
+
+Run from the top of the tree with:  python -m unittest discover tests
+"""
+
+import os
+import sys
+import socket
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gattfd
+
+try:
+    import ble_dbus
+except Exception: # no dbus module, or no system bus with bluez
+    ble_dbus = None
+
+MTU = 23
+
+def acquired():
+    """Returns (fd, peer): a file descriptor as AcquireNotify and
+    AcquireWrite hand out, and the bluetoothd end of it."""
+    ours,peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    fd = os.dup(ours.fileno())
+    ours.close()
+    return fd, peer
+
+class NotifySocketTest(unittest.TestCase):
+    def setUp(self):
+        fd,self.peer = acquired()
+        self.sock = gattfd.NotifySocket(gattfd.from_fd(fd), MTU)
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def test_from_fd_closes_fd(self):
+        fd,peer = acquired()
+        sock = gattfd.from_fd(fd)
+        self.assertRaises(OSError, os.fstat, fd)
+        sock.close()
+        peer.close()
+
+    def test_notifications(self):
+        for value in ('\x00\x48', '\x00\x49\x01', 'x'*(MTU-3)):
+            self.peer.send(value)
+            self.assertEqual(self.sock.recv(1.0), value)
+        self.assertEqual(self.sock.count, 3)
+
+    def test_recv_into_reuses_buffer(self):
+        self.peer.send('ab')
+        first = self.sock.recv_into(1.0)
+        self.assertEqual(first.tobytes(), 'ab')
+        self.peer.send('cd')
+        self.sock.recv_into(1.0)
+        self.assertEqual(first.tobytes(), 'cd')
+
+    def test_timeout(self):
+        self.assertRaises(socket.timeout, self.sock.recv, 0.01)
+        self.peer.send('\x01')
+        self.assertEqual(self.sock.recv(None), '\x01')
+
+    def test_eof(self):
+        self.peer.close()
+        self.assertRaises(IOError, self.sock.recv, 1.0)
+
+class WriteSocketTest(unittest.TestCase):
+    def setUp(self):
+        fd,self.peer = acquired()
+        self.sock = gattfd.WriteSocket(gattfd.from_fd(fd), MTU)
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def test_write(self):
+        self.sock.write('\x01\x02')
+        self.sock.write(bytearray('\x03'))
+        self.sock.write(memoryview('\x04\x05')[1:])
+        self.assertEqual([self.peer.recv(MTU) for _ in range(3)],
+                         ['\x01\x02', '\x03', '\x05'])
+        self.assertEqual(self.sock.count, 3)
+
+    def test_mtu(self):
+        self.assertEqual(self.sock.max_value, MTU-3)
+        self.sock.write('x'*(MTU-3))
+        self.assertEqual(self.peer.recv(MTU), 'x'*(MTU-3))
+        self.assertRaises(ValueError, self.sock.write, 'x'*(MTU-2))
+        self.assertEqual(self.sock.count, 1)
+
+class FakeGattCharacteristic(object):
+    "The AcquireNotify and AcquireWrite methods of bluetoothd."
+
+    def __init__(self):
+        self.peers = []
+
+    def _acquire(self, options):
+        fd,peer = acquired()
+        self.peers.append(peer)
+        return fd, MTU
+
+    AcquireNotify = AcquireWrite = _acquire
+
+@unittest.skipIf(ble_dbus is None, "needs dbus and bluez")
+class AcquireTest(unittest.TestCase):
+    def setUp(self):
+        char = ble_dbus.Characteristic.__new__(ble_dbus.Characteristic)
+        char.uuid = '00002a37-0000-1000-8000-00805f9b34fb'
+        char._flags = ['read', 'notify', 'write-without-response']
+        char.methods = FakeGattCharacteristic()
+        char._notify_sock = char._write_sock = None
+        char._read_procedure = ble_dbus.REQUEST
+        char._write_procedure = ble_dbus.COMMAND
+        char._notify_timeout = 1.0
+        char.notify_counter = 0
+        char.value_lock = ble_dbus.threading.Lock()
+        self.char = char
+
+    def tearDown(self):
+        self.char.release()
+        for peer in self.char.methods.peers:
+            peer.close()
+
+    def test_notify(self):
+        sock = self.char.acquire_notify()
+        self.assertIs(self.char.acquire_notify(), sock)
+        self.assertEqual(self.char.read_procedure, ble_dbus.NOTIFY)
+        peer, = self.char.methods.peers
+        peer.send('\x00\x48')
+        self.assertEqual(self.char.raw, '\x00\x48')
+        self.assertEqual(self.char.notify_counter, 1)
+
+    def test_write(self):
+        self.char.acquire_write()
+        peer, = self.char.methods.peers
+        self.char.raw = '\x01'
+        self.assertEqual(peer.recv(MTU), '\x01')
+        def too_long():
+            self.char.raw = 'x'*MTU
+        self.assertRaises(ValueError, too_long)
+
+    def test_release(self):
+        self.char.acquire_notify()
+        self.char.acquire_write()
+        self.char.release()
+        self.assertEqual(self.char.read_procedure, ble_dbus.REQUEST)
+        # bluetoothd sees both sockets closed.
+        for peer in self.char.methods.peers:
+            self.assertEqual(peer.recv(MTU), '')
+
+if __name__ == '__main__':
+    unittest.main()
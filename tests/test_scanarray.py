@@ -0,0 +1,135 @@
+#!/usr/bin/python2
+
+"""ReportArray columns, rows and (with numpy) the structured export.
+
+Run from the top of the tree with:  python -m unittest discover tests
+"""
+
+import os
+import sys
+import array
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scanarray
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HRM = 'c0:ff:ee:00:00:01'
+BEACON = 'ff:ee:dd:cc:bb:aa'
+
+HRM_DATA = '\x02\x01\x06\x03\x03\x0d\x18\x04\x09HRM'
+BEACON_DATA = '\x02\x01\x06\x05\xff\x59\x00\x01\x02' # manufacturer data, 0xff
+
+def filled():
+    reports = scanarray.ReportArray()
+    reports.append(HRM, -50, HRM_DATA, 1, 0, 'hci0', now=100.0)
+    reports.append(BEACON, None, BEACON_DATA, 0, 3, 'hci1', now=101.0)
+    reports.append(HRM, -55, HRM_DATA, 1, 0, 'hci0', now=102.0)
+    return reports
+
+class ColumnTest(unittest.TestCase):
+    def test_typecodes(self):
+        sizes = dict((name, array.array(typecode).itemsize)
+                     for name,typecode in scanarray.COLUMNS)
+        # A double holds any 48-bit address exactly; the ad_types
+        # bitmask is two 32-bit halves.
+        self.assertEqual(sizes['address'], 8)
+        self.assertEqual(sizes['timestamp'], 8)
+        self.assertEqual(sizes['ad_types_lo'], 4)
+        self.assertEqual(sizes['ad_types_hi'], 4)
+        self.assertEqual(sizes['offset'], 4)
+        self.assertEqual(sizes['rssi'], 2)
+        self.assertEqual(sizes['length'], 2)
+
+    def test_fields_match_columns(self):
+        columns = [name for name,_ in scanarray.COLUMNS]
+        columns[columns.index('ad_types_lo'):
+                columns.index('ad_types_hi')+1] = ['ad_types']
+        self.assertEqual([name for name,_ in scanarray.FIELDS], columns)
+
+    def test_column_arrays(self):
+        reports = filled()
+        for name,typecode in scanarray.COLUMNS:
+            column = getattr(reports, name)
+            self.assertEqual(column.typecode, typecode)
+            self.assertEqual(len(column), 3)
+
+class ReportArrayTest(unittest.TestCase):
+    def test_rows(self):
+        reports = filled()
+        self.assertEqual(len(reports), 3)
+        self.assertEqual(reports.row(0),
+                         {'bdaddr': HRM, 'bdaddr_type': 1, 'evt_type': 0,
+                          'rssi': -50, 'adapter': 'hci0', 'timestamp': 100.0,
+                          'data': HRM_DATA})
+        row = reports.row(1)
+        self.assertEqual(row['bdaddr'], BEACON)
+        self.assertIsNone(row['rssi'])
+        self.assertEqual(row['adapter'], 'hci1')
+        self.assertEqual([r['data'] for r in reports],
+                         [HRM_DATA, BEACON_DATA, HRM_DATA])
+
+    def test_shared_payloads(self):
+        reports = filled()
+        self.assertEqual(reports.offset[0], reports.offset[2])
+        self.assertEqual(len(reports.payloads),
+                         len(HRM_DATA)+len(BEACON_DATA))
+
+    def test_ad_types(self):
+        reports = filled()
+        self.assertEqual(reports.ad_types_lo[0], (1<<0x01)|(1<<0x03)|(1<<0x09))
+        self.assertEqual(reports.ad_types_hi[0], 0)
+        # AD types above 62 share bit 63.
+        self.assertEqual(reports.ad_types_lo[1], 1<<0x01)
+        self.assertEqual(reports.ad_types_hi[1], 1<<31)
+
+    def test_capacity(self):
+        reports = scanarray.ReportArray(capacity=4)
+        for i in range(5):
+            data = BEACON_DATA if i < 3 else HRM_DATA
+            reports.append(HRM, -i, data, now=float(i))
+        self.assertEqual(len(reports), 3)
+        self.assertEqual(reports.dropped, 2)
+        self.assertEqual([r['rssi'] for r in reports], [-2, -3, -4])
+        self.assertEqual(reports.payload(0), BEACON_DATA)
+        self.assertEqual(reports.payload(2), HRM_DATA)
+
+@unittest.skipIf(numpy is None, "needs numpy")
+class NumpyTest(unittest.TestCase):
+    def test_dtype(self):
+        dtype = filled().dtype()
+        self.assertEqual(dtype.names,
+                         tuple(name for name,_ in scanarray.FIELDS))
+        self.assertEqual(dtype['address'], numpy.dtype('u8'))
+        self.assertEqual(dtype['ad_types'], numpy.dtype('u8'))
+        self.assertEqual(dtype['rssi'], numpy.dtype('i2'))
+
+    def test_to_numpy(self):
+        reports = filled()
+        rows = reports.to_numpy()
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows['address'][1], 0xffeeddccbbaa)
+        self.assertEqual(list(rows['rssi']),
+                         [-50, scanarray.RSSI_NONE, -55])
+        self.assertEqual(list(rows['timestamp']), [100.0, 101.0, 102.0])
+        # Bit 63 survives the join of the two halves.
+        self.assertEqual(int(rows['ad_types'][1]),
+                         scanarray.ad_type_mask(BEACON_DATA))
+        self.assertEqual(int(rows['ad_types'][1]) >> 63, 1)
+
+    def test_select(self):
+        reports = filled()
+        self.assertEqual(len(reports.select(uuid=0x180d)), 2)
+        self.assertEqual(len(reports.select(uuid=['180f', '180d'])), 2)
+        self.assertEqual(len(reports.select(uuid='180f')), 0)
+        self.assertEqual(len(reports.select(min_rssi=-52)), 1)
+        self.assertEqual(len(reports.select(adapter='hci1')), 1)
+        self.assertEqual(len(reports.select(ad_type=0xff)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
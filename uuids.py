@@ -22,11 +22,12 @@ def setup_uuid_type(uuid, ident_name, desc_name):
         globals()[ident_name]=uuid
 
 def canonical_uuid(uuid):
+    "16 and 32-bit uuids, as ints or hex strings, are put on the base uuid."
     if type(uuid)==int:
-        uuid=str(uuid)
+        uuid=hex(uuid)
 
     if len(uuid) < 32:
-        uuid="%08x-0000-1000-8000-00805f9b34fb"%int(uuid,0)
+        uuid="%08x-0000-1000-8000-00805f9b34fb"%int(uuid,16)
 
     return uuid
 